@@ -20,7 +20,8 @@ from utils import parse, utils
 # SLD specific imports
 from sld.detector import OWLVITV2Detector
 from sld.sdxl_refine import sdxl_refine
-from sld.utils import get_all_latents, run_sam, run_sam_postprocess, resize_image
+from sld.utils import get_all_latents, run_sam_batch, run_sam_postprocess
+from sld.diffedit import diffedit_all_latents
 from sld.llm_template import spot_object_template, spot_difference_template, image_edit_template
 from sld.llm_chat import get_key_objects, get_updated_layout
 from eval.eval import eval_prompt, Evaluator
@@ -64,15 +65,15 @@ def get_remove_region(entry, remove_objects, move_objects, preserve_objs, models
 
     # Otherwise, run the SAM segmentation to locate target regions
     remove_items = remove_objects + [x[0] for x in move_objects]
+    # The removed and preserved boxes are decoded together against a single image embedding
+    all_masks = run_sam_batch([obj[1] for obj in remove_items + preserve_objs], image_source, models)
     remove_mask = np.zeros((H, W, 3), dtype=bool)
-    for obj in remove_items:
-        masks = run_sam(bbox=obj[1], image_source=image_source, models=models)
+    for masks in all_masks[: len(remove_items)]:
         remove_mask = remove_mask | masks
 
     # Preserve the regions that should not be removed
     preserve_mask = np.zeros((H, W, 3), dtype=bool)
-    for obj in preserve_objs:
-        masks = run_sam(bbox=obj[1], image_source=image_source, models=models)
+    for masks in all_masks[len(remove_items) :]:
         preserve_mask = preserve_mask | masks
     # Process the SAM mask by averaging, thresholding, and dilating.
     preserve_region = run_sam_postprocess(preserve_mask, H, W, config)
@@ -84,9 +85,11 @@ def get_remove_region(entry, remove_objects, move_objects, preserve_objs, models
 # Operation #3: Repositioning (Preprocessing latent)
 def get_repos_info(entry, move_objects, models, config):
     """
-    Updates a list of objects to be moved / reshaped, including resizing images and generating masks.
-    * Important: Perform image reshaping at the image-level rather than the latent-level.
-    * Warning: For simplicity, the object is not positioned to the center of the new region...
+    Updates a list of objects to be moved / reshaped with their source masks and latent trajectories.
+    * The objects are segmented in the source image and warped in latent space from the source image's
+      inversion (see `utils.latents.warp_latents_affine`), so moving objects needs no extra inversion.
+    * `entry["transformation_matrices"]` optionally maps an object name to its affine transformation (normalized
+      image coordinates, about the object center); other moves scale and translate the old box onto the new one.
     """
 
     # if no remove objects, set zero to the whole mask
@@ -95,15 +98,17 @@ def get_repos_info(entry, move_objects, models, config):
     image_source = np.array(Image.open(entry["output"][-1]))
     H, W, _ = image_source.shape
     inv_seed = int(config.get("SLD", "inv_seed"))
+    matrices = entry.get("transformation_matrices") or {}
+
+    # Same inversion as the background latents in `correction`
+    all_latents, _ = get_all_latents(image_source, models, inv_seed)
+    all_masks = run_sam_batch([item[0][1] for item in move_objects], image_source, models)
 
     new_move_objects = []
-    for item in move_objects:
-        new_img, obj = resize_image(image_source, item[0][1], item[1][1])
-        old_object_region = run_sam_postprocess(run_sam(obj, new_img, models), H, W, config).astype(np.bool_)
-        all_latents, _ = get_all_latents(new_img, models, inv_seed)
-        new_move_objects.append(
-            [item[0][0], obj, item[1][1], old_object_region, all_latents]
-        )
+    for item, masks in zip(move_objects, all_masks):
+        old_object_region = run_sam_postprocess(masks, H, W, config).astype(np.bool_)
+        matrix = matrices.get(item[1][0])
+        new_move_objects.append([item[0][0], item[0][1], item[1][1], old_object_region, all_latents, matrix])
 
     return new_move_objects
 
@@ -124,57 +129,34 @@ def get_attrmod_latent(entry, change_attr_objects, models, config):
     """
     if len(change_attr_objects) == 0:
         return []
-    from diffusers import StableDiffusionDiffEditPipeline
-    from diffusers import DDIMScheduler, DDIMInverseScheduler
 
     img = Image.open(entry["output"][-1])
     image_source = np.array(img)
     H, W, _ = image_source.shape
     inv_seed = int(config.get("SLD", "inv_seed"))
 
-    # Initialize the Stable Diffusion pipeline
-    pipe = StableDiffusionDiffEditPipeline.from_pretrained(
-        "stabilityai/stable-diffusion-2-1-base", torch_dtype=torch.float16
-    ).to("cuda")
-
-    pipe.scheduler = DDIMScheduler.from_config(pipe.scheduler.config)
-    pipe.inverse_scheduler = DDIMInverseScheduler.from_config(pipe.scheduler.config)
-    pipe.enable_model_cpu_offload()
-    new_change_objects = []
-    for obj in change_attr_objects:
-        # Run diffedit
-        old_object_region = run_sam_postprocess(run_sam(obj[1], image_source, models), H, W, config)
-        old_object_region = old_object_region.astype(np.bool_)[np.newaxis, ...]
+    old_object_regions, mask_prompts, new_prompts = [], [], []
+    all_masks = run_sam_batch([obj[1] for obj in change_attr_objects], image_source, models)
+    for obj, masks in zip(change_attr_objects, all_masks):
+        old_object_region = run_sam_postprocess(masks, H, W, config)
+        old_object_regions.append(old_object_region.astype(np.bool_))
 
         new_object = obj[0].split(" #")[0]
         base_object = new_object.split(" ")[-1]
-        mask_prompt = f"a {base_object}"
-        new_prompt = f"a {new_object}"
-
-        image_latents = pipe.invert(
-            image=img,
-            prompt=mask_prompt,
-            inpaint_strength=float(config.get("SLD", "diffedit_inpaint_strength")),
-            generator=torch.Generator(device="cuda").manual_seed(inv_seed),
-        ).latents
-        image = pipe(
-            prompt=new_prompt,
-            mask_image=old_object_region,
-            image_latents=image_latents,
-            guidance_scale=float(config.get("SLD", "diffedit_guidance_scale")),
-            inpaint_strength=float(config.get("SLD", "diffedit_inpaint_strength")),
-            generator=torch.Generator(device="cuda").manual_seed(inv_seed),
-            negative_prompt="",
-        ).images[0]
-
-        all_latents, _ = get_all_latents(np.array(image), models, inv_seed)
-        new_change_objects.append(
-            [
-                old_object_region[0],
-                all_latents,
-            ]
-        )
-    return new_change_objects
+        mask_prompts.append(f"a {base_object}")
+        new_prompts.append(f"a {new_object}")
+
+    # Run diffedit for all objects at once; the latents come straight from the DiffEdit pass
+    all_latents_list = diffedit_all_latents(
+        img,
+        old_object_regions,
+        mask_prompts,
+        new_prompts,
+        inv_seed,
+        inpaint_strength=float(config.get("SLD", "diffedit_inpaint_strength")),
+        guidance_scale=float(config.get("SLD", "diffedit_guidance_scale")),
+    )
+    return [[old_object_region, all_latents] for old_object_region, all_latents in zip(old_object_regions, all_latents_list)]
 
 
 def correction(
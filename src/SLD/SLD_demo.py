@@ -1,13 +1,5 @@
-########################    modified by marco    #########################
 import os
 import sys
-
-# Set the working directory to the script's directory
-script_dir = os.path.dirname(os.path.abspath(__file__))
-os.chdir(script_dir)
-########################    modified by marco    #########################
-
-import os
 import json
 import copy
 import shutil
@@ -26,21 +18,53 @@ import diffusers
 import models
 from models import sam
 from utils import parse, utils
+from utils.text_cache import text_embedding_cache
 
 # SLD specific imports
-from sld.detector import OWLVITV2Detector
-from sld.sdxl_refine import sdxl_refine
-from sld.utils import get_all_latents, run_sam, run_sam_postprocess, resize_image
+from sld import image_generator
+from sld.detector import Detector, OWLVITV2Detector
+from sld.sdxl_refine import load_sdxl_refiner
+from sld import utils as sld_utils
+from sld.latent_cache import InversionCache
+from sld.utils import get_all_latents, run_sam_batch, run_sam_postprocess
+from sld.diffedit import diffedit_all_latents
 from sld.llm_template import spot_object_template, spot_difference_template, image_edit_template
 from sld.llm_chat import get_key_objects, get_updated_layout
 
 
 os.environ["TOKENIZERS_PARALLELISM"] = "false"
 
+# Paths are resolved against this directory instead of changing the working directory,
+# so that the module can be imported by the driver in `src/main.py`
+SLD_DIR = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_CONFIG_PATH = os.path.join(SLD_DIR, "demo_config.ini")
+
 
 # Operation #1: Addition (The code is in sld/image_generator.py)
 
 
+def load_det_masks(det_masks, mask_dir, H, W):
+    """Loads precomputed detection masks (object name -> mask file, relative to `mask_dir`) as (H, W, 3) boolean masks."""
+    masks = {}
+    for name, mask_fname in (det_masks or {}).items():
+        mask = Image.open(os.path.join(mask_dir, mask_fname)).convert("L")
+        if mask.size != (W, H):
+            mask = mask.resize((W, H), Image.NEAREST)
+        masks[name] = np.repeat(np.array(mask)[..., None] > 127, 3, axis=2)
+    return masks
+
+
+def get_object_masks(entry, objects, image_source, models):
+    """
+    Segments (name, box) objects of the source image. Objects with a precomputed detection mask
+    (`entry["det_masks"]`) reuse it; only the others are decoded with SAM, in one batch.
+    """
+    precomputed = entry.get("det_masks") or {}
+    missing = [obj for obj in objects if obj[0] not in precomputed]
+    sam_masks = iter(run_sam_batch([obj[1] for obj in missing], image_source, models) if missing else [])
+    return [precomputed[obj[0]] if obj[0] in precomputed else next(sam_masks) for obj in objects]
+
+
 # Operation #2: Deletion (Preprocessing region mask for removal)
 def get_remove_region(entry, remove_objects, move_objects, preserve_objs, models, config):
     """Generate a region mask for removal given bounding box info."""
@@ -55,15 +79,15 @@ def get_remove_region(entry, remove_objects, move_objects, preserve_objs, models
 
     # Otherwise, run the SAM segmentation to locate target regions
     remove_items = remove_objects + [x[0] for x in move_objects]
+    # The removed and preserved boxes are decoded together against a single image embedding
+    all_masks = get_object_masks(entry, remove_items + preserve_objs, image_source, models)
     remove_mask = np.zeros((H, W, 3), dtype=bool)
-    for obj in remove_items:
-        masks = run_sam(bbox=obj[1], image_source=image_source, models=models)
+    for masks in all_masks[: len(remove_items)]:
         remove_mask = remove_mask | masks
 
     # Preserve the regions that should not be removed
     preserve_mask = np.zeros((H, W, 3), dtype=bool)
-    for obj in preserve_objs:
-        masks = run_sam(bbox=obj[1], image_source=image_source, models=models)
+    for masks in all_masks[len(remove_items) :]:
         preserve_mask = preserve_mask | masks
     # Process the SAM mask by averaging, thresholding, and dilating.
     preserve_region = run_sam_postprocess(preserve_mask, H, W, config)
@@ -75,9 +99,11 @@ def get_remove_region(entry, remove_objects, move_objects, preserve_objs, models
 # Operation #3: Repositioning (Preprocessing latent)
 def get_repos_info(entry, move_objects, models, config):
     """
-    Updates a list of objects to be moved / reshaped, including resizing images and generating masks.
-    * Important: Perform image reshaping at the image-level rather than the latent-level.
-    * Warning: For simplicity, the object is not positioned to the center of the new region...
+    Updates a list of objects to be moved / reshaped with their source masks and latent trajectories.
+    * The objects are segmented in the source image and warped in latent space from the source image's
+      inversion (see `utils.latents.warp_latents_affine`), so moving objects needs no extra inversion.
+    * `entry["transformation_matrices"]` optionally maps an object name to its affine transformation (normalized
+      image coordinates, about the object center); other moves scale and translate the old box onto the new one.
     """
 
     # if no remove objects, set zero to the whole mask
@@ -86,13 +112,17 @@ def get_repos_info(entry, move_objects, models, config):
     image_source = np.array(Image.open(entry["output"][-1]))
     H, W, _ = image_source.shape
     inv_seed = int(config.get("SLD", "inv_seed"))
+    matrices = entry.get("transformation_matrices") or {}
+
+    # Same inversion as the background latents in `correction`
+    all_latents, _ = get_all_latents(image_source, models, inv_seed)
+    all_masks = get_object_masks(entry, [item[0] for item in move_objects], image_source, models)
 
     new_move_objects = []
-    for item in move_objects:
-        new_img, obj = resize_image(image_source, item[0][1], item[1][1])
-        old_object_region = run_sam_postprocess(run_sam(obj, new_img, models), H, W, config).astype(np.bool_)
-        all_latents, _ = get_all_latents(new_img, models, inv_seed)
-        new_move_objects.append([item[0][0], obj, item[1][1], old_object_region, all_latents])
+    for item, masks in zip(move_objects, all_masks):
+        old_object_region = run_sam_postprocess(masks, H, W, config).astype(np.bool_)
+        matrix = matrices.get(item[1][0])
+        new_move_objects.append([item[0][0], item[0][1], item[1][1], old_object_region, all_latents, matrix])
 
     return new_move_objects
 
@@ -113,55 +143,34 @@ def get_attrmod_latent(entry, change_attr_objects, models, config):
     """
     if len(change_attr_objects) == 0:
         return []
-    from diffusers import StableDiffusionDiffEditPipeline
-    from diffusers import DDIMScheduler, DDIMInverseScheduler
 
     img = Image.open(entry["output"][-1])
     image_source = np.array(img)
     H, W, _ = image_source.shape
     inv_seed = int(config.get("SLD", "inv_seed"))
 
-    # Initialize the Stable Diffusion pipeline
-    pipe = StableDiffusionDiffEditPipeline.from_pretrained("stabilityai/stable-diffusion-2-1-base", torch_dtype=torch.float16).to("cuda")
-
-    pipe.scheduler = DDIMScheduler.from_config(pipe.scheduler.config)
-    pipe.inverse_scheduler = DDIMInverseScheduler.from_config(pipe.scheduler.config)
-    pipe.enable_model_cpu_offload()
-    new_change_objects = []
-    for obj in change_attr_objects:
-        # Run diffedit
-        old_object_region = run_sam_postprocess(run_sam(obj[1], image_source, models), H, W, config)
-        old_object_region = old_object_region.astype(np.bool_)[np.newaxis, ...]
+    old_object_regions, mask_prompts, new_prompts = [], [], []
+    all_masks = run_sam_batch([obj[1] for obj in change_attr_objects], image_source, models)
+    for obj, masks in zip(change_attr_objects, all_masks):
+        old_object_region = run_sam_postprocess(masks, H, W, config)
+        old_object_regions.append(old_object_region.astype(np.bool_))
 
         new_object = obj[0].split(" #")[0]
         base_object = new_object.split(" ")[-1]
-        mask_prompt = f"a {base_object}"
-        new_prompt = f"a {new_object}"
-
-        image_latents = pipe.invert(
-            image=img,
-            prompt=mask_prompt,
-            inpaint_strength=float(config.get("SLD", "diffedit_inpaint_strength")),
-            generator=torch.Generator(device="cuda").manual_seed(inv_seed),
-        ).latents
-        image = pipe(
-            prompt=new_prompt,
-            mask_image=old_object_region,
-            image_latents=image_latents,
-            guidance_scale=float(config.get("SLD", "diffedit_guidance_scale")),
-            inpaint_strength=float(config.get("SLD", "diffedit_inpaint_strength")),
-            generator=torch.Generator(device="cuda").manual_seed(inv_seed),
-            negative_prompt="",
-        ).images[0]
-
-        all_latents, _ = get_all_latents(np.array(image), models, inv_seed)
-        new_change_objects.append(
-            [
-                old_object_region[0],
-                all_latents,
-            ]
-        )
-    return new_change_objects
+        mask_prompts.append(f"a {base_object}")
+        new_prompts.append(f"a {new_object}")
+
+    # Run diffedit for all objects at once; the latents come straight from the DiffEdit pass
+    all_latents_list = diffedit_all_latents(
+        img,
+        old_object_regions,
+        mask_prompts,
+        new_prompts,
+        inv_seed,
+        inpaint_strength=float(config.get("SLD", "diffedit_inpaint_strength")),
+        guidance_scale=float(config.get("SLD", "diffedit_guidance_scale")),
+    )
+    return [[old_object_region, all_latents] for old_object_region, all_latents in zip(old_object_regions, all_latents_list)]
 
 
 def correction(entry, add_objects, move_objects, remove_region, change_attr_objects, models, config):
@@ -184,6 +193,7 @@ def correction(entry, add_objects, move_objects, remove_region, change_attr_obje
         bg_seed=int(config.get("SLD", "bg_seed")),
         bg_all_latents=all_latents,
         frozen_step_ratio=float(config.get("SLD", "frozen_step_ratio")),
+        model_dict=models.model_dict,
     )
     return ret_dict
 
@@ -212,78 +222,120 @@ def spot_differences(prompt, det_results, data, config, mode="self_correction"):
         return data["llm_layout_suggestions"]
 
 
-if __name__ == "__main__":
-    # create argument parser
-    parser = argparse.ArgumentParser(description="Demo for the SLD pipeline")
-    parser.add_argument("--json-file", type=str, default="demo/self_correction/data.json", help="Path to the json file")
-    parser.add_argument("--input-dir", type=str, default="demo/self_correction/src_image", help="Path to the input directory")
-    parser.add_argument("--output-dir", type=str, default="demo/self_correction/results", help="Path to the output directory")
-    parser.add_argument("--mode", type=str, default="self_correction", help="Mode of the demo", choices=["self_correction", "image_editing"])
-    parser.add_argument("--config", type=str, default="demo_config.ini", help="Path to the config file")
-    parser.add_argument("--evaluation-path-before", type=str, default="demo/self_correction/evaluation", help="Path to the evaluation folder")
-    parser.add_argument("--evaluation-path-refined", type=str, default="demo/self_correction/evaluation_refined", help="Path to the evaluation folder")
-    parser.add_argument("--save-file-name", type=str, default=None, help="Path to the save file name")
-    args = parser.parse_args()
-    if args.save_file_name is None:
-        args.save_file_name = time.time()
+class SLDEngine:
+    """Keeps the SLD models (GLIGEN, SAM, OWLv2 and the SDXL refiner) resident across samples."""
 
-    print("-------------- DEBUG -------------- Mode: ", args.mode)
+    def __init__(self, config_path=DEFAULT_CONFIG_PATH, device="cuda"):
+        # All SLD modules run on "cuda", so make the requested GPU the current one
+        self.device = device
+        self._set_device()
 
-    # Check if input path is absolute
-    if not os.path.isabs(args.evaluation_path_before) and not os.path.isabs(args.evaluation_path_refined):
-        print("Error: Evaluation path before and refined must be an absolute path")
-        sys.exit(1)
+        # Read config
+        self.config = configparser.ConfigParser()
+        self.config.read(config_path)
 
-    # Create evaluation folders if they don't exist
-    os.makedirs(args.evaluation_path_before, exist_ok=True)
-    os.makedirs(args.evaluation_path_refined, exist_ok=True)
+        # Load models
+        models.sd_key = "gligen/diffusers-generation-text-box"
+        models.sd_version = "sdv1.4"
+        diffusion_scheduler = None
 
-    # Open the json file configured for self-correction (a list of filenames with prompts and other info...)
-    # Create the output directory
-    with open(args.json_file) as f:
-        data = json.load(f)
-    save_dir = args.output_dir
-    parse.img_dir = os.path.join(save_dir, "tmp_imgs")
-    os.makedirs(save_dir, exist_ok=True)
-    os.makedirs(parse.img_dir, exist_ok=True)
-
-    # Read config
-    config = configparser.ConfigParser()
-    config.read(args.config)
-
-    # Load models
-    models.sd_key = "gligen/diffusers-generation-text-box"
-    models.sd_version = "sdv1.4"
-    diffusion_scheduler = None
-
-    models.model_dict = models.load_sd(
-        key=models.sd_key,
-        use_fp16=False,
-        load_inverse_scheduler=True,
-        scheduler_cls=diffusers.schedulers.__dict__[diffusion_scheduler] if diffusion_scheduler is not None else None,
-    )
-    sam_model_dict = sam.load_sam()
-    models.model_dict.update(sam_model_dict)
-    from sld import image_generator
+        self.model_dict = models.load_sd(
+            key=models.sd_key,
+            use_fp16=False,
+            load_inverse_scheduler=True,
+            scheduler_cls=diffusers.schedulers.__dict__[diffusion_scheduler] if diffusion_scheduler is not None else None,
+        )
+        sam_model_dict = sam.load_sam()
+        self.model_dict.update(sam_model_dict)
+        # `sld.utils` helpers read the models from the `models` module
+        models.model_dict = self.model_dict
+
+        # Repeated inversions of the same image (source, moved objects, benchmark variants) become a lookup
+        inversion_cache_dir = self.config.get("SLD", "inversion_cache_dir", fallback="")
+        if inversion_cache_dir and not os.path.isabs(inversion_cache_dir):
+            inversion_cache_dir = os.path.join(SLD_DIR, inversion_cache_dir)
+        sld_utils.inversion_cache = InversionCache(
+            cache_dir=inversion_cache_dir or None,
+            max_memory_items=int(self.config.get("SLD", "inversion_cache_memory_items", fallback=8)),
+            max_disk_gb=float(self.config.get("SLD", "inversion_cache_disk_gb", fallback=20.0)),
+            # Empty: keep the model's dtype; "fp16" trades precision for half the memory and disk use
+            storage_dtype=torch.float16 if self.config.get("SLD", "inversion_cache_dtype", fallback="") == "fp16" else None,
+        )
 
-    det = OWLVITV2Detector()
-    # Iterate through the json file
-    for idx in range(len(data)):
+        # OWLv2 is only loaded for entries without precomputed detections
+        self._detector = None
+        self.refiner = load_sdxl_refiner(
+            dtype=self.config.get("SLD", "sdxl_refiner_dtype", fallback="fp32"),
+            batch_size=int(self.config.get("SLD", "sdxl_refiner_batch_size", fallback=4)),
+        )
 
-        # Reset random seeds
+    @property
+    def detector(self):
+        if self._detector is None:
+            self._detector = OWLVITV2Detector()
+        return self._detector
+
+    def modules(self):
+        """The torch modules currently loaded by the engine (for `utils_pose.model_registry.ModelRegistry`)."""
+        modules = [self.model_dict.vae, self.model_dict.text_encoder, self.model_dict.unet, self.model_dict.sam_model]
+        modules += [component for component in self.refiner.pipe.components.values() if isinstance(component, torch.nn.Module)]
+        # Lazily loaded parts go last, so that the resident modules keep their positions
+        if self._detector is not None:
+            modules.append(self._detector.model)
+        return modules
+
+    def _set_device(self):
+        # The current CUDA device is per thread, so this is repeated when called from a pipeline worker
+        if self.device.startswith("cuda"):
+            torch.cuda.set_device(self.device)
+
+    def run_json(self, json_file, input_dir, output_dir, mode, evaluation_path_before, evaluation_path_refined, save_file_name):
+        """Run every entry of an SLD config json (e.g. `config_sld.json`)."""
+        self._set_device()
+        with open(json_file) as f:
+            data = json.load(f)
+        # The intermediates of all entries are refined together, in batches of the refiner. The driver
+        # (`src/main.py`) writes one entry per `config_sld.json`, so there it refines one image per call.
+        jobs = []
+        for data_entry in data:
+            job = self.run(data_entry, input_dir, output_dir, mode, evaluation_path_before, evaluation_path_refined, save_file_name, refine=False)
+            if job is not None:
+                jobs.append(job)
+        self.refiner.refine_files(jobs)
+        for job in jobs:
+            print("* Output File (After SDXL): ", job[2])
+        print(f"* Text embedding cache: {text_embedding_cache.stats()}")
+
+    def run(self, data_entry, input_dir, output_dir, mode, evaluation_path_before, evaluation_path_refined, save_file_name, refine=True):
+        """
+        Self-correct or edit a single image described by one SLD config entry.
+        With refine=False the SDXL refinement is skipped and its job is returned for `SDXLRefiner.refine_files`.
+        """
+        config = self.config
+
+        # Create evaluation folders if they don't exist
+        os.makedirs(evaluation_path_before, exist_ok=True)
+        os.makedirs(evaluation_path_refined, exist_ok=True)
+
+        # Create the output directory
+        save_dir = output_dir
+        parse.img_dir = os.path.join(save_dir, "tmp_imgs")
+        os.makedirs(save_dir, exist_ok=True)
+        os.makedirs(parse.img_dir, exist_ok=True)
 
+        # Reset random seeds
         default_seed = int(config.get("SLD", "default_seed"))
         torch.manual_seed(default_seed)
         np.random.seed(default_seed)
         random.seed(default_seed)
 
         # Load the image and prompt
-        rel_fname = data[idx]["input_fname"]
-        # fname = os.path.join(args.input_dir, f"{rel_fname}.png")  ### marco
-        fname = args.input_dir
+        rel_fname = data_entry["input_fname"]
+        # fname = os.path.join(input_dir, f"{rel_fname}.png")  ### marco
+        fname = input_dir
 
-        prompt = data[idx]["prompt"]
-        # dirname = os.path.join(save_dir, data[idx]["output_dir"]) ### marco
+        prompt = data_entry["prompt"]
+        # dirname = os.path.join(save_dir, data_entry["output_dir"]) ### marco
         dirname = save_dir
         os.makedirs(dirname, exist_ok=True)
 
@@ -294,42 +346,50 @@ if __name__ == "__main__":
         print(f"Target Textual Prompt: {prompt}")
 
         # Step 1: Spot Objects with LLM
-        llm_parsed_prompt = spot_objects(prompt, data[idx], config)
+        llm_parsed_prompt = spot_objects(prompt, data_entry, config)
         entry = {
             "instructions": prompt,
             "output": [fname],
-            "generator": data[idx]["generator"],
+            "generator": data_entry["generator"],
             "objects": llm_parsed_prompt["objects"],
             "bg_prompt": llm_parsed_prompt["bg_prompt"],
             "neg_prompt": llm_parsed_prompt["neg_prompt"],
+            "transformation_matrices": data_entry.get("transformation_matrices"),
         }
         print("-" * 5 + f" Parsing Prompts " + "-" * 5)
         print(f"* Objects: {entry['objects']}")
         print(f"* Background: {entry['bg_prompt']}")
         print(f"* Negation: {entry['neg_prompt']}")
 
-        # Step 2: Run open vocabulary detector
-        print("-" * 5 + f" Running Detector " + "-" * 5)
-        default_attr_threshold = float(config.get("SLD", "attr_detection_threshold"))
-        default_prim_threshold = float(config.get("SLD", "prim_detection_threshold"))
-        default_nms_threshold = float(config.get("SLD", "nms_threshold"))
-
-        attr_threshold = float(config.get(entry["generator"], "attr_detection_threshold", fallback=default_attr_threshold))
-        prim_threshold = float(config.get(entry["generator"], "prim_detection_threshold", fallback=default_prim_threshold))
-        nms_threshold = float(config.get(entry["generator"], "nms_threshold", fallback=default_nms_threshold))
-        det_results = det.run(
-            prompt,
-            entry["objects"],
-            entry["output"][-1],
-            attr_detection_threshold=attr_threshold,
-            prim_detection_threshold=prim_threshold,
-            nms_threshold=nms_threshold,
-        )
+        # Step 2: Run open vocabulary detector, unless the entry already has the detections (e.g. from `src/main.py`)
+        if data_entry.get("det_results") is not None:
+            print("-" * 5 + f" Using Precomputed Detections " + "-" * 5)
+            det_results = [tuple(obj) for obj in data_entry["det_results"]]
+            W, H = Image.open(fname).size
+            # Mask files are relative to the output directory, where the config was written
+            entry["det_masks"] = load_det_masks(data_entry.get("det_masks"), output_dir, H, W)
+        else:
+            print("-" * 5 + f" Running Detector " + "-" * 5)
+            default_attr_threshold = float(config.get("SLD", "attr_detection_threshold"))
+            default_prim_threshold = float(config.get("SLD", "prim_detection_threshold"))
+            default_nms_threshold = float(config.get("SLD", "nms_threshold"))
+
+            attr_threshold = float(config.get(entry["generator"], "attr_detection_threshold", fallback=default_attr_threshold))
+            prim_threshold = float(config.get(entry["generator"], "prim_detection_threshold", fallback=default_prim_threshold))
+            nms_threshold = float(config.get(entry["generator"], "nms_threshold", fallback=default_nms_threshold))
+            det_results = self.detector.run(
+                prompt,
+                entry["objects"],
+                entry["output"][-1],
+                attr_detection_threshold=attr_threshold,
+                prim_detection_threshold=prim_threshold,
+                nms_threshold=nms_threshold,
+            )
 
         print("-" * 5 + f" Getting Modification Suggestions " + "-" * 5)
 
         # Step 3: Spot difference between detected results and initial prompts
-        llm_suggestions = spot_differences(prompt, det_results, data[idx], config, mode=args.mode)
+        llm_suggestions = spot_differences(prompt, det_results, data_entry, config, mode=mode)
 
         print(f"* Detection Restuls: {det_results}")
         print(f"* LLM Suggestions: {llm_suggestions}")
@@ -342,7 +402,7 @@ if __name__ == "__main__":
             addition_objs,
             repositioning_objs,
             attr_modification_objs,
-        ) = det.parse_list(det_results, llm_suggestions)
+        ) = Detector().parse_list(det_results, llm_suggestions)
 
         print("-" * 5 + f" Editing Operations " + "-" * 5)
         print(f"* Preservation: {preserve_objs}")
@@ -365,8 +425,7 @@ if __name__ == "__main__":
             shutil.copy(entry["output"][-1], output_fname)
             print("* No changes to apply!")
             print(f"* Output File: {output_fname}")
-            # Shortcut to proceed to the next round!
-            continue
+            return
 
         # Step 4: T2I Ops: Addition / Deletion / Repositioning / Attr. Modification
         print("-" * 5 + f" Image Manipulation " + "-" * 5)
@@ -381,7 +440,7 @@ if __name__ == "__main__":
         Image.fromarray(ret_dict.image).save(curr_output_fname)
 
         # ********** MARCO **********
-        Image.fromarray(ret_dict.image).save(os.path.join(args.evaluation_path_before, f"{args.save_file_name}.png"))
+        Image.fromarray(ret_dict.image).save(os.path.join(evaluation_path_before, f"{save_file_name}.png"))
         # ********** MARCO **********
         print("-" * 5 + f" Results " + "-" * 5)
         print("* Output File (Before SDXL): ", curr_output_fname)
@@ -389,10 +448,48 @@ if __name__ == "__main__":
 
         # Can run this if applying SDXL as the refine process
         sdxl_output_fname = os.path.join(dirname, f"final_{rel_fname}.png")
-        if args.mode == "self_correction":
+        if mode == "self_correction":
             # For image editing, the prompt should be updated
-            sdxl_refine(prompt, curr_output_fname, sdxl_output_fname, args.evaluation_path_refined, args.save_file_name)
+            job = (prompt, curr_output_fname, sdxl_output_fname, evaluation_path_refined, save_file_name)
         else:
             # For image editing, the prompt should be updated
-            sdxl_refine(ret_dict.final_prompt, curr_output_fname, sdxl_output_fname, args.evaluation_path_refined, args.save_file_name)
-        print("* Output File (After SDXL): ", sdxl_output_fname)
+            job = (ret_dict.final_prompt, curr_output_fname, sdxl_output_fname, evaluation_path_refined, save_file_name)
+        if refine:
+            self.refiner.refine_files([job])
+            print("* Output File (After SDXL): ", sdxl_output_fname)
+        return job
+
+
+if __name__ == "__main__":
+    # create argument parser
+    parser = argparse.ArgumentParser(description="Demo for the SLD pipeline")
+    parser.add_argument("--json-file", type=str, default=os.path.join(SLD_DIR, "demo/self_correction/data.json"), help="Path to the json file")
+    parser.add_argument("--input-dir", type=str, default=os.path.join(SLD_DIR, "demo/self_correction/src_image"), help="Path to the input directory")
+    parser.add_argument("--output-dir", type=str, default=os.path.join(SLD_DIR, "demo/self_correction/results"), help="Path to the output directory")
+    parser.add_argument("--mode", type=str, default="self_correction", help="Mode of the demo", choices=["self_correction", "image_editing"])
+    parser.add_argument("--config", type=str, default=DEFAULT_CONFIG_PATH, help="Path to the config file")
+    parser.add_argument("--evaluation-path-before", type=str, default=os.path.join(SLD_DIR, "demo/self_correction/evaluation"), help="Path to the evaluation folder")
+    parser.add_argument("--evaluation-path-refined", type=str, default=os.path.join(SLD_DIR, "demo/self_correction/evaluation_refined"), help="Path to the evaluation folder")
+    parser.add_argument("--save-file-name", type=str, default=None, help="Path to the save file name")
+    args = parser.parse_args()
+    if args.save_file_name is None:
+        args.save_file_name = time.time()
+
+    print("-------------- DEBUG -------------- Mode: ", args.mode)
+
+    # Check if input path is absolute
+    if not os.path.isabs(args.evaluation_path_before) and not os.path.isabs(args.evaluation_path_refined):
+        print("Error: Evaluation path before and refined must be an absolute path")
+        sys.exit(1)
+
+    # Open the json file configured for self-correction (a list of filenames with prompts and other info...)
+    engine = SLDEngine(config_path=args.config)
+    engine.run_json(
+        args.json_file,
+        args.input_dir,
+        args.output_dir,
+        args.mode,
+        args.evaluation_path_before,
+        args.evaluation_path_refined,
+        args.save_file_name,
+    )
@@ -0,0 +1,230 @@
+"""
+Micro-benchmark and equivalence check of the vectorized NMS in `utils.nms` against the loop implementations
+it replaced (`sld.utils.nms` and `class_aware_nms`, copied below). On random detections, the NumPy and torch
+versions must keep the same boxes in the same order as the references.
+
+Usage (from src/SLD): python benchmark_nms.py --num-boxes 200 --num-labels 5 --trials 100 --repeats 20
+"""
+import argparse
+import time
+
+import numpy as np
+import torch
+
+from utils.nms import nms, class_aware_nms, nms_torch, class_aware_nms_torch
+
+
+# The previous implementations, kept as references
+
+def nms_reference(
+    bounding_boxes,
+    confidence_score,
+    labels,
+    threshold,
+    input_in_pixels=False,
+    return_array=True,
+):
+    """
+    This NMS processes boxes of all labels. It not only removes the box with the same label.
+
+    Adapted from https://github.com/amusi/Non-Maximum-Suppression/blob/master/nms.py
+    """
+    # If no bounding boxes, return empty list
+    if len(bounding_boxes) == 0:
+        return np.array([]), np.array([]), np.array([])
+
+    # Bounding boxes
+    boxes = np.array(bounding_boxes)
+
+    # coordinates of bounding boxes
+    start_x = boxes[:, 0]
+    start_y = boxes[:, 1]
+    end_x = boxes[:, 2]
+    end_y = boxes[:, 3]
+
+    # Confidence scores of bounding boxes
+    score = np.array(confidence_score)
+
+    # Picked bounding boxes
+    picked_boxes = []
+    picked_score = []
+    picked_labels = []
+
+    # Compute areas of bounding boxes
+    if input_in_pixels:
+        areas = (end_x - start_x + 1) * (end_y - start_y + 1)
+    else:
+        areas = (end_x - start_x) * (end_y - start_y)
+
+    # Sort by confidence score of bounding boxes
+    order = np.argsort(score)
+
+    # Iterate bounding boxes
+    while order.size > 0:
+        # The index of largest confidence score
+        index = order[-1]
+
+        # Pick the bounding box with largest confidence score
+        picked_boxes.append(bounding_boxes[index])
+        picked_score.append(confidence_score[index])
+        picked_labels.append(labels[index])
+
+        # Compute ordinates of intersection-over-union(IOU)
+        x1 = np.maximum(start_x[index], start_x[order[:-1]])
+        x2 = np.minimum(end_x[index], end_x[order[:-1]])
+        y1 = np.maximum(start_y[index], start_y[order[:-1]])
+        y2 = np.minimum(end_y[index], end_y[order[:-1]])
+
+        # Compute areas of intersection-over-union
+        if input_in_pixels:
+            w = np.maximum(0.0, x2 - x1 + 1)
+            h = np.maximum(0.0, y2 - y1 + 1)
+        else:
+            w = np.maximum(0.0, x2 - x1)
+            h = np.maximum(0.0, y2 - y1)
+        intersection = w * h
+
+        # Compute the ratio between intersection and union
+        ratio = intersection / (areas[index] + areas[order[:-1]] - intersection)
+
+        left = np.where(ratio < threshold)
+        order = order[left]
+
+    if return_array:
+        picked_boxes, picked_score, picked_labels = (
+            np.array(picked_boxes),
+            np.array(picked_score),
+            np.array(picked_labels),
+        )
+
+    return picked_boxes, picked_score, picked_labels
+
+
+def class_aware_nms_reference(
+    bounding_boxes, confidence_score, labels, threshold, input_in_pixels=False
+):
+    """
+    This NMS processes boxes of each label individually.
+    """
+    # If no bounding boxes, return empty list
+    if len(bounding_boxes) == 0:
+        return np.array([]), np.array([]), np.array([])
+
+    picked_boxes, picked_score, picked_labels = [], [], []
+
+    labels_unique = np.unique(labels)
+    for label in labels_unique:
+        bounding_boxes_label = [
+            bounding_box
+            for i, bounding_box in enumerate(bounding_boxes)
+            if labels[i] == label
+        ]
+        confidence_score_label = [
+            confidence_score_item
+            for i, confidence_score_item in enumerate(confidence_score)
+            if labels[i] == label
+        ]
+        labels_label = [label] * len(bounding_boxes_label)
+        picked_boxes_label, picked_score_label, picked_labels_label = nms_reference(
+            bounding_boxes_label,
+            confidence_score_label,
+            labels_label,
+            threshold=threshold,
+            input_in_pixels=input_in_pixels,
+            return_array=False,
+        )
+        picked_boxes += picked_boxes_label
+        picked_score += picked_score_label
+        picked_labels += picked_labels_label
+
+    picked_boxes, picked_score, picked_labels = (
+        np.array(picked_boxes),
+        np.array(picked_score),
+        np.array(picked_labels),
+    )
+
+    return picked_boxes, picked_score, picked_labels
+
+
+def random_detections(num_boxes, num_labels, rng, input_in_pixels):
+    scale = 512.0 if input_in_pixels else 1.0
+    # Clustered boxes, so that a good share of them overlaps
+    centers = rng.uniform(0.2, 0.8, size=(max(1, num_boxes // 8), 2))[rng.integers(0, max(1, num_boxes // 8), num_boxes)]
+    centers = centers + rng.normal(0, 0.03, size=(num_boxes, 2))
+    sizes = rng.uniform(0.05, 0.3, size=(num_boxes, 2))
+    boxes = np.concatenate([centers - sizes / 2, centers + sizes / 2], axis=1).clip(0, 1) * scale
+    scores = rng.uniform(0, 1, size=num_boxes)
+    labels = rng.integers(0, num_labels, size=num_boxes)
+    return boxes, scores, labels
+
+
+def check_equal(reference, vectorized, name):
+    for ref, out, field in zip(reference, vectorized, ("boxes", "scores", "labels")):
+        out = out.cpu().numpy() if torch.is_tensor(out) else out
+        assert np.array_equal(np.asarray(ref).reshape(np.shape(out)), out), f"{name}: {field} differ"
+
+
+def timeit(fn, repeats, device=None):
+    fn()
+    if device is not None and device.type == "cuda":
+        torch.cuda.synchronize()
+    start = time.perf_counter()
+    for _ in range(repeats):
+        fn()
+    if device is not None and device.type == "cuda":
+        torch.cuda.synchronize()
+    return (time.perf_counter() - start) / repeats * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--num-boxes", type=int, default=200)
+    parser.add_argument("--num-labels", type=int, default=5)
+    parser.add_argument("--threshold", type=float, default=0.5)
+    parser.add_argument("--trials", type=int, default=100)
+    parser.add_argument("--repeats", type=int, default=20)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    rng = np.random.default_rng(args.seed)
+
+    # Equivalence, over sizes from empty to `num_boxes` and both coordinate conventions
+    for trial in range(args.trials):
+        input_in_pixels = bool(trial % 2)
+        num_boxes = int(rng.integers(0, args.num_boxes + 1))
+        boxes, scores, labels = random_detections(num_boxes, args.num_labels, rng, input_in_pixels)
+        tensors = [torch.from_numpy(x).to(device) for x in (boxes, scores, labels)]
+
+        reference = nms_reference(boxes, scores, labels, args.threshold, input_in_pixels=input_in_pixels)
+        check_equal(reference, nms(boxes, scores, labels, args.threshold, input_in_pixels=input_in_pixels), "nms")
+        if num_boxes:
+            check_equal(reference, nms_torch(*tensors, args.threshold, input_in_pixels=input_in_pixels), "nms_torch")
+
+        reference = class_aware_nms_reference(boxes, scores, labels, args.threshold, input_in_pixels=input_in_pixels)
+        check_equal(reference, class_aware_nms(boxes, scores, labels, args.threshold, input_in_pixels=input_in_pixels), "class_aware_nms")
+        if num_boxes:
+            check_equal(
+                reference,
+                class_aware_nms_torch(*tensors, args.threshold, input_in_pixels=input_in_pixels),
+                "class_aware_nms_torch",
+            )
+    print(f"{args.trials} random trials: the vectorized NMS keeps the same boxes in the same order")
+
+    # Speed, at `num_boxes`
+    boxes, scores, labels = random_detections(args.num_boxes, args.num_labels, rng, False)
+    tensors = [torch.from_numpy(x).to(device) for x in (boxes, scores, labels)]
+    print(f"{args.num_boxes} boxes, {args.num_labels} labels:")
+    for name, fn, fn_device in (
+        ("nms (reference)", lambda: nms_reference(boxes, scores, labels, args.threshold), None),
+        ("nms (numpy)", lambda: nms(boxes, scores, labels, args.threshold), None),
+        (f"nms (torch, {device})", lambda: nms_torch(*tensors, args.threshold), device),
+        ("class_aware_nms (reference)", lambda: class_aware_nms_reference(boxes, scores, labels, args.threshold), None),
+        ("class_aware_nms (numpy)", lambda: class_aware_nms(boxes, scores, labels, args.threshold), None),
+        (f"class_aware_nms (torch, {device})", lambda: class_aware_nms_torch(*tensors, args.threshold), device),
+    ):
+        print(f"{name:<36} {timeit(fn, args.repeats, fn_device):8.2f} ms")
+
+
+if __name__ == "__main__":
+    main()
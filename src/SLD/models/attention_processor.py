@@ -386,21 +386,30 @@ class AttnProcessor:
         attn_process_fn=None,
         return_cond_ca_only=False,
         return_token_ca_only=None,
+        return_head_mean_ca=False,
+        saved_attn_dtype=None,
         offload_cross_attn_to_cpu=False,
         save_attn_to_dict=None,
         save_keys=None,
+        attn_accumulator=None,
         enable_flash_attn=True,
     ):
         """
         attn_key: current key (a tuple of hierarchy index (up/mid/down, stage id, block id, sub-block id), sub block id should always be 0 in SD UNet)
         save_attn_to_dict: pass in a dict to save to dict
+        return_token_ca_only: keep only these text token columns (an integer or a 1d index tensor) of the returned/saved attention
+        return_head_mean_ca: average the returned/saved attention over heads (the head dimension is kept with size 1)
+        saved_attn_dtype: cast the returned/saved attention to this dtype (e.g., torch.float16)
+        attn_accumulator: a `utils.attn.AttnAccumulator` that accumulates the attention in place (it applies its own token and batch selection)
         """
         cross_attn = encoder_hidden_states is not None
+        accumulate_attn = attn_accumulator is not None and attn_accumulator.wants(attn_key)
         
         if (not cross_attn) or (
             (attn_process_fn is None) 
             and not (save_attn_to_dict is not None and (save_keys is None or (tuple(attn_key) in save_keys))) 
-            and not return_attntion_probs):
+            and not return_attntion_probs
+            and not accumulate_attn):
             with torch.backends.cuda.sdp_kernel(enable_flash=enable_flash_attn, enable_math=True, enable_mem_efficient=enable_flash_attn):
                 return self.__call_fast__(attn, hidden_states, encoder_hidden_states, attention_mask, temb)
         
@@ -460,6 +469,9 @@ class AttnProcessor:
 
         hidden_states = hidden_states / attn.rescale_output_factor
 
+        if accumulate_attn:
+            attn_accumulator.update(attn_key, attention_probs_before_process.unflatten(dim=0, sizes=(batch_size, attn.heads)))
+
         if return_attntion_probs or save_attn_to_dict is not None:
             # Recover batch dimension: (batch_size, heads, flattened_2d, text_tokens)
             attention_probs_unflattened = attention_probs_before_process.unflatten(dim=0, sizes=(batch_size, attn.heads))
@@ -474,6 +486,10 @@ class AttnProcessor:
             if return_cond_ca_only:
                 assert batch_size % 2 == 0, f"Samples are not in pairs: {batch_size} samples"
                 attention_probs_unflattened = attention_probs_unflattened[batch_size // 2:]
+            if return_head_mean_ca:
+                attention_probs_unflattened = attention_probs_unflattened.mean(dim=1, keepdim=True)
+            if saved_attn_dtype is not None:
+                attention_probs_unflattened = attention_probs_unflattened.to(saved_attn_dtype)
             if offload_cross_attn_to_cpu:
                 attention_probs_unflattened = attention_probs_unflattened.cpu()
             if save_attn_to_dict is not None and (save_keys is None or (tuple(attn_key) in save_keys)):
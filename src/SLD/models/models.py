@@ -7,6 +7,7 @@ import numpy as np
 # For compatibility
 from utils.latents import get_unscaled_latents, get_scaled_latents, blend_latents
 from utils import torch_device
+from utils.text_cache import text_embedding_cache
 
 # This is to be set in the `generate.py`
 sd_key = ""
@@ -66,20 +67,21 @@ def encode_prompts(tokenizer, text_encoder, prompts, negative_prompt="", return_
     if negative_prompt == "":
         print("Note that negative_prompt is an empty string")
     
-    text_input = tokenizer(
-        prompts, padding="max_length", max_length=tokenizer.model_max_length, truncation=True, return_tensors="pt"
-    )
-    
-    max_length = text_input.input_ids.shape[-1]
+    def encode(texts):
+        text_input = tokenizer(
+            texts, padding="max_length", max_length=tokenizer.model_max_length, truncation=True, return_tensors="pt"
+        )
+        return text_encoder(text_input.input_ids.to(torch_device))[0]
+
     if one_uncond_input_only:
         num_uncond_input = 1
     else:
         num_uncond_input = len(prompts)
-    uncond_input = tokenizer([negative_prompt] * num_uncond_input, padding="max_length", max_length=max_length, return_tensors="pt")
 
+    # The fixed negative prompts and repeated prompts are encoded once (see `utils.text_cache`)
     with torch.no_grad():
-        uncond_embeddings = text_encoder(uncond_input.input_ids.to(torch_device))[0]
-        cond_embeddings = text_encoder(text_input.input_ids.to(torch_device))[0]
+        uncond_embeddings = text_embedding_cache.encode("hidden_states", [negative_prompt] * num_uncond_input, tokenizer, text_encoder, encode)
+        cond_embeddings = text_embedding_cache.encode("hidden_states", prompts, tokenizer, text_encoder, encode)
     
     if one_uncond_input_only:
         return uncond_embeddings, cond_embeddings
@@ -8,7 +8,8 @@ import numpy as np
 from .attention import GatedSelfAttentionDense
 from .models import process_input_embeddings, torch_device
 import warnings
-from utils.latents import get_scaled_latents
+from utils.latents import get_scaled_latents, LatentTrajectoryRecorder
+from utils.text_cache import text_embedding_cache
 
 # All keys: [('down', 0, 0, 0), ('down', 0, 1, 0), ('down', 1, 0, 0), ('down', 1, 1, 0), ('down', 2, 0, 0), ('down', 2, 1, 0), ('mid', 0, 0, 0), ('up', 1, 0, 0), ('up', 1, 1, 0), ('up', 1, 2, 0), ('up', 2, 0, 0), ('up', 2, 1, 0), ('up', 2, 2, 0), ('up', 3, 0, 0), ('up', 3, 1, 0), ('up', 3, 2, 0)]
 # Note that the first up block is `UpBlock2D` rather than `CrossAttnUpBlock2D` and does not have attention. The last index is always 0 in our case since we have one `BasicTransformerBlock` in each `Transformer2DModel`.
@@ -20,6 +21,24 @@ DEFAULT_GUIDANCE_ATTN_KEYS = [
 ]
 
 
+def apply_guidance_grad(scheduler, index, t, latents, grad_cond):
+    if hasattr(scheduler, "sigmas"):
+        latents = latents - grad_cond * scheduler.sigmas[index] ** 2
+    elif hasattr(scheduler, "alphas_cumprod"):
+        warnings.warn("Using guidance scaled with alphas_cumprod")
+        # Scaling with classifier guidance
+        alpha_prod_t = scheduler.alphas_cumprod[t]
+        # Classifier guidance: https://arxiv.org/pdf/2105.05233.pdf
+        # DDIM: https://arxiv.org/pdf/2010.02502.pdf
+        scale = (1 - alpha_prod_t) ** (0.5)
+        latents = latents - scale * grad_cond
+    else:
+        # NOTE: no scaling is performed
+        warnings.warn("No scaling in guidance is performed")
+        latents = latents - grad_cond
+    return latents
+
+
 def latent_backward_guidance(
     scheduler,
     unet,
@@ -39,8 +58,12 @@ def latent_backward_guidance(
     guidance_attn_keys=None,
     verbose=False,
     clear_cache=False,
+    save_token_columns_only=True,
     **kwargs,
 ):
+    """
+    save_token_columns_only: save only the attention columns of the tokens used by the loss (object positions and word tokens) rather than all 77 columns
+    """
     iteration = 0
 
     if index < max_index_step:
@@ -50,6 +73,14 @@ def latent_backward_guidance(
             else:
                 max_iter = max_iter[-1]
 
+        token_indices = None
+        if save_token_columns_only and object_positions:
+            token_indices, object_positions, word_token_indices = guidance.get_token_columns(
+                object_positions, kwargs.get("word_token_indices")
+            )
+            if "word_token_indices" in kwargs:
+                kwargs["word_token_indices"] = word_token_indices
+
         if verbose:
             print(
                 f"time index {index}, loss: {loss.item()/loss_scale:.3f} (de-scaled with scale {loss_scale:.1f}), loss threshold: {loss_threshold:.3f}"
@@ -68,6 +99,8 @@ def latent_backward_guidance(
 
             if cross_attention_kwargs is not None:
                 full_cross_attention_kwargs.update(cross_attention_kwargs)
+            if token_indices is not None:
+                full_cross_attention_kwargs["return_token_ca_only"] = token_indices
 
             latents.requires_grad_(True)
             latent_model_input = latents
@@ -79,9 +112,10 @@ def latent_backward_guidance(
                 encoder_hidden_states=cond_embeddings,
                 return_cross_attention_probs=False,
                 cross_attention_kwargs=full_cross_attention_kwargs,
+                # Only the attention maps are needed: the blocks after the last guidance key are skipped
+                stop_after_attn_keys=guidance_attn_keys,
             )
 
-            # TODO: could return the attention maps for the required blocks only and not necessarily the final output
             # update latents with guidance
 
             loss = (
@@ -108,20 +142,7 @@ def latent_backward_guidance(
 
             latents.requires_grad_(False)
 
-            if hasattr(scheduler, "sigmas"):
-                latents = latents - grad_cond * scheduler.sigmas[index] ** 2
-            elif hasattr(scheduler, "alphas_cumprod"):
-                warnings.warn("Using guidance scaled with alphas_cumprod")
-                # Scaling with classifier guidance
-                alpha_prod_t = scheduler.alphas_cumprod[t]
-                # Classifier guidance: https://arxiv.org/pdf/2105.05233.pdf
-                # DDIM: https://arxiv.org/pdf/2010.02502.pdf
-                scale = (1 - alpha_prod_t) ** (0.5)
-                latents = latents - scale * grad_cond
-            else:
-                # NOTE: no scaling is performed
-                warnings.warn("No scaling in guidance is performed")
-                latents = latents - grad_cond
+            latents = apply_guidance_grad(scheduler, index, t, latents, grad_cond)
             iteration += 1
 
             if clear_cache:
@@ -135,6 +156,130 @@ def latent_backward_guidance(
     return latents, loss
 
 
+def latent_backward_guidance_per_sample(
+    scheduler,
+    unet,
+    cond_embeddings,
+    index,
+    bboxes,
+    object_positions,
+    t,
+    latents,
+    loss,
+    loss_scale=30,
+    loss_threshold=0.2,
+    max_iter=5,
+    max_index_step=10,
+    cross_attention_kwargs=None,
+    guidance_attn_keys=None,
+    verbose=False,
+    clear_cache=False,
+    save_token_columns_only=True,
+    **kwargs,
+):
+    """
+    `latent_backward_guidance` for a batch of independent generations (e.g., the per-box generations run as one batch).
+    `bboxes` and `object_positions` have one item per sample and `loss` has one loss per sample.
+    Every sample is optimized until its own loss is below the threshold. Only the samples still above the threshold are passed through the UNet.
+    """
+    iteration = 0
+
+    if index < max_index_step:
+        if isinstance(max_iter, list):
+            if len(max_iter) > index:
+                max_iter = max_iter[index]
+            else:
+                max_iter = max_iter[-1]
+
+        token_indices = None
+        if save_token_columns_only and any(object_positions):
+            # The union of the tokens of all samples, each sample reads its own columns
+            token_indices, _, _ = guidance.get_token_columns(
+                [positions for sample_positions in object_positions for positions in sample_positions]
+            )
+            object_positions = [
+                guidance.get_token_columns(sample_positions, token_indices=token_indices)[1]
+                for sample_positions in object_positions
+            ]
+
+        while iteration < max_iter:
+            active = (loss / loss_scale > loss_threshold).nonzero().flatten()
+            if len(active) == 0:
+                break
+
+            saved_attn = {}
+            full_cross_attention_kwargs = {
+                "save_attn_to_dict": saved_attn,
+                "save_keys": guidance_attn_keys,
+            }
+
+            if cross_attention_kwargs is not None:
+                full_cross_attention_kwargs.update(cross_attention_kwargs)
+                if "gligen" in cross_attention_kwargs:
+                    # GLIGEN conditions are per sample, so only the active samples are kept
+                    full_cross_attention_kwargs["gligen"] = {
+                        k: v[active] if torch.is_tensor(v) else v
+                        for k, v in cross_attention_kwargs["gligen"].items()
+                    }
+            if token_indices is not None:
+                full_cross_attention_kwargs["return_token_ca_only"] = token_indices
+
+            active_latents = latents[active].detach().requires_grad_(True)
+            latent_model_input = scheduler.scale_model_input(active_latents, t)
+
+            unet(
+                latent_model_input,
+                t,
+                encoder_hidden_states=cond_embeddings[active],
+                return_cross_attention_probs=False,
+                cross_attention_kwargs=full_cross_attention_kwargs,
+                stop_after_attn_keys=guidance_attn_keys,
+            )
+
+            active_loss = torch.stack(
+                [
+                    guidance.compute_ca_lossv3(
+                        saved_attn={
+                            k: v[ind : ind + 1] for k, v in saved_attn.items()
+                        },
+                        bboxes=bboxes[sample_ind],
+                        object_positions=object_positions[sample_ind],
+                        guidance_attn_keys=guidance_attn_keys,
+                        index=index,
+                        verbose=verbose,
+                        **kwargs,
+                    )
+                    for ind, sample_ind in enumerate(active.tolist())
+                ]
+            ) * loss_scale
+
+            if torch.isnan(active_loss).any():
+                print("**Loss is NaN**")
+
+            del full_cross_attention_kwargs, saved_attn
+
+            # The samples are independent, so the gradient of the sum is the gradient of each sample's own loss
+            grad_cond = torch.autograd.grad(active_loss.sum(), [active_latents])[0]
+
+            latents = latents.clone()
+            latents[active] = apply_guidance_grad(
+                scheduler, index, t, active_latents.detach(), grad_cond
+            )
+            loss = loss.clone()
+            loss[active] = active_loss.detach().to(loss.dtype)
+            iteration += 1
+
+            if clear_cache:
+                utils.free_memory()
+
+            if verbose:
+                print(
+                    f"time index {index}, losses: {(loss / loss_scale).tolist()}, loss threshold: {loss_threshold:.3f}, iteration: {iteration}"
+                )
+
+    return latents, loss
+
+
 @torch.no_grad()
 def encode(model_dict, image, generator):
     """
@@ -201,12 +346,16 @@ def generate_semantic_guidance(
     saved_cross_attn_keys=None,
     return_cond_ca_only=False,
     return_token_ca_only=None,
+    return_head_mean_ca=False,
+    saved_cross_attn_dtype=None,
+    attn_accumulator=None,
     offload_guidance_cross_attn_to_cpu=False,
     offload_cross_attn_to_cpu=False,
     offload_latents_to_cpu=True,
     return_box_vis=False,
     show_progress=True,
     save_all_latents=False,
+    saved_latent_steps=None,
     dynamic_num_inference_steps=False,
     fast_after_steps=None,
     fast_rate=2,
@@ -229,12 +378,6 @@ def generate_semantic_guidance(
     # Just in case that we have in-place ops
     latents = latents.clone()
 
-    if save_all_latents:
-        # offload to cpu to save space
-        if offload_latents_to_cpu:
-            latents_all = [latents.cpu()]
-        else:
-            latents_all = [latents]
 
     scheduler.set_timesteps(num_inference_steps)
     if fast_after_steps is not None:
@@ -242,6 +385,16 @@ def generate_semantic_guidance(
             scheduler.timesteps, fast_after_steps, fast_rate
         )
 
+    if save_all_latents:
+        if offload_latents_to_cpu:
+            # offload to cpu to save space (copied asynchronously to pinned memory)
+            latents_recorder = LatentTrajectoryRecorder(
+                len(scheduler.timesteps) + 1, latents, steps=saved_latent_steps
+            )
+            latents_recorder.record(0, latents)
+        else:
+            latents_all = [latents]
+
     if dynamic_num_inference_steps:
         original_num_inference_steps = scheduler.num_inference_steps
 
@@ -265,6 +418,9 @@ def generate_semantic_guidance(
         "offload_cross_attn_to_cpu": offload_cross_attn_to_cpu,
         "return_cond_ca_only": return_cond_ca_only,
         "return_token_ca_only": return_token_ca_only,
+        "return_head_mean_ca": return_head_mean_ca,
+        "saved_attn_dtype": saved_cross_attn_dtype,
+        "attn_accumulator": attn_accumulator,
         "save_keys": saved_cross_attn_keys,
     }
 
@@ -272,6 +428,9 @@ def generate_semantic_guidance(
     # assert len(set(semantic_guidance_kwargs['guidance_attn_keys'])) == len(semantic_guidance_kwargs['guidance_attn_keys']), f"guidance_attn_keys not unique: {semantic_guidance_kwargs['guidance_attn_keys']}"
 
     for index, t in enumerate(tqdm(scheduler.timesteps, disable=not show_progress)):
+        if attn_accumulator is not None:
+            attn_accumulator.set_step(index)
+
         # expand the latents if we are doing classifier-free guidance to avoid doing two forward passes.
 
         if bboxes:
@@ -349,7 +508,7 @@ def generate_semantic_guidance(
 
         if save_all_latents:
             if offload_latents_to_cpu:
-                latents_all.append(latents.cpu())
+                latents_recorder.record(index + 1, latents)
             else:
                 latents_all.append(latents)
 
@@ -377,7 +536,10 @@ def generate_semantic_guidance(
         ]
         ret.append(pil_images)
     if save_all_latents:
-        latents_all = torch.stack(latents_all, dim=0)
+        if offload_latents_to_cpu:
+            latents_all = latents_recorder.get()
+        else:
+            latents_all = torch.stack(latents_all, dim=0)
         ret.append(latents_all)
     return tuple(ret)
 
@@ -461,10 +623,13 @@ def prepare_gligen_condition(
             bboxes_item = torch.tensor(bboxes_item[:n_objs])
             boxes[idx, : bboxes_item.shape[0]] = bboxes_item
 
-            tokenizer_inputs = tokenizer(
-                phrases_item[:n_objs], padding=True, return_tensors="pt"
-            ).to(torch_device)
-            _phrase_embeddings = text_encoder(**tokenizer_inputs).pooler_output
+            def encode(texts):
+                tokenizer_inputs = tokenizer(texts, padding=True, return_tensors="pt").to(torch_device)
+                return text_encoder(**tokenizer_inputs).pooler_output
+
+            _phrase_embeddings = text_embedding_cache.encode(
+                "pooled", phrases_item[:n_objs], tokenizer, text_encoder, encode
+            )
             phrase_embeddings[idx, : _phrase_embeddings.shape[0]] = _phrase_embeddings
             assert (
                 bboxes_item.shape[0] == _phrase_embeddings.shape[0]
@@ -503,15 +668,20 @@ def generate_gligen(
     saved_cross_attn_keys=None,
     return_cond_ca_only=False,
     return_token_ca_only=None,
+    return_head_mean_ca=False,
+    saved_cross_attn_dtype=None,
+    attn_accumulator=None,
     offload_cross_attn_to_cpu=False,
     offload_latents_to_cpu=True,
     semantic_guidance=False,
     semantic_guidance_bboxes=None,
     semantic_guidance_object_positions=None,
     semantic_guidance_kwargs=None,
+    per_sample_semantic_guidance=False,
     return_box_vis=False,
     show_progress=True,
     save_all_latents=False,
+    saved_latent_steps=None,
     batched_condition=False,
     dynamic_num_inference_steps=False,
     fast_after_steps=None,
@@ -522,6 +692,9 @@ def generate_gligen(
     batched:
         Enabled: bboxes and phrases should be a list (batch dimension) of items (specify the bboxes/phrases of each image in the batch).
         Disabled: bboxes and phrases should be a list of bboxes and phrases specifying the bboxes/phrases of one image (no batch dimension).
+    per_sample_semantic_guidance: the images in the batch are independent generations. `semantic_guidance_bboxes` and `semantic_guidance_object_positions` are given per image and each image is guided with its own loss.
+    saved_latent_steps: with `save_all_latents`, the steps to keep in the returned `latents_all` (all steps if None). Pass a prefix such as `range(frozen_steps + 1)` to keep only the steps that are read later.
+    attn_accumulator: a `utils.attn.AttnAccumulator` that keeps a running mean of the cross-attention over the steps (rather than saving the attention of every step)
     """
     vae, tokenizer, text_encoder, unet, scheduler, dtype = (
         model_dict.vae,
@@ -544,12 +717,6 @@ def generate_gligen(
     # Just in case that we have in-place ops
     latents = latents.clone()
 
-    if save_all_latents:
-        # offload to cpu to save space
-        if offload_latents_to_cpu:
-            latents_all = [latents.cpu()]
-        else:
-            latents_all = [latents]
 
     scheduler.set_timesteps(num_inference_steps)
     if fast_after_steps is not None:
@@ -557,6 +724,20 @@ def generate_gligen(
             scheduler.timesteps, fast_after_steps, fast_rate
         )
 
+    if save_all_latents:
+        # The latents in the fast steps are not saved
+        num_saved_latents = len(scheduler.timesteps) + 1
+        if fast_after_steps is not None:
+            num_saved_latents = min(num_saved_latents, fast_after_steps + 1)
+        if offload_latents_to_cpu:
+            # offload to cpu to save space (copied asynchronously to pinned memory)
+            latents_recorder = LatentTrajectoryRecorder(
+                num_saved_latents, latents, steps=saved_latent_steps
+            )
+            latents_recorder.record(0, latents)
+        else:
+            latents_all = [latents]
+
     if dynamic_num_inference_steps:
         original_num_inference_steps = scheduler.num_inference_steps
 
@@ -573,7 +754,12 @@ def generate_gligen(
     )
 
     if semantic_guidance_bboxes and semantic_guidance:
-        loss = torch.tensor(10000.0)
+        if per_sample_semantic_guidance:
+            loss = torch.full((latents.shape[0],), 10000.0, device=latents.device)
+            guidance_fn = latent_backward_guidance_per_sample
+        else:
+            loss = torch.tensor(10000.0)
+            guidance_fn = latent_backward_guidance
         # TODO: we can also save necessary tokens only to save memory.
         # offload_guidance_cross_attn_to_cpu does not save too much since we only store attention map for each timestep.
         guidance_cross_attention_kwargs = {
@@ -596,6 +782,9 @@ def generate_gligen(
         "offload_cross_attn_to_cpu": offload_cross_attn_to_cpu,
         "return_cond_ca_only": return_cond_ca_only,
         "return_token_ca_only": return_token_ca_only,
+        "return_head_mean_ca": return_head_mean_ca,
+        "saved_attn_dtype": saved_cross_attn_dtype,
+        "attn_accumulator": attn_accumulator,
         "save_keys": saved_cross_attn_keys,
         "gligen": {
             "boxes": boxes,
@@ -610,13 +799,16 @@ def generate_gligen(
     gligen_enable_fuser(unet, True)
 
     for index, t in enumerate(tqdm(timesteps, disable=not show_progress)):
+        if attn_accumulator is not None:
+            attn_accumulator.set_step(index)
+
         # Scheduled sampling
         if index == num_grounding_steps:
             gligen_enable_fuser(unet, False)
 
         if semantic_guidance_bboxes and semantic_guidance:
             with torch.enable_grad():
-                latents, loss = latent_backward_guidance(
+                latents, loss = guidance_fn(
                     scheduler,
                     unet,
                     cond_embeddings,
@@ -669,7 +861,7 @@ def generate_gligen(
         # Do not save the latents in the fast steps
         if save_all_latents and (fast_after_steps is None or index < fast_after_steps):
             if offload_latents_to_cpu:
-                latents_all.append(latents.cpu())
+                latents_recorder.record(index + 1, latents)
             else:
                 latents_all.append(latents)
 
@@ -691,7 +883,10 @@ def generate_gligen(
         ]
         ret.append(pil_images)
     if save_all_latents:
-        latents_all = torch.stack(latents_all, dim=0)
+        if offload_latents_to_cpu:
+            latents_all = latents_recorder.get()
+        else:
+            latents_all = torch.stack(latents_all, dim=0)
         ret.append(latents_all)
 
     return tuple(ret)
@@ -714,6 +909,9 @@ def generate_gligen_final(
     saved_cross_attn_keys=None,
     return_cond_ca_only=False,
     return_token_ca_only=None,
+    return_head_mean_ca=False,
+    saved_cross_attn_dtype=None,
+    attn_accumulator=None,
     offload_cross_attn_to_cpu=False,
     offload_latents_to_cpu=True,
     semantic_guidance=False,
@@ -723,6 +921,7 @@ def generate_gligen_final(
     return_box_vis=False,
     show_progress=True,
     save_all_latents=False,
+    saved_latent_steps=None,
     batched_condition=False,
     dynamic_num_inference_steps=False,
     fast_after_steps=None,
@@ -768,12 +967,6 @@ def generate_gligen_final(
 
     latents = latents.clone()
 
-    if save_all_latents:
-        # offload to cpu to save space
-        if offload_latents_to_cpu:
-            latents_all = [latents.cpu()]
-        else:
-            latents_all = [latents]
 
     scheduler.set_timesteps(num_inference_steps)
     if fast_after_steps is not None:
@@ -781,6 +974,20 @@ def generate_gligen_final(
             scheduler.timesteps, fast_after_steps, fast_rate
         )
 
+    if save_all_latents:
+        # The latents in the fast steps are not saved
+        num_saved_latents = len(scheduler.timesteps) + 1
+        if fast_after_steps is not None:
+            num_saved_latents = min(num_saved_latents, fast_after_steps + 1)
+        if offload_latents_to_cpu:
+            # offload to cpu to save space (copied asynchronously to pinned memory)
+            latents_recorder = LatentTrajectoryRecorder(
+                num_saved_latents, latents, steps=saved_latent_steps
+            )
+            latents_recorder.record(0, latents)
+        else:
+            latents_all = [latents]
+
     if dynamic_num_inference_steps:
         original_num_inference_steps = scheduler.num_inference_steps
 
@@ -820,6 +1027,9 @@ def generate_gligen_final(
         "offload_cross_attn_to_cpu": offload_cross_attn_to_cpu,
         "return_cond_ca_only": return_cond_ca_only,
         "return_token_ca_only": return_token_ca_only,
+        "return_head_mean_ca": return_head_mean_ca,
+        "saved_attn_dtype": saved_cross_attn_dtype,
+        "attn_accumulator": attn_accumulator,
         "save_keys": saved_cross_attn_keys,
         "gligen": {
             "boxes": boxes,
@@ -834,6 +1044,9 @@ def generate_gligen_final(
     gligen_enable_fuser(unet, True)
 
     for index, t in enumerate(tqdm(timesteps, disable=not show_progress)):
+        if attn_accumulator is not None:
+            attn_accumulator.set_step(index)
+
         # Scheduled sampling
         if index == num_grounding_steps:
             gligen_enable_fuser(unet, False)
@@ -893,7 +1106,7 @@ def generate_gligen_final(
         # Do not save the latents in the fast steps
         if save_all_latents and (fast_after_steps is None or index < fast_after_steps):
             if offload_latents_to_cpu:
-                latents_all.append(latents.cpu())
+                latents_recorder.record(index + 1, latents)
             else:
                 latents_all.append(latents)
 
@@ -916,7 +1129,10 @@ def generate_gligen_final(
         ]
         ret.append(pil_images)
     if save_all_latents:
-        latents_all = torch.stack(latents_all, dim=0)
+        if offload_latents_to_cpu:
+            latents_all = latents_recorder.get()
+        else:
+            latents_all = torch.stack(latents_all, dim=0)
         ret.append(latents_all)
 
     return tuple(ret)
@@ -938,10 +1154,11 @@ def get_inverse_timesteps(inverse_scheduler, num_inference_steps, strength):
 
 @torch.no_grad()
 def invert(
-    model_dict, latents, input_embeddings, num_inference_steps, guidance_scale=7.5
+    model_dict, latents, input_embeddings, num_inference_steps, guidance_scale=7.5, saved_latent_steps=None
 ):
     """
     latents: encoded from the image, should not have noise (t = 0)
+    saved_latent_steps: the steps to keep, indexed as in the returned latents (all steps if None). A prefix (e.g., the frozen steps) keeps the indexing of the full trajectory.
 
     returns inverted_latents for all time steps
     """
@@ -962,8 +1179,14 @@ def invert(
         inverse_scheduler, num_inference_steps, strength=1.0
     )
 
-    inverted_latents = [latents.cpu()]
-    for t in tqdm(timesteps):
+    # The returned latents are in denoising order, the reverse of the inversion order
+    if saved_latent_steps is not None:
+        saved_latent_steps = [len(timesteps) - step for step in saved_latent_steps]
+    latents_recorder = LatentTrajectoryRecorder(
+        len(timesteps) + 1, latents, steps=saved_latent_steps
+    )
+    latents_recorder.record(0, latents)
+    for index, t in enumerate(tqdm(timesteps)):
         # expand the latents if we are doing classifier-free guidance to avoid doing two forward passes.
         if guidance_scale > 0.0:
             latent_model_input = torch.cat([latents] * 2)
@@ -1002,11 +1225,10 @@ def invert(
         # compute the previous noisy sample x_t -> x_t-1
         latents = inverse_scheduler.step(noise_pred, t, latents).prev_sample
 
-        inverted_latents.append(latents.cpu())
+        latents_recorder.record(index + 1, latents)
 
-    assert len(inverted_latents) == (len(timesteps) + 1)
     # timestep is the first dimension
-    inverted_latents = torch.stack(list(reversed(inverted_latents)), dim=0)
+    inverted_latents = torch.flip(latents_recorder.get(), dims=(0,))
 
     return inverted_latents
 
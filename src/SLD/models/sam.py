@@ -8,6 +8,8 @@ from transformers import SamModel, SamProcessor
 import utils
 from utils import vis
 import cv2
+import hashlib
+from collections import OrderedDict
 from scipy import ndimage
 
 
@@ -16,10 +18,72 @@ def load_sam():
     sam_processor = SamProcessor.from_pretrained("facebook/sam-vit-huge")
 
     sam_model_dict = dict(sam_model=sam_model, sam_processor=sam_processor)
+    sam_model_dict["sam_session"] = SamSession(sam_model_dict)
 
     return sam_model_dict
 
 
+class SamSession:
+    """
+    Runs the SAM image encoder once per image and decodes any number of box prompts against it.
+
+    Image embeddings are cached by a hash of the image (LRU, `max_images` entries), so every call on the same
+    image (remove / preserve / move / attribute-change objects) shares a single encoder pass.
+    """
+
+    def __init__(self, sam_model_dict, max_images=4):
+        self.sam_model = sam_model_dict["sam_model"]
+        self.sam_processor = sam_model_dict["sam_processor"]
+        self.max_images = max_images
+        self.embeddings = OrderedDict()
+
+    def _encode(self, image):
+        """Returns (image_embeddings, original_size, reshaped_input_size) of an HxWx3 uint8 image."""
+        image = np.ascontiguousarray(image)
+        key = hashlib.sha256(image.tobytes()).hexdigest() + str(image.shape)
+        if key in self.embeddings:
+            self.embeddings.move_to_end(key)
+            return self.embeddings[key]
+
+        with torch.no_grad():
+            with torch.autocast(torch_device):
+                inputs = self.sam_processor(image, return_tensors="pt").to(torch_device)
+                image_embeddings = self.sam_model.get_image_embeddings(inputs["pixel_values"])
+        entry = (image_embeddings, inputs["original_sizes"].cpu(), inputs["reshaped_input_sizes"].cpu())
+        del inputs
+
+        self.embeddings[key] = entry
+        while len(self.embeddings) > self.max_images:
+            self.embeddings.popitem(last=False)
+        return entry
+
+    def sam_boxes(self, image, input_boxes, target_mask_shape):
+        """
+        Decodes every xyxy box (pixels) in one mask-decoder call.
+
+        Returns a list with, per box, the (3, h, w) boolean masks of the three SAM mask outputs resized to
+        `target_mask_shape`, as `sam` returns them for a single box, and the (num_boxes, 3) iou scores.
+        """
+        image_embeddings, original_size, reshaped_input_size = self._encode(image)
+
+        # Same coordinate normalization as SamProcessor: scale to the resized (longest side 1024) input
+        (orig_h, orig_w), (new_h, new_w) = original_size[0].tolist(), reshaped_input_size[0].tolist()
+        boxes = torch.as_tensor(input_boxes, dtype=torch.float).reshape(1, -1, 4)
+        boxes = boxes * torch.tensor([new_w / orig_w, new_h / orig_h, new_w / orig_w, new_h / orig_h])
+
+        with torch.no_grad():
+            with torch.autocast(torch_device):
+                outputs = self.sam_model(image_embeddings=image_embeddings, input_boxes=boxes.to(torch_device))
+            masks = self.sam_processor.image_processor.post_process_masks(
+                outputs.pred_masks.cpu().float(), original_size, reshaped_input_size
+            )[0]
+            conf_scores = outputs.iou_scores.cpu().numpy()[0]
+            del outputs
+
+        masks = F.interpolate(masks.type(torch.float), target_mask_shape, mode="bilinear").type(torch.bool).numpy()
+        return list(masks), conf_scores
+
+
 # Not fully backward compatible with the previous implementation
 # Reference: lmdv2/notebooks/gen_masked_latents_multi_object_ref_ca_loss_modular.ipynb
 def sam(
@@ -715,7 +715,8 @@ class UNet2DConditionModel(ModelMixin, ConfigMixin, UNet2DConditionLoadersMixin)
         mid_block_additional_residual: Optional[torch.Tensor] = None,
         encoder_attention_mask: Optional[torch.Tensor] = None,
         return_dict: bool = True,
-        return_cross_attention_probs: bool = False
+        return_cross_attention_probs: bool = False,
+        stop_after_attn_keys: Optional[List[Tuple]] = None,
     ) -> Union[UNet2DConditionOutput, Tuple]:
         r"""
         Args:
@@ -736,6 +737,10 @@ class UNet2DConditionModel(ModelMixin, ConfigMixin, UNet2DConditionLoadersMixin)
                 A kwargs dictionary that if specified includes additonal conditions that can be used for additonal time
                 embeddings or encoder hidden states projections. See the configurations `encoder_hid_dim_type` and
                 `addition_embed_type` for more information.
+            stop_after_attn_keys (`list`, *optional*):
+                Attention keys (e.g. `("up", 1, 2, 0)`) whose attention maps are the only thing needed from this
+                forward pass (e.g. for attention guidance). The forward pass stops after the block containing the last
+                of these keys and `sample` is `None` in the output.
 
         Returns:
             [`~models.unet_2d_condition.UNet2DConditionOutput`] or `tuple`:
@@ -857,6 +862,18 @@ class UNet2DConditionModel(ModelMixin, ConfigMixin, UNet2DConditionLoadersMixin)
             image_embeds = added_cond_kwargs.get("image_embeds")
             encoder_hidden_states = self.encoder_hid_proj(encoder_hidden_states, image_embeds)
 
+        # Index of the last block to run (down blocks, then mid, then up blocks) if the forward pass is truncated
+        if stop_after_attn_keys:
+            block_offsets = {"down": 0, "mid": len(self.down_blocks), "up": len(self.down_blocks) + 1}
+            last_block_index = max(block_offsets[attn_key[0]] + attn_key[1] for attn_key in stop_after_attn_keys)
+        else:
+            last_block_index = None
+
+        def truncated_output():
+            if not return_dict:
+                return (None,)
+            return UNet2DConditionOutput(sample=None, cross_attention_probs_down=cross_attention_probs_down, cross_attention_probs_mid=cross_attention_probs_mid, cross_attention_probs_up=cross_attention_probs_up)
+
         # 2. pre-process
         sample = self.conv_in(sample)
 
@@ -875,6 +892,8 @@ class UNet2DConditionModel(ModelMixin, ConfigMixin, UNet2DConditionLoadersMixin)
         # 3. down
         down_block_res_samples = (sample,)
         cross_attention_probs_down = []
+        cross_attention_probs_mid = []
+        cross_attention_probs_up = []
         if cross_attention_kwargs is None:
             cross_attention_kwargs = {}
 
@@ -901,6 +920,9 @@ class UNet2DConditionModel(ModelMixin, ConfigMixin, UNet2DConditionLoadersMixin)
 
             down_block_res_samples += res_samples
 
+            if last_block_index == i:
+                return truncated_output()
+
         if down_block_additional_residuals is not None:
             new_down_block_res_samples = ()
 
@@ -913,7 +935,6 @@ class UNet2DConditionModel(ModelMixin, ConfigMixin, UNet2DConditionLoadersMixin)
             down_block_res_samples = new_down_block_res_samples
 
         # 4. mid
-        cross_attention_probs_mid = []
         if self.mid_block is not None:
             cross_attention_kwargs["attn_key"] = ["mid", 0]
             
@@ -931,10 +952,12 @@ class UNet2DConditionModel(ModelMixin, ConfigMixin, UNet2DConditionLoadersMixin)
                 cross_attention_probs_mid.append(cross_attention_probs)
             
 
+        if last_block_index == len(self.down_blocks):
+            return truncated_output()
+
         if mid_block_additional_residual is not None:
             sample = sample + mid_block_additional_residual
 
-        cross_attention_probs_up = []
         # 5. up
         for i, upsample_block in enumerate(self.up_blocks):
             cross_attention_kwargs["attn_key"] = ["up", i]
@@ -969,6 +992,9 @@ class UNet2DConditionModel(ModelMixin, ConfigMixin, UNet2DConditionLoadersMixin)
                     hidden_states=sample, temb=emb, res_hidden_states_tuple=res_samples, upsample_size=upsample_size
                 )
 
+            if last_block_index == len(self.down_blocks) + 1 + i:
+                return truncated_output()
+
         # 6. post-process
         if self.conv_norm_out:
             sample = self.conv_norm_out(sample)
@@ -3,7 +3,8 @@ import numpy as np
 import torch
 
 from PIL import Image
-from sld.utils import nms, post_process
+from sld.utils import post_process
+from utils.nms import class_aware_nms, class_aware_nms_torch
 from utils.utils import free_memory
 from utils.parse import p
 
@@ -68,52 +69,6 @@ def peak_bbox_via_name(target_base_name, det_results):
     return return_list
 
 
-def class_aware_nms(
-    bounding_boxes, confidence_score, labels, threshold, input_in_pixels=False
-):
-    """
-    This NMS processes boxes of each label individually.
-    """
-    # If no bounding boxes, return empty list
-    if len(bounding_boxes) == 0:
-        return np.array([]), np.array([]), np.array([])
-
-    picked_boxes, picked_score, picked_labels = [], [], []
-
-    labels_unique = np.unique(labels)
-    for label in labels_unique:
-        bounding_boxes_label = [
-            bounding_box
-            for i, bounding_box in enumerate(bounding_boxes)
-            if labels[i] == label
-        ]
-        confidence_score_label = [
-            confidence_score_item
-            for i, confidence_score_item in enumerate(confidence_score)
-            if labels[i] == label
-        ]
-        labels_label = [label] * len(bounding_boxes_label)
-        picked_boxes_label, picked_score_label, picked_labels_label = nms(
-            bounding_boxes_label,
-            confidence_score_label,
-            labels_label,
-            threshold=threshold,
-            input_in_pixels=input_in_pixels,
-            return_array=False,
-        )
-        picked_boxes += picked_boxes_label
-        picked_score += picked_score_label
-        picked_labels += picked_labels_label
-
-    picked_boxes, picked_score, picked_labels = (
-        np.array(picked_boxes),
-        np.array(picked_score),
-        np.array(picked_labels),
-    )
-
-    return picked_boxes, picked_score, picked_labels
-
-
 class Detector:
     def __init__(self):
         # Initialize class variables
@@ -437,91 +392,71 @@ class OWLVITV2Detector(Detector):
         )
         self.model = owl_vit_model.eval().to("cuda")
 
-    def detect(self, img_path, split, score_threshold, nms_threshold):
-        # data preprocessing
-        if split == "attribute":
-            target_objects = [x for x in self.attribute_count_dict]
-        elif split == "primitive":
-            target_objects = [x for x in self.primitive_count_dict]
-        if len(target_objects) == 0:
-            return []
+    @torch.inference_mode()
+    def encode_image(self, img_path):
+        """
+        Runs the OWLv2 image encoder once. Returns the patch features (for `score_queries`) and
+        the predicted boxes as normalized xyxy, which do not depend on the text queries.
+        """
         image = Image.open(img_path)
-        texts = [[f"image of {p.a(obj)}" for obj in target_objects]]
-
-        inputs = self.processor(text=texts, images=image, return_tensors="pt")
-        inputs = inputs.to("cuda")
-        with torch.inference_mode():
-            outputs = self.model(**inputs)
+        pixel_values = self.processor(images=image, return_tensors="pt")["pixel_values"].to("cuda")
+        feature_map = self.model.image_embedder(pixel_values=pixel_values)[0]
+        batch_size, num_patches_height, num_patches_width, hidden_dim = feature_map.shape
+        image_feats = feature_map.reshape(batch_size, num_patches_height * num_patches_width, hidden_dim)
+        pred_boxes = self.model.box_predictor(image_feats, feature_map)[0]
 
+        # cxcywh to xyxy, scaled as in `post_process_object_detection`
         width, height = image.size
-
-        # Target image sizes (height, width) to rescale box predictions [batch_size, 2]
-        target_sizes = torch.Tensor([[height, width]])
-        target_sizes = target_sizes.cuda()
-        # Convert outputs (bounding boxes and class logits) to COCO API
-        results = self.processor.post_process_object_detection(
-            outputs=outputs, target_sizes=target_sizes, threshold=0
-        )
-        assert len(results) == 1
-        boxes, scores, labels = (
-            results[0]["boxes"],
-            results[0]["scores"],
-            results[0]["labels"],
-        )
+        scale = torch.tensor([width, height, width, height], device=pred_boxes.device, dtype=pred_boxes.dtype)
+        boxes = torch.cat([pred_boxes[:, :2] - pred_boxes[:, 2:] / 2, pred_boxes[:, :2] + pred_boxes[:, 2:] / 2], dim=-1) * scale
         # Hack: Assume width = height
-        boxes = torch.clip(boxes, 0, width)
-        boxes = boxes.cpu().detach()
-        # xyxy ranging from 0 to 1
-        boxes = np.array(
-            [
-                [x_min / width, y_min / height, x_max / width, y_max / height]
-                for (x_min, y_min, x_max, y_max), score in zip(boxes, scores)
-                if score >= score_threshold
-            ]
-        )
-        labels = np.array(
-            [
-                label.cpu().numpy()
-                for label, score in zip(labels, scores)
-                if score >= score_threshold
-            ]
-        )
-        scores = np.array(
-            [
-                score.cpu().detach().numpy()
-                for score in scores
-                if score >= score_threshold
-            ]
-        )
-        boxes, scores, labels = class_aware_nms(boxes, scores, labels, nms_threshold)
-        ret_results = []
-        for box, score, label in zip(boxes, scores, labels):
-            box = box.tolist()
-            box = [box[0], box[1], box[2] - box[0], box[3] - box[1]]  # xyxy to xyhw
-            box = post_process(box)
+        boxes = torch.clip(boxes, 0, width) / scale
+        return image_feats, boxes
 
-            # print(
-            #     f"Detected {target_objects[label]} ({label}) with confidence {round(score.item(), 3)} at location {box}"
-            # )
-            ret_results.append(
-                (
-                    f"{target_objects[label]}",
-                    box,
-                )
-            )
+    @torch.inference_mode()
+    def score_queries(self, image_feats, target_objects):
+        """Class logits (num_boxes, num_queries) of the encoded image for the given object names."""
+        texts = [[f"image of {p.a(obj)}" for obj in target_objects]]
+        text_inputs = self.processor(text=texts, return_tensors="pt").to("cuda")
+        query_embeds = self.model.owlv2.get_text_features(
+            input_ids=text_inputs["input_ids"], attention_mask=text_inputs["attention_mask"]
+        )[None]
+        query_mask = torch.ones(query_embeds.shape[:2], dtype=torch.bool, device=query_embeds.device)
+        logits, _ = self.model.class_predictor(image_feats, query_embeds, query_mask)
+        return logits[0]
+
+    def detect(self, boxes, logits, target_objects, score_threshold, nms_threshold):
+        """Thresholds and NMS-es the boxes for one query set (`logits` holds its columns only)."""
+        if len(target_objects) == 0:
+            return []
+        max_logits, labels = logits.max(dim=-1)
+        scores = torch.sigmoid(max_logits)
+        keep = scores >= score_threshold
+        boxes, scores, labels = class_aware_nms_torch(boxes[keep], scores[keep], labels[keep], nms_threshold)
 
-        return ret_results
+        # xyxy to xywh
+        boxes = boxes.cpu().numpy()
+        boxes[:, 2:] -= boxes[:, :2]
+        return [(f"{target_objects[label]}", post_process(box.tolist())) for box, label in zip(boxes, labels.tolist())]
 
     def run(self, prompt, object_lists, img_path, **kwargs):
         attr_detection_threshold = kwargs.get("attr_detection_threshold", self.default_attr_detection_threshold)
         prim_detection_threshold = kwargs.get("prim_detection_threshold", self.default_prim_detection_threshold)
         nms_threshold = kwargs.get("nms_threshold", self.default_nms_threshold)
         self.register_objects(prompt, object_lists)
+        attribute_targets = [x for x in self.attribute_count_dict]
+        primitive_targets = [x for x in self.primitive_count_dict]
+        if len(attribute_targets) + len(primitive_targets) == 0:
+            return []
+
+        # One image encoding and one text encoding for both query sets
+        image_feats, boxes = self.encode_image(img_path)
+        logits = self.score_queries(image_feats, attribute_targets + primitive_targets)
         attribute_objects = self.detect(
-            img_path, split="attribute", score_threshold=attr_detection_threshold, nms_threshold=nms_threshold,
+            boxes, logits[:, : len(attribute_targets)], attribute_targets, attr_detection_threshold, nms_threshold,
         )
         primitive_objects = self.detect(
-            img_path, split="primitive", score_threshold=prim_detection_threshold, nms_threshold=nms_threshold,
+            boxes, logits[:, len(attribute_targets) :], primitive_targets, prim_detection_threshold, nms_threshold,
         )
         free_memory()
         print(f"* attr object: {attribute_objects}")
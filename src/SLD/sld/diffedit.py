@@ -0,0 +1,90 @@
+import numpy as np
+import torch
+from diffusers import DDIMInverseScheduler, DDIMScheduler, StableDiffusionDiffEditPipeline
+
+import models
+from sld.utils import get_all_latents
+
+DIFFEDIT_KEY = "stabilityai/stable-diffusion-2-1-base"
+
+# Loaded on first use and kept for every later attribute modification
+_diffedit_pipe = None
+
+
+def get_diffedit_pipeline():
+    global _diffedit_pipe
+    if _diffedit_pipe is None:
+        pipe = StableDiffusionDiffEditPipeline.from_pretrained(DIFFEDIT_KEY, torch_dtype=torch.float16)
+        pipe.scheduler = DDIMScheduler.from_config(pipe.scheduler.config)
+        pipe.inverse_scheduler = DDIMInverseScheduler.from_config(pipe.scheduler.config)
+        # Offload to the GPU the SLD models run on (the current device), not always cuda:0
+        pipe.enable_model_cpu_offload(gpu_id=torch.cuda.current_device())
+        _diffedit_pipe = pipe
+    return _diffedit_pipe
+
+
+def _same_timesteps(scheduler_a, scheduler_b, num_inference_steps):
+    """Whether two schedulers visit the same timesteps with the same noise levels."""
+    a = DDIMScheduler.from_config(scheduler_a.config)
+    b = DDIMScheduler.from_config(scheduler_b.config)
+    a.set_timesteps(num_inference_steps)
+    b.set_timesteps(num_inference_steps)
+    return torch.equal(a.timesteps, b.timesteps) and torch.allclose(a.alphas_cumprod, b.alphas_cumprod)
+
+
+@torch.no_grad()
+def diffedit_all_latents(img, masks, mask_prompts, new_prompts, inv_seed, inpaint_strength, guidance_scale, num_inference_steps=50, model_dict=None):
+    """
+    Runs DiffEdit for several attribute changes of the same image as one batched invert and one batched generate.
+
+    img: PIL image
+    masks: object regions at latent resolution, one per change
+    mask_prompts, new_prompts: DiffEdit prompts, one per change
+
+    Returns the latent trajectory of every change in the layout of `get_all_latents` (num_inference_steps + 1
+    steps, noisiest first). If the DiffEdit scheduler visits the same timesteps as the SLD scheduler, the
+    trajectory is read from the DiffEdit pass itself: the inversion provides the steps before `inpaint_strength`
+    (DiffEdit starts its denoising from the inverted latent) and the denoising loop provides the rest.
+    Otherwise the edited images are inverted with the SLD model, as before.
+    """
+    if model_dict is None:
+        model_dict = models.model_dict
+    pipe = get_diffedit_pipeline()
+    num_changes = len(masks)
+
+    # Inverting the whole schedule gives the prefix needed by the denoising pass plus the earlier steps
+    full_inverted = pipe.invert(
+        image=[img] * num_changes,
+        prompt=mask_prompts,
+        inpaint_strength=1.0,
+        num_inference_steps=num_inference_steps,
+        generator=[torch.Generator(device="cuda").manual_seed(inv_seed) for _ in range(num_changes)],
+    ).latents
+    t_start = num_inference_steps - min(int(num_inference_steps * inpaint_strength), num_inference_steps)
+
+    reuse_trajectory = _same_timesteps(pipe.scheduler, model_dict.scheduler, num_inference_steps)
+    denoised = []
+
+    def collect(step, timestep, latents):
+        denoised.append(latents.detach().cpu())
+
+    output = pipe(
+        prompt=new_prompts,
+        mask_image=np.stack([np.asarray(mask, dtype=np.bool_) for mask in masks]),
+        image_latents=full_inverted[:, t_start:],
+        guidance_scale=guidance_scale,
+        inpaint_strength=inpaint_strength,
+        num_inference_steps=num_inference_steps,
+        generator=[torch.Generator(device="cuda").manual_seed(inv_seed) for _ in range(num_changes)],
+        negative_prompt=[""] * num_changes,
+        output_type="latent" if reuse_trajectory else "pil",
+        callback=collect if reuse_trajectory else None,
+        callback_steps=1,
+    )
+
+    if not reuse_trajectory:
+        return [get_all_latents(np.array(image), models, inv_seed)[0] for image in output.images]
+
+    # (num_changes, steps, 4, h, w): inverted steps up to and including the DiffEdit starting latent, then every denoised step
+    trajectory = torch.cat([full_inverted[:, : t_start + 1].cpu(), torch.stack(denoised, dim=1)], dim=1)
+    return [trajectory[i].unsqueeze(1).to(model_dict.dtype) for i in range(num_changes)]
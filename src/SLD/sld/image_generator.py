@@ -4,7 +4,7 @@ import utils
 import numpy as np
 from easydict import EasyDict
 
-from models import pipelines, sam, model_dict
+from models import pipelines, sam
 from utils import parse, guidance, attn, latents, vis
 from utils.latents import get_scaled_latents
 from sld.utils import DEFAULT_SO_NEGATIVE_PROMPT, DEFAULT_OVERALL_NEGATIVE_PROMPT
@@ -12,15 +12,6 @@ from sld.utils import DEFAULT_SO_NEGATIVE_PROMPT, DEFAULT_OVERALL_NEGATIVE_PROMP
 # import inflect
 # p = inflect.engine()
 
-vae, tokenizer, text_encoder, unet, scheduler, dtype = (
-    model_dict.vae,
-    model_dict.tokenizer,
-    model_dict.text_encoder,
-    model_dict.unet,
-    model_dict.scheduler,
-    model_dict.dtype,
-)
-
 version = "sld"
 
 # Hyperparams
@@ -59,8 +50,13 @@ def generate_single_object_with_box(
     gligen_scheduled_sampling_beta=0.3,
     verbose=False,
     visualize=True,
+    model_dict=None,
     **kwargs,
 ):
+    if model_dict is None:
+        model_dict = models.model_dict
+    tokenizer = model_dict.tokenizer
+
     bboxes, phrases, words = [box], [phrase], [word]
 
     if verbose:
@@ -138,18 +134,144 @@ def generate_single_object_with_box(
     )
 
 
+def generate_single_objects_with_boxes(
+    so_prompt_phrase_word_box_list,
+    input_latents,
+    input_embeddings,
+    semantic_guidance_kwargs,
+    obj_attn_key,
+    saved_cross_attn_keys,
+    sam_refine_kwargs,
+    num_inference_steps,
+    gligen_scheduled_sampling_beta=0.3,
+    verbose=False,
+    visualize=True,
+    model_dict=None,
+    **kwargs,
+):
+    """
+    Batched version of `generate_single_object_with_box`: the N per-box generations run as one GLIGEN batch (2N samples with classifier-free guidance).
+    input_latents: (N, 4, H, W), the initial latents of the objects
+    input_embeddings: (uncond_embeddings, cond_embeddings) with one cond embedding per object
+    Returns lists with one item per object, laid out as the outputs of `generate_single_object_with_box`.
+    """
+    if model_dict is None:
+        model_dict = models.model_dict
+    tokenizer = model_dict.tokenizer
+
+    bboxes, phrases, object_positions, word_token_indices = [], [], [], []
+    for prompt, phrase, word, box in so_prompt_phrase_word_box_list:
+        if verbose:
+            print(f"Getting token map (prompt: {prompt})")
+        object_positions_item, word_token_indices_item = guidance.get_phrase_indices(
+            tokenizer=tokenizer,
+            prompt=prompt,
+            phrases=[phrase],
+            words=[word],
+            return_word_token_indices=True,
+            add_suffix_if_not_found=False,
+            verbose=verbose,
+        )
+        bboxes.append([box])
+        phrases.append([phrase])
+        object_positions.append(object_positions_item)
+        word_token_indices.append(word_token_indices_item[0])
+
+    if verbose:
+        print("word_token_indices:", word_token_indices)
+    (
+        _,
+        single_object_images,
+        saved_attns,
+        single_object_pil_images_box_ann,
+        latents_all,
+    ) = pipelines.generate_gligen(
+        model_dict,
+        input_latents,
+        input_embeddings,
+        num_inference_steps,
+        bboxes,
+        phrases,
+        gligen_scheduled_sampling_beta=gligen_scheduled_sampling_beta,
+        guidance_scale=7.5,
+        return_saved_cross_attn=True,
+        semantic_guidance=True,
+        semantic_guidance_bboxes=bboxes,
+        semantic_guidance_object_positions=object_positions,
+        semantic_guidance_kwargs=semantic_guidance_kwargs,
+        per_sample_semantic_guidance=True,
+        saved_cross_attn_keys=[obj_attn_key, *saved_cross_attn_keys],
+        return_cond_ca_only=True,
+        # Sample k keeps column k of these tokens (its own word token)
+        return_token_ca_only=torch.tensor(word_token_indices),
+        offload_cross_attn_to_cpu=offload_cross_attn_to_cpu,
+        return_box_vis=True,
+        save_all_latents=True,
+        dynamic_num_inference_steps=True,
+        batched_condition=True,
+        **kwargs,
+    )
+
+    utils.free_memory()
+
+    latents_all_list, mask_tensor_list, saved_attns_list = [], [], []
+    for idx, (_, _, _, box) in enumerate(so_prompt_phrase_word_box_list):
+        if visualize:
+            print("Single object image")
+            vis.display(single_object_pil_images_box_ann[idx])
+        mask_selected, conf_score_selected = sam.sam_refine_box(
+            sam_input_image=single_object_images[idx],
+            box=box,
+            model_dict=model_dict,
+            verbose=verbose,
+            **sam_refine_kwargs,
+        )
+
+        latents_all_list.append(latents_all[:, idx : idx + 1])
+        mask_tensor_list.append(torch.tensor(mask_selected))
+        # Same shapes as a single object generation: (1, n heads, 2d dimension, 1)
+        saved_attns_list.append(
+            [
+                {k: v[idx : idx + 1, ..., idx : idx + 1] for k, v in saved_attn.items()}
+                for saved_attn in saved_attns
+            ]
+        )
+
+    return (
+        latents_all_list,
+        mask_tensor_list,
+        saved_attns_list,
+        list(single_object_pil_images_box_ann),
+    )
+
+
 def get_masked_latents_all_list(
     so_prompt_phrase_word_box_list,
     input_latents_list,
     so_input_embeddings,
     verbose=False,
+    model_dict=None,
+    batch_single_objects=True,
     **kwargs,
 ):
+    """
+    batch_single_objects: generate all the objects in one batch (see `generate_single_objects_with_boxes`) rather than one after another
+    """
     latents_all_list, mask_tensor_list, saved_attns_list, so_img_list = [], [], [], []
 
     if not so_prompt_phrase_word_box_list:
         return latents_all_list, mask_tensor_list, saved_attns_list, so_img_list
 
+    if batch_single_objects:
+        return generate_single_objects_with_boxes(
+            so_prompt_phrase_word_box_list,
+            torch.cat(list(input_latents_list), dim=0),
+            input_embeddings=so_input_embeddings,
+            verbose=verbose,
+            model_dict=model_dict,
+            **kwargs,
+        )
+
     so_uncond_embeddings, so_cond_embeddings = so_input_embeddings
 
     for idx, ((prompt, phrase, word, box), input_latents) in enumerate(
@@ -173,6 +295,7 @@ def get_masked_latents_all_list(
             input_latents,
             input_embeddings=so_current_input_embeddings,
             verbose=verbose,
+            model_dict=model_dict,
             **kwargs,
         )
         latents_all_list.append(latents_all)
@@ -244,6 +367,7 @@ def run(
     use_ref_ca=True,
     use_autocast=True,
     verbose=False,
+    model_dict=None,
 ):
     """
     spec: the spec for generation (see generate.py for how to construct a spec)
@@ -269,8 +393,18 @@ def run(
     use_fast_schedule: since the per-box generation, after the steps for latent and attention transfer, is only used by SAM (which does not need to be precise), we skip steps after the steps needed for transfer with a fast schedule.
     use_ref_ca: Use reference cross attention to guide the cross attention in the overall generation
     use_autocast: enable automatic mixed precision (saves memory and makes generation faster)
+    model_dict: the loaded SD/SAM models to generate with (defaults to `models.model_dict`)
     Note: attention guidance is disabled for per-box generation by default (`max_index_step` set to 0) because we did not find it improving the results. Attention guidance and reference attention are still enabled for final guidance (overall generation). They greatly improve attribute binding compared to GLIGEN.
     """
+    if model_dict is None:
+        model_dict = models.model_dict
+    tokenizer, text_encoder, unet, scheduler, dtype = (
+        model_dict.tokenizer,
+        model_dict.text_encoder,
+        model_dict.unet,
+        model_dict.scheduler,
+        model_dict.dtype,
+    )
 
     frozen_step_ratio = min(max(frozen_step_ratio, 0.0), 1.0)
     frozen_steps = int(num_inference_steps * frozen_step_ratio)
@@ -435,6 +569,7 @@ def run(
                     fast_after_steps=fast_after_steps,
                     fast_rate=2,
                     verbose=verbose,
+                    model_dict=model_dict,
                 )
             else:
                 # No per-box guidance
@@ -557,7 +692,7 @@ def run(
             # TODO: It seems like there are some bugs
             print(f"Final prompt: {overall_prompt}")
             with torch.autocast("cuda", enabled=use_autocast):
-                _, images, _ = pipelines.generate_gligen_final(
+                _, images = pipelines.generate_gligen_final(
                     model_dict,
                     composed_latents,
                     overall_input_embeddings,
@@ -573,7 +708,8 @@ def run(
                     frozen_steps=frozen_steps,
                     frozen_mask=frozen_mask,
                     initial_bg=None,
-                    return_saved_cross_attn=True,
+                    # The attention maps of the final pass are not used, so none are saved
+                    return_saved_cross_attn=False,
                 )
 
             return EasyDict(image=images[0], so_img_list=so_img_list, final_prompt=overall_prompt)
@@ -592,8 +728,8 @@ def run(
             overall_negative_prompt = DEFAULT_OVERALL_NEGATIVE_PROMPT
         overall_input_embeddings = models.encode_prompts(
             prompts=[prompt],
-            tokenizer=models.model_dict.tokenizer,
-            text_encoder=models.model_dict.text_encoder,
+            tokenizer=tokenizer,
+            text_encoder=text_encoder,
             negative_prompt=overall_negative_prompt,
             one_uncond_input_only=False,
         )
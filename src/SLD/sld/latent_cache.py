@@ -0,0 +1,111 @@
+import os
+import json
+import hashlib
+from collections import OrderedDict
+
+import numpy as np
+import torch
+
+
+class InversionCache:
+    """
+    LRU cache of DDIM inversion trajectories (all time steps of `pipelines.invert`).
+
+    Entries live in memory (up to `max_memory_items`) and, if `cache_dir` is set, on disk as `.npy` files
+    that are memory-mapped on load. The disk cache is trimmed to `max_disk_gb` by evicting the least
+    recently used files. Trajectories are stored in the dtype they are computed in, unless `storage_dtype`
+    is set (e.g. torch.float16, to halve memory and disk use at the cost of precision); they are then always
+    returned after that round trip, so a cached and a freshly computed inversion give identical results.
+    Every call returns its own copy, so callers may modify it without touching the cached entry.
+    """
+
+    def __init__(self, cache_dir=None, max_memory_items=8, max_disk_gb=20.0, storage_dtype=None):
+        self.cache_dir = cache_dir
+        self.max_memory_items = max_memory_items
+        self.max_disk_bytes = int(max_disk_gb * 1024**3)
+        self.storage_dtype = storage_dtype
+        self.memory = OrderedDict()
+        self.hits, self.misses = 0, 0
+        if cache_dir:
+            os.makedirs(cache_dir, exist_ok=True)
+
+    @staticmethod
+    def make_key(img_np, inv_seed, prompt, negative_prompt, num_inference_steps, guidance_scale, model_key, scheduler):
+        """
+        img_np: the image to invert (uint8 numpy array)
+        prompt, negative_prompt, model_key: identify the prompt embedding used for the inversion
+        scheduler: the inverse scheduler (its class and config are part of the key)
+        """
+        img_np = np.ascontiguousarray(img_np)
+        image_hash = hashlib.sha256(img_np.tobytes()).hexdigest()
+        embedding_id = hashlib.sha256(f"{model_key}\0{prompt}\0{negative_prompt}".encode()).hexdigest()
+        scheduler_id = f"{type(scheduler).__name__}:{json.dumps(dict(scheduler.config), sort_keys=True, default=str)}"
+        payload = json.dumps(
+            [image_hash, list(img_np.shape), int(inv_seed), embedding_id, int(num_inference_steps), float(guidance_scale), scheduler_id]
+        )
+        return hashlib.sha256(payload.encode()).hexdigest()
+
+    def _stored_key(self, key, dtype):
+        # Trajectories stored in different dtypes are different entries
+        return f"{key}_{str(self.storage_dtype or dtype).replace('torch.', '')}"
+
+    def _path(self, stored_key):
+        return os.path.join(self.cache_dir, f"{stored_key}.npy")
+
+    def get(self, key, dtype=torch.float32):
+        key = self._stored_key(key, dtype)
+        if key in self.memory:
+            self.memory.move_to_end(key)
+            self.hits += 1
+            return self.memory[key].to(dtype, copy=True)
+
+        if self.cache_dir and os.path.isfile(self._path(key)):
+            path = self._path(key)
+            # Copy-on-write mapping: pages are read from the file when the trajectory is used
+            latents = torch.from_numpy(np.load(path, mmap_mode="c"))
+            # Refresh the access time used for LRU eviction on disk
+            os.utime(path)
+            self._remember(key, latents)
+            self.hits += 1
+            return latents.to(dtype, copy=True)
+
+        self.misses += 1
+        return None
+
+    def put(self, key, latents):
+        """Store a trajectory and return it as it will be read back from the cache."""
+        dtype = latents.dtype
+        key = self._stored_key(key, dtype)
+        latents = latents.detach().cpu().to(self.storage_dtype or dtype)
+        self._remember(key, latents)
+
+        if self.cache_dir:
+            path = self._path(key)
+            tmp_path = f"{path}.{os.getpid()}.tmp.npy"
+            arr = np.lib.format.open_memmap(tmp_path, mode="w+", dtype=latents.numpy().dtype, shape=tuple(latents.shape))
+            arr[...] = latents.numpy()
+            arr.flush()
+            del arr
+            os.replace(tmp_path, path)
+            self._evict_disk()
+
+        return latents.to(dtype, copy=True)
+
+    def _remember(self, key, latents):
+        self.memory[key] = latents
+        self.memory.move_to_end(key)
+        while len(self.memory) > self.max_memory_items:
+            self.memory.popitem(last=False)
+
+    def _evict_disk(self):
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            if name.endswith(".npy") and ".tmp" not in name:
+                stat = os.stat(os.path.join(self.cache_dir, name))
+                entries.append((stat.st_mtime, stat.st_size, name))
+        total = sum(size for _, size, _ in entries)
+        for _, size, name in sorted(entries):
+            if total <= self.max_disk_bytes:
+                break
+            os.remove(os.path.join(self.cache_dir, name))
+            total -= size
@@ -4,25 +4,61 @@ from diffusers import StableDiffusionXLImg2ImgPipeline
 import os
 import time
 
-def sdxl_refine(prompt, input_fname, output_fname, evaluation_folder, save_file_name):
-    torch.set_float32_matmul_precision("high")
-    pipe = StableDiffusionXLImg2ImgPipeline.from_pretrained(
-        "stabilityai/stable-diffusion-xl-refiner-1.0",
-        torch_dtype=torch.float32,
-    )
-
-    pipe = pipe.to("cuda")
-
-    init_image = Image.open(input_fname)
-    init_image = init_image.resize((1024, 1024), Image.LANCZOS)
-    image = pipe(
-        prompt,
-        image=init_image,
-        strength=0.3,
-        aesthetic_score=7.0,
-        num_inference_steps=50,
-    ).images
-    image[0].save(output_fname)
-
-    # Save the image to the evaluation folder
-    image[0].save(os.path.join(evaluation_folder, f"{save_file_name}.png"))
\ No newline at end of file
+REFINER_DTYPES = {"fp32": torch.float32, "fp16": torch.float16, "bf16": torch.bfloat16}
+
+
+class SDXLRefiner:
+    """
+    Resident SDXL refiner: the img2img pipeline is loaded once and reused for every call.
+
+    dtype: "fp32", "fp16" or "bf16". The SDXL VAE config sets `force_upcast`, so the VAE still runs in fp32
+    for the half precision variants and the decoded images do not overflow.
+    batch_size: maximum number of (prompt, image) pairs denoised together by `refine_files`
+    """
+
+    def __init__(self, dtype="fp32", device="cuda", batch_size=4):
+        torch.set_float32_matmul_precision("high")
+        self.pipe = StableDiffusionXLImg2ImgPipeline.from_pretrained(
+            "stabilityai/stable-diffusion-xl-refiner-1.0",
+            torch_dtype=REFINER_DTYPES[dtype],
+            variant="fp16" if dtype == "fp16" else None,
+        )
+        self.pipe = self.pipe.to(device)
+        self.batch_size = batch_size
+
+    def refine(self, prompts, images):
+        """Refine a batch of PIL images in one denoising pass; returns the refined images in order."""
+        images = [image.resize((1024, 1024), Image.LANCZOS) for image in images]
+        return self.pipe(
+            prompts,
+            image=images,
+            strength=0.3,
+            aesthetic_score=7.0,
+            num_inference_steps=50,
+        ).images
+
+    def refine_files(self, jobs):
+        """
+        jobs: list of (prompt, input_fname, output_fname, evaluation_folder, save_file_name), as for `sdxl_refine`.
+        Every refined image is written to its output file and to the evaluation folder.
+        """
+        for start in range(0, len(jobs), self.batch_size):
+            batch = jobs[start : start + self.batch_size]
+            images = self.refine([job[0] for job in batch], [Image.open(job[1]) for job in batch])
+            for (_, _, output_fname, evaluation_folder, save_file_name), image in zip(batch, images):
+                image.save(output_fname)
+
+                # Save the image to the evaluation folder
+                image.save(os.path.join(evaluation_folder, f"{save_file_name}.png"))
+
+
+def load_sdxl_refiner(dtype="fp32", device="cuda", batch_size=4):
+    return SDXLRefiner(dtype=dtype, device=device, batch_size=batch_size)
+
+
+def sdxl_refine(prompt, input_fname, output_fname, evaluation_folder, save_file_name, pipe=None):
+    # Pass a resident `pipe` (see `load_sdxl_refiner`) to avoid reloading the refiner on every call
+    if pipe is None:
+        pipe = load_sdxl_refiner()
+
+    pipe.refine_files([(prompt, input_fname, output_fname, evaluation_folder, save_file_name)])
@@ -4,6 +4,7 @@ import torch
 import numpy as np
 from models import sam
 from models import pipelines
+from utils.nms import nms, class_aware_nms_torch  # re-exported, see `utils.nms`
 
 
 DEFAULT_SO_NEGATIVE_PROMPT = "artifacts, blurry, smooth texture, bad quality, distortions, unrealistic, distorted image, bad proportions, duplicate, two, many, group, occlusion, occluded, side, border, collate"
@@ -11,12 +12,15 @@ DEFAULT_OVERALL_NEGATIVE_PROMPT = "artifacts, blurry, smooth texture, bad qualit
 
 
 
+# Optional `sld.latent_cache.InversionCache`, set by the SLD engine
+inversion_cache = None
+
+
 def get_all_latents(img_np, models, inv_seed=1):
-    generator = torch.cuda.manual_seed(inv_seed)
-    cln_latents = pipelines.encode(models.model_dict, img_np, generator)
     # Magic prompt
     # Have tried using the parsed bg prompt from the LLM, but it doesn't work well
     prompt = "A realistic photo of a scene"
+    num_inference_steps, guidance_scale = 50, 2.5
     input_embeddings = models.encode_prompts(
         prompts=[prompt],
         tokenizer=models.model_dict.tokenizer,
@@ -24,36 +28,64 @@ def get_all_latents(img_np, models, inv_seed=1):
         negative_prompt=DEFAULT_OVERALL_NEGATIVE_PROMPT,
         one_uncond_input_only=False,
     )
+
+    generator = torch.cuda.manual_seed(inv_seed)
+    if inversion_cache is not None:
+        cache_key = inversion_cache.make_key(
+            img_np,
+            inv_seed,
+            prompt,
+            DEFAULT_OVERALL_NEGATIVE_PROMPT,
+            num_inference_steps,
+            guidance_scale,
+            models.sd_key,
+            models.model_dict.inverse_scheduler,
+        )
+        all_latents = inversion_cache.get(cache_key, dtype=models.model_dict.dtype)
+        if all_latents is not None:
+            # Re-seeded on both paths: a miss draws from the generator, so the CUDA RNG state after the
+            # call would otherwise depend on the cache state
+            torch.cuda.manual_seed(inv_seed)
+            return all_latents, input_embeddings
+
+    cln_latents = pipelines.encode(models.model_dict, img_np, generator)
     # Get all hidden latents
     all_latents = pipelines.invert(
         models.model_dict,
         cln_latents,
         input_embeddings,
-        num_inference_steps=50,
-        guidance_scale=2.5,
+        num_inference_steps=num_inference_steps,
+        guidance_scale=guidance_scale,
     )
+    if inversion_cache is not None:
+        all_latents = inversion_cache.put(cache_key, all_latents)
+        torch.cuda.manual_seed(inv_seed)
     return all_latents, input_embeddings
 
 
-def run_sam(bbox, image_source, models):
+def run_sam_batch(bboxes, image_source, models):
+    """
+    Segments several (x, y, w, h) normalized boxes of the same image. The image is encoded once
+    (see `sam.SamSession`) and all boxes are decoded together; returns one (H, W, 3) mask per box.
+    """
     H, W, _ = image_source.shape
-    box_xyxy = torch.Tensor(
+    boxes_xyxy = torch.Tensor(
         [
-            bbox[0],
-            bbox[1],
-            bbox[2] + bbox[0],
-            bbox[3] + bbox[1],
+            [
+                bbox[0],
+                bbox[1],
+                bbox[2] + bbox[0],
+                bbox[3] + bbox[1],
+            ]
+            for bbox in bboxes
         ]
     ) * torch.Tensor([W, H, W, H])
-    box_xyxy = box_xyxy.unsqueeze(0).unsqueeze(0)
-    masks, _ = sam.sam(
-        models.model_dict,
-        image_source,
-        input_boxes=box_xyxy,
-        target_mask_shape=(H, W),
-    )
-    masks = masks[0][0].transpose(1, 2, 0).astype(bool)
-    return masks
+    masks, _ = models.model_dict.sam_session.sam_boxes(image_source, boxes_xyxy, target_mask_shape=(H, W))
+    return [mask.transpose(1, 2, 0).astype(bool) for mask in masks]
+
+
+def run_sam(bbox, image_source, models):
+    return run_sam_batch([bbox], image_source, models)[0]
 
 
 def run_sam_postprocess(remove_mask, H, W, config):
@@ -120,90 +152,6 @@ def resize_image(image, region_a_param, region_b_param):
     return new_img, new_param
 
 
-def nms(
-    bounding_boxes,
-    confidence_score,
-    labels,
-    threshold,
-    input_in_pixels=False,
-    return_array=True,
-):
-    """
-    This NMS processes boxes of all labels. It not only removes the box with the same label.
-
-    Adapted from https://github.com/amusi/Non-Maximum-Suppression/blob/master/nms.py
-    """
-    # If no bounding boxes, return empty list
-    if len(bounding_boxes) == 0:
-        return np.array([]), np.array([]), np.array([])
-
-    # Bounding boxes
-    boxes = np.array(bounding_boxes)
-
-    # coordinates of bounding boxes
-    start_x = boxes[:, 0]
-    start_y = boxes[:, 1]
-    end_x = boxes[:, 2]
-    end_y = boxes[:, 3]
-
-    # Confidence scores of bounding boxes
-    score = np.array(confidence_score)
-
-    # Picked bounding boxes
-    picked_boxes = []
-    picked_score = []
-    picked_labels = []
-
-    # Compute areas of bounding boxes
-    if input_in_pixels:
-        areas = (end_x - start_x + 1) * (end_y - start_y + 1)
-    else:
-        areas = (end_x - start_x) * (end_y - start_y)
-
-    # Sort by confidence score of bounding boxes
-    order = np.argsort(score)
-
-    # Iterate bounding boxes
-    while order.size > 0:
-        # The index of largest confidence score
-        index = order[-1]
-
-        # Pick the bounding box with largest confidence score
-        picked_boxes.append(bounding_boxes[index])
-        picked_score.append(confidence_score[index])
-        picked_labels.append(labels[index])
-
-        # Compute ordinates of intersection-over-union(IOU)
-        x1 = np.maximum(start_x[index], start_x[order[:-1]])
-        x2 = np.minimum(end_x[index], end_x[order[:-1]])
-        y1 = np.maximum(start_y[index], start_y[order[:-1]])
-        y2 = np.minimum(end_y[index], end_y[order[:-1]])
-
-        # Compute areas of intersection-over-union
-        if input_in_pixels:
-            w = np.maximum(0.0, x2 - x1 + 1)
-            h = np.maximum(0.0, y2 - y1 + 1)
-        else:
-            w = np.maximum(0.0, x2 - x1)
-            h = np.maximum(0.0, y2 - y1)
-        intersection = w * h
-
-        # Compute the ratio between intersection and union
-        ratio = intersection / (areas[index] + areas[order[:-1]] - intersection)
-
-        left = np.where(ratio < threshold)
-        order = order[left]
-
-    if return_array:
-        picked_boxes, picked_score, picked_labels = (
-            np.array(picked_boxes),
-            np.array(picked_score),
-            np.array(picked_labels),
-        )
-
-    return picked_boxes, picked_score, picked_labels
-
-
 def post_process(box):
     new_box = []
     for item in box:
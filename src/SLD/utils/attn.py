@@ -6,17 +6,75 @@ import torch.nn.functional as F
 import math
 import utils
 
+class AttnAccumulator:
+    """
+    Running mean of cross-attention maps over the denoising steps, updated in place by the attention processor (pass it as `attn_accumulator` in `cross_attention_kwargs`).
+    Only one map per key is kept, regardless of the number of steps.
+
+    keys: attention keys to accumulate (all cross-attention keys if None)
+    token_ids: text token columns to keep (all tokens if None)
+    step_start, step_end: the steps (as set by `set_step`) to average over, `step_end` is exclusive (no end if None)
+    cond_only: keep the cond half of the batch only
+    head_mean: average over heads (the head dimension is kept with size 1)
+    """
+    def __init__(self, keys=None, token_ids=None, step_start=10, step_end=None, cond_only=False, head_mean=False):
+        self.keys = None if keys is None else [tuple(key) for key in keys]
+        self.token_ids = None if token_ids is None else torch.as_tensor(token_ids, dtype=torch.long).flatten()
+        self.step_start, self.step_end = step_start, step_end
+        self.cond_only, self.head_mean = cond_only, head_mean
+        self.step = 0
+        self.means, self.counts = {}, {}
+
+    def set_step(self, step):
+        self.step = step
+
+    def wants(self, attn_key):
+        in_window = self.step >= self.step_start and (self.step_end is None or self.step < self.step_end)
+        return in_window and (self.keys is None or tuple(attn_key) in self.keys)
+
+    @torch.no_grad()
+    def update(self, attn_key, attn):
+        """ attn: (batch, heads, flattened 2d, text tokens) """
+        if self.token_ids is not None:
+            attn = attn[..., self.token_ids.to(attn.device)]
+        if self.cond_only:
+            attn = attn[attn.shape[0] // 2:]
+        if self.head_mean:
+            attn = attn.mean(dim=1, keepdim=True)
+        attn_key = tuple(attn_key)
+        attn = attn.float()
+        if attn_key not in self.means:
+            self.means[attn_key], self.counts[attn_key] = attn.clone(), 1
+        else:
+            self.counts[attn_key] += 1
+            self.means[attn_key].add_((attn - self.means[attn_key]) / self.counts[attn_key])
+
+    def mean(self, attn_key):
+        return self.means[tuple(attn_key)]
+
+    def column(self, token_id):
+        """ Index of `token_id` in the accumulated maps """
+        if self.token_ids is None:
+            return token_id
+        return self.token_ids.tolist().index(token_id)
+
+
 def get_token_attnv2(token_id, saved_attns, attn_key, attn_aggregation_step_start=10, input_ca_has_condition_only=False, return_np=False):
     """
-    saved_attns: a list of saved_attn (list is across timesteps)
+    saved_attns: a list of saved_attn (list is across timesteps), or an `AttnAccumulator` (the step window is the one of the accumulator and `attn_aggregation_step_start` is ignored)
     
     moves to cpu by default
     """
-    saved_attns = saved_attns[attn_aggregation_step_start:]    
+    if isinstance(saved_attns, AttnAccumulator):
+        attn = saved_attns.mean(attn_key).cpu()
+        token_id = saved_attns.column(token_id)
+        input_ca_has_condition_only = input_ca_has_condition_only or saved_attns.cond_only
+    else:
+        saved_attns = saved_attns[attn_aggregation_step_start:]    
 
-    saved_attns = [saved_attn[attn_key].cpu() for saved_attn in saved_attns]
-    
-    attn = torch.stack(saved_attns, dim=0).mean(dim=0)
+        saved_attns = [saved_attn[attn_key].cpu() for saved_attn in saved_attns]
+        
+        attn = torch.stack(saved_attns, dim=0).mean(dim=0)
     
     # print("attn shape", attn.shape)
     
@@ -208,9 +208,9 @@ def latent_backward_guidance_boxdiff(scheduler, unet, cond_embeddings, index, bb
         latent_model_input = scheduler.scale_model_input(latent_model_input, t)
 
         unet(latent_model_input, t, encoder_hidden_states=cond_embeddings,
-             return_cross_attention_probs=False, cross_attention_kwargs=full_cross_attention_kwargs)
+             return_cross_attention_probs=False, cross_attention_kwargs=full_cross_attention_kwargs,
+             stop_after_attn_keys=guidance_attn_keys)
 
-        # TODO: could return the attention maps for the required blocks only and not necessarily the final output
         # update latents with guidance
         loss = compute_ca_loss_boxdiff(saved_attn=saved_attn, bboxes=bboxes, object_positions=object_positions, guidance_attn_keys=guidance_attn_keys,
                                        ref_ca_saved_attns=ref_ca_saved_attns, index=index, verbose=verbose, **kwargs) * amp_loss_scale
@@ -5,10 +5,19 @@ from collections.abc import Iterable
 import warnings
 
 import utils
+from utils.text_cache import text_embedding_cache
 
 
 # A list mapping: prompt index to str (prompt in a list of token str)
 def get_token_map(tokenizer, prompt, verbose=False, padding="do_not_pad"):
+    if not verbose:
+        return text_embedding_cache.token_map(
+            tokenizer, prompt, padding, lambda: _get_token_map(tokenizer, prompt, padding=padding)
+        )
+    return _get_token_map(tokenizer, prompt, verbose=verbose, padding=padding)
+
+
+def _get_token_map(tokenizer, prompt, verbose=False, padding="do_not_pad"):
     fg_prompt_tokens = tokenizer(
         [prompt], padding=padding, max_length=77, return_tensors="np"
     )
@@ -125,6 +134,31 @@ def get_phrase_indices(
     return object_positions
 
 
+def get_token_columns(object_positions, word_token_indices=None, token_indices=None):
+    """
+    The losses below only read the attention columns of the object (and word) tokens. Passing `token_indices` as `return_token_ca_only` saves only these columns.
+    `token_indices` (sorted token positions) is computed from `object_positions` and `word_token_indices` if not given.
+    Returns `token_indices` and `object_positions` and `word_token_indices` remapped to index the saved columns, so the losses can be used unchanged.
+    """
+    if token_indices is None:
+        positions = [position for positions in object_positions for position in positions]
+        if word_token_indices is not None:
+            positions += [position for position in word_token_indices if position is not None]
+        token_indices = torch.tensor(sorted(set(positions)), dtype=torch.long)
+
+    columns = {position: column for column, position in enumerate(token_indices.tolist())}
+    object_positions = [
+        [columns[position] for position in positions] for positions in object_positions
+    ]
+    if word_token_indices is not None:
+        word_token_indices = [
+            columns[position] if position is not None else None
+            for position in word_token_indices
+        ]
+
+    return token_indices, object_positions, word_token_indices
+
+
 def add_ca_loss_per_attn_map_to_loss(
     loss,
     attn_map,
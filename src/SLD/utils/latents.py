@@ -35,6 +35,44 @@ def get_scaled_latents(
     return latents_base
 
 
+class LatentTrajectoryRecorder:
+    """
+    Records the latents of a denoising (or inversion) loop into a preallocated host buffer.
+    The device-to-host copies are issued on a side stream into pinned memory, so the loop does not wait for them.
+
+    num_steps: number of latents in the full trajectory (number of steps + 1, the initial latents are step 0)
+    steps: the steps to keep (all steps if None). With a prefix of the steps (e.g., the frozen steps), the returned trajectory is indexed the same way as the full one.
+    """
+
+    def __init__(self, num_steps, latents, steps=None):
+        self.steps = list(range(num_steps)) if steps is None else sorted(set(steps))
+        self.slots = {step: slot for slot, step in enumerate(self.steps)}
+        use_cuda = latents.is_cuda
+        self.buffer = torch.empty(
+            (len(self.steps), *latents.shape), dtype=latents.dtype, pin_memory=use_cuda
+        )
+        self.stream = torch.cuda.Stream(device=latents.device) if use_cuda else None
+
+    def record(self, step, latents):
+        if step not in self.slots:
+            return
+        target = self.buffer[self.slots[step]]
+        if self.stream is None:
+            target.copy_(latents)
+            return
+        # The copy starts once the latents are computed and the memory of `latents` is not reused before the copy is done
+        self.stream.wait_stream(torch.cuda.current_stream(latents.device))
+        with torch.cuda.stream(self.stream):
+            target.copy_(latents, non_blocking=True)
+        latents.record_stream(self.stream)
+
+    def get(self):
+        """ Waits for the pending copies and returns the trajectory: (number of kept steps, *latents.shape) on cpu """
+        if self.stream is not None:
+            self.stream.synchronize()
+        return self.buffer
+
+
 def blend_latents(latents_bg, latents_fg, fg_mask, fg_blending_ratio=0.01):
     """
     in_channels: often obtained with `unet.config.in_channels`
@@ -91,47 +129,72 @@ def compose_latents(
     # Other than t=T (idx=0), we only have masked latents. This is to prevent accidentally loading from non-masked part. Use same mask as the one used to compose the latents.
     if use_fast_schedule:
         # If we use fast schedule, we only compose the frozen steps because the later steps do not match.
-        composed_latents = torch.zeros(
-            (fast_after_steps + 1, *latents_bg.shape), dtype=dtype
-        )
+        num_steps = fast_after_steps + 1
     else:
         # Otherwise we compose all steps so that we don't need to compose again if we change the frozen steps.
-        composed_latents = torch.zeros((latents_bg.shape), dtype=dtype)
-        # composed_latents = latents_bg
+        num_steps = latents_bg.shape[0]
+
+    composed_latents, foreground_indices = compose_latents_with_bg(
+        latents_all_list, mask_tensor_list, latents_bg[:num_steps], dtype
+    )
+
+    composed_latents, foreground_indices = composed_latents.to(
+        torch_device
+    ), foreground_indices.to(torch_device)
+    return composed_latents, foreground_indices
+
+
+def get_priority_label_map(mask_tensor_list, mask_order):
+    """
+    Returns a (H, W) map with, at every position, the index (in `mask_tensor_list`) of the last mask in `mask_order` that covers it, or `len(mask_tensor_list)` if no mask covers it.
+    """
+    num_masks = len(mask_tensor_list)
+    masks = torch.stack([mask_tensor_list[mask_idx].bool().cpu() for mask_idx in mask_order], dim=0)
+    # Later masks in the order have higher priority
+    priorities = torch.arange(1, num_masks + 1).view(num_masks, 1, 1)
+    top_priority, top_rank = (masks.long() * priorities).max(dim=0)
+    order = torch.as_tensor(np.asarray(mask_order), dtype=torch.long)
+    return torch.where(top_priority > 0, order[top_rank], torch.full_like(top_rank, num_masks))
+
+
+def compose_latents_by_label_map(latents_stack, label_map):
+    """
+    latents_stack: (N, T, ..., H, W), the latent trajectories of N sources
+    label_map: (H, W), the source index of every position
+    Returns the (T, ..., H, W) composition with one gather.
+    """
+    index = label_map.to(latents_stack.device).view(
+        1, *([1] * (latents_stack.dim() - 3)), *label_map.shape
+    )
+    index = index.expand(1, *latents_stack.shape[1:])
+    return torch.gather(latents_stack, 0, index)[0]
 
-    foreground_indices = torch.zeros(latents_bg.shape[-2:], dtype=torch.long)
+
+def compose_latents_with_bg(latents_all_list, mask_tensor_list, latents_bg, dtype):
+    """
+    Composes the trajectories in `latents_all_list` with their masks (the largest mask first, so smaller masks stay on top) and fills the rest with `latents_bg`.
+    Returns the composed latents (on the device of `latents_bg`) and the union of the masks.
+    """
+    num_steps, device = latents_bg.shape[0], latents_bg.device
+    if not len(mask_tensor_list):
+        return latents_bg.to(dtype), torch.zeros(latents_bg.shape[-2:], dtype=torch.bool)
 
     mask_size = np.array([mask_tensor.sum().item() for mask_tensor in mask_tensor_list])
 
     # Compose the largest mask first
     mask_order = np.argsort(-mask_size)
 
-    existing_objects = torch.zeros(latents_bg.shape[-2:], dtype=torch.bool)
-    # print(len(mask_order))
-    # exit()
-    for idx, mask_idx in enumerate(mask_order):
-        latents_all, mask_tensor = (
-            latents_all_list[mask_idx],
-            mask_tensor_list[mask_idx],
-        )
-
-        mask_tensor_expanded = mask_tensor[None, None, None, ...].repeat(51, 1, 4, 1, 1)
-        composed_latents[mask_tensor_expanded == 1] = latents_all[
-            mask_tensor_expanded == 1
-        ]
-        existing_objects |= mask_tensor
+    label_map = get_priority_label_map(mask_tensor_list, mask_order)
 
-    existing_objects_expanded = existing_objects[None, None, None, ...].repeat(
-        51, 1, 4, 1, 1
+    # The last source (index `len(mask_tensor_list)`) is the background
+    latents_stack = torch.stack(
+        [latents_all[:num_steps].to(device, dtype) for latents_all in latents_all_list]
+        + [latents_bg.to(dtype)],
+        dim=0,
     )
-    composed_latents[existing_objects_expanded == 0] = latents_bg.cpu()[
-        existing_objects_expanded == 0
-    ]
+    composed_latents = compose_latents_by_label_map(latents_stack, label_map)
 
-    composed_latents, foreground_indices = composed_latents.to(
-        torch_device
-    ), existing_objects.to(torch_device)
-    return composed_latents, foreground_indices
+    return composed_latents, label_map != len(mask_tensor_list)
 
 
 def align_with_bboxes(
@@ -240,6 +303,70 @@ def inverse_warp(A, roi_A, B, roi_B_target, seg_map):
     return B, new_mask
 
 
+def get_box_affine(old_box, new_box, width=64):
+    """
+    Affine matrix (3x3, latent pixels) that scales `old_box` uniformly to fit `new_box` and aligns the top-left corners.
+    This is the move the image-level resize + re-inversion used to perform. Boxes are normalized [x, y, w, h].
+    """
+    scale = min(new_box[2] / old_box[2], new_box[3] / old_box[3])
+    return np.array(
+        [
+            [scale, 0.0, (new_box[0] - scale * old_box[0]) * width],
+            [0.0, scale, (new_box[1] - scale * old_box[1]) * width],
+            [0.0, 0.0, 1.0],
+        ]
+    )
+
+
+def get_latent_affine(matrix, seg_map):
+    """
+    Converts a transformation in normalized image coordinates about the object center (the math model's
+    matrix, see `utils_pose.sld_adapter`) to latent pixels about the center of `seg_map`'s bounding box.
+    """
+    h, w = seg_map.shape
+    ys, xs = np.nonzero(seg_map)
+    x_center, y_center = (xs.min() + xs.max() + 1) / 2, (ys.min() + ys.max() + 1) / 2
+
+    to_latent = np.diag([w, h, 1.0])
+    to_center = np.array([[1.0, 0.0, x_center], [0.0, 1.0, y_center], [0.0, 0.0, 1.0]])
+    matrix = to_latent @ np.asarray(matrix, dtype=np.float64) @ np.linalg.inv(to_latent)
+    return to_center @ matrix @ np.linalg.inv(to_center)
+
+
+def warp_latents_affine(all_latents, seg_map, matrix):
+    """
+    Warps the masked object of a latent trajectory with an affine matrix, all timesteps in one `grid_sample`.
+
+    all_latents: (num_steps, 1, 4, h, w)
+    seg_map: (h, w) object mask
+    matrix: 3x3 forward (source -> target) transformation in latent pixels
+
+    Nearest sampling keeps the statistics of the noisy latents (bilinear would average the noise down).
+    Returns the trajectory with the warped object pasted in and the warped mask.
+    """
+    num_steps, _, channels, h, w = all_latents.shape
+    device = all_latents.device
+
+    # Target pixel centers mapped back to the source, in `grid_sample` coordinates (align_corners=False)
+    inverse = torch.from_numpy(np.linalg.inv(np.asarray(matrix, dtype=np.float64))).float().to(device)
+    ys, xs = torch.meshgrid(
+        torch.arange(h, device=device, dtype=torch.float32) + 0.5,
+        torch.arange(w, device=device, dtype=torch.float32) + 0.5,
+        indexing="ij",
+    )
+    coords = torch.stack([xs, ys, torch.ones_like(xs)], dim=-1) @ inverse.T
+    grid = torch.stack([coords[..., 0] / w * 2 - 1, coords[..., 1] / h * 2 - 1], dim=-1)[None]
+
+    seg_map = torch.as_tensor(np.asarray(seg_map), device=device).float()[None, None]
+    new_mask = F.grid_sample(seg_map, grid, mode="nearest", align_corners=False)[0, 0] > 0.5
+
+    latents = all_latents.reshape(num_steps, channels, h, w).float()
+    warped = F.grid_sample(latents, grid.expand(num_steps, -1, -1, -1), mode="nearest", align_corners=False)
+    new_latents = torch.where(new_mask, warped, latents).to(all_latents.dtype).unsqueeze(1)
+
+    return new_latents, new_mask.cpu()
+
+
 def plot_feat(tensor_data, fname):
     import matplotlib.pyplot as plt
 
@@ -313,44 +440,13 @@ def compose_latents_with_alignment(
     # latents_all_list.append(latents_bg_lists)
     # mask_tensor_list.append(bg_mask)
 
-    for obj_name, old_obj, new_obj, seg_map, all_latents in move_objects:
-        # print(all_latents.shape)
-        # exit()
-        # x_min_old, x_max_old, y_min_old, y_max_old
-        old_coords = coord_transform(old_obj, 64)
-        # x_min_new, x_max_new, y_min_new, y_max_new
-        new_coords = coord_transform(new_obj, 64)
-        new_latents = all_latents.clone()
-        new_latents, new_mask = inverse_warp(
-            all_latents, old_coords, new_latents, new_coords, seg_map
-        )
-        # plot_feat(new_latents[-1], "feat_after.png")
-        # plot_feat(all_latents[-1], "feat_before.png")
-        # plot_feat(new_latents[-1], "feat_after.png")
-        # exit()
-        # print(new_latents.shape)
-        # print(latents_bg_lists.shape)
-        # print(new_mask.shape)
-        # import pdb
-
-        # pdb.set_trace()
-        # new_latents[
-        #     :, :, :, y_min_new:y_max_new, x_min_new:x_max_new
-        # ] = latents_bg_lists[:, :, :, y_min_old:y_max_old, x_min_old:x_max_old]
-        # new_mask = torch.zeros((64, 64), dtype=bool)
-        # new_mask[y_min_new:y_max_new, x_min_new:x_max_new] = True
-        # plt.imsave((mew_latents[].cpu().numpy() * 255).astype(np.uint8)).save(
-        #     "new_mask.png"
-        # )
-        # Image.fromarray((new_mask.cpu().numpy() * 255).astype(np.uint8)).save(
-        #     "new_mask.png"
-        # )
-        # old_mask = torch.zeros((64, 64), dtype=bool)
-        # old_mask[y_min_old:y_max_old, x_min_old:x_max_old] = True
-        # Image.fromarray((old_mask.cpu().numpy() * 255).astype(np.uint8)).save(
-        #     "old_mask.png"
-        # )
-        # exit()
+    # Each moved object is the source image's own inversion, warped in latent space (no re-inversion per move)
+    for obj_name, old_obj, new_obj, seg_map, all_latents, matrix in move_objects:
+        if matrix is None:
+            matrix = get_box_affine(old_obj, new_obj, seg_map.shape[1])
+        else:
+            matrix = get_latent_affine(matrix, seg_map)
+        new_latents, new_mask = warp_latents_affine(all_latents, seg_map, matrix)
         latents_all_list.append(new_latents)
         mask_tensor_list.append(new_mask)
         # np.save()
@@ -367,10 +463,10 @@ def compose_latents_with_alignment(
         latents_all_list.append(latents)
         mask_tensor_list.append(torch.from_numpy(mask))
 
-    fg_mask_union = torch.zeros((64, 64), dtype=bool)
-    N = len(mask_tensor_list)
-    for i in range(N):
-        fg_mask_union |= mask_tensor_list[i]
+    if len(mask_tensor_list):
+        fg_mask_union = torch.stack([mask_tensor.bool() for mask_tensor in mask_tensor_list], dim=0).any(dim=0)
+    else:
+        fg_mask_union = torch.zeros((64, 64), dtype=bool)
     bg_mask = ~fg_mask_union
     bg_mask[original_remove == True] = False
     # Image.fromarray((bg_mask.cpu().numpy() * 255).astype(np.uint8)).save("bg_mask.png")
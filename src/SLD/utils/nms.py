@@ -0,0 +1,125 @@
+"""
+Vectorized NMS shared by the detector (`sld.detector`) and the evaluation (`eval.eval`), in NumPy and in torch.
+
+The picks and their order match the loop implementation this replaces: boxes are visited by descending score
+and a box is dropped once its IoU with a kept box reaches the threshold. Class-aware NMS shifts the boxes of
+each label apart so that all labels are handled by one IoU matrix; its output is ordered by label.
+"""
+import numpy as np
+import torch
+
+
+def _suppression_matrix_numpy(boxes, threshold, input_in_pixels):
+    # suppresses[i, j]: box i (ranked higher) removes box j if i is kept
+    extra = 1.0 if input_in_pixels else 0.0
+    areas = (boxes[:, 2] - boxes[:, 0] + extra) * (boxes[:, 3] - boxes[:, 1] + extra)
+    top_left = np.maximum(boxes[:, None, :2], boxes[None, :, :2])
+    bottom_right = np.minimum(boxes[:, None, 2:], boxes[None, :, 2:])
+    intersection = np.maximum(0.0, bottom_right - top_left + extra).prod(-1)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        ratio = intersection / (areas[:, None] + areas[None, :] - intersection)
+    return np.triu(~(ratio < threshold), k=1)
+
+
+def _suppression_matrix_torch(boxes, threshold, input_in_pixels):
+    extra = 1.0 if input_in_pixels else 0.0
+    areas = (boxes[:, 2] - boxes[:, 0] + extra) * (boxes[:, 3] - boxes[:, 1] + extra)
+    top_left = torch.maximum(boxes[:, None, :2], boxes[None, :, :2])
+    bottom_right = torch.minimum(boxes[:, None, 2:], boxes[None, :, 2:])
+    intersection = (bottom_right - top_left + extra).clamp(min=0).prod(-1)
+    ratio = intersection / (areas[:, None] + areas[None, :] - intersection)
+    return torch.triu(~(ratio < threshold), diagonal=1)
+
+
+def _greedy_keep(suppresses, keep):
+    # Greedy NMS is the fixed point of this update: box j is final after at most j iterations
+    while True:
+        new_keep = ~(suppresses & keep[:, None]).any(0)
+        if (new_keep == keep).all():
+            return keep
+        keep = new_keep
+
+
+def _label_offsets(boxes, label_ids):
+    # Wide enough that boxes of different labels never touch, also with the +1 of pixel coordinates
+    span = boxes.max() - boxes.min() + 2
+    return label_ids[:, None] * span
+
+
+def nms_indices(boxes, scores, threshold, labels=None, input_in_pixels=False):
+    """
+    NumPy NMS on (N, 4) xyxy boxes. Returns the kept indices in pick order;
+    with `labels`, boxes only suppress boxes of the same label and the picks are grouped by label.
+    """
+    boxes, scores = np.asarray(boxes, dtype=np.float64), np.asarray(scores)
+    if len(boxes) == 0:
+        return np.zeros((0,), dtype=np.int64)
+
+    order = np.argsort(scores)[::-1]
+    if labels is not None:
+        _, label_ids = np.unique(np.asarray(labels), return_inverse=True)
+        label_ids = label_ids.reshape(-1)
+        order = order[np.argsort(label_ids[order], kind="stable")]
+        boxes = boxes + _label_offsets(boxes, label_ids.astype(np.float64))
+
+    suppresses = _suppression_matrix_numpy(boxes[order], threshold, input_in_pixels)
+    keep = _greedy_keep(suppresses, np.ones(len(order), dtype=bool))
+    return order[keep]
+
+
+def nms_indices_torch(boxes, scores, threshold, labels=None, input_in_pixels=False):
+    """Torch version of `nms_indices`; runs on the device of `boxes`."""
+    if boxes.shape[0] == 0:
+        return torch.zeros((0,), dtype=torch.long, device=boxes.device)
+
+    order = torch.argsort(scores, descending=True, stable=True)
+    if labels is not None:
+        _, label_ids = torch.unique(labels, return_inverse=True)
+        order = order[torch.argsort(label_ids[order], stable=True)]
+        boxes = boxes + _label_offsets(boxes, label_ids.to(boxes.dtype))
+
+    suppresses = _suppression_matrix_torch(boxes[order], threshold, input_in_pixels)
+    keep = _greedy_keep(suppresses, torch.ones(order.shape[0], dtype=torch.bool, device=boxes.device))
+    return order[keep]
+
+
+def nms(bounding_boxes, confidence_score, labels, threshold, input_in_pixels=False, return_array=True):
+    """
+    This NMS processes boxes of all labels. It not only removes the box with the same label.
+    """
+    # If no bounding boxes, return empty list
+    if len(bounding_boxes) == 0:
+        return np.array([]), np.array([]), np.array([])
+
+    keep = nms_indices(bounding_boxes, confidence_score, threshold, input_in_pixels=input_in_pixels)
+    picked_boxes = [bounding_boxes[i] for i in keep]
+    picked_score = [confidence_score[i] for i in keep]
+    picked_labels = [labels[i] for i in keep]
+
+    if return_array:
+        return np.array(picked_boxes), np.array(picked_score), np.array(picked_labels)
+    return picked_boxes, picked_score, picked_labels
+
+
+def class_aware_nms(bounding_boxes, confidence_score, labels, threshold, input_in_pixels=False):
+    """
+    This NMS processes boxes of each label individually.
+    """
+    # If no bounding boxes, return empty list
+    if len(bounding_boxes) == 0:
+        return np.array([]), np.array([]), np.array([])
+
+    keep = nms_indices(bounding_boxes, confidence_score, threshold, labels=labels, input_in_pixels=input_in_pixels)
+    return np.asarray(bounding_boxes)[keep], np.asarray(confidence_score)[keep], np.asarray(labels)[keep]
+
+
+def nms_torch(boxes, scores, labels, threshold, input_in_pixels=False):
+    """Tensor version of `nms`: returns the kept (boxes, scores, labels)."""
+    keep = nms_indices_torch(boxes, scores, threshold, input_in_pixels=input_in_pixels)
+    return boxes[keep], scores[keep], labels[keep]
+
+
+def class_aware_nms_torch(boxes, scores, labels, threshold, input_in_pixels=False):
+    """Tensor version of `class_aware_nms`: returns the kept (boxes, scores, labels), ordered by label."""
+    keep = nms_indices_torch(boxes, scores, threshold, labels=labels, input_in_pixels=input_in_pixels)
+    return boxes[keep], scores[keep], labels[keep]
@@ -0,0 +1,81 @@
+from collections import Counter, OrderedDict
+
+import torch
+
+
+class TextEmbeddingCache:
+    """
+    LRU cache of CLIP text encodings, shared by `models.encode_prompts`, `pipelines.prepare_gligen_condition`
+    and `guidance.get_phrase_indices` (token maps).
+
+    Entries are per text and keyed by (kind, text, tokenizer, text encoder, dtype), where kind tells apart the
+    per-token hidden states, the pooled GLIGEN phrase embeddings and token maps. Batches are looked up text by
+    text and only the missing texts are encoded, together. CLIP uses a causal mask, so the encoding of a text
+    does not depend on the other texts of the batch or on the padding after it.
+    """
+
+    def __init__(self, max_items=256):
+        self.max_items = max_items
+        self.entries = OrderedDict()
+        self.hits, self.misses = Counter(), Counter()
+
+    @staticmethod
+    def model_id(model):
+        # The name tells apart checkpoints; the object id tells apart two loads of the same checkpoint
+        config = getattr(model, "config", None)
+        name = getattr(model, "name_or_path", None) or getattr(config, "_name_or_path", "")
+        return f"{type(model).__name__}:{name}:{id(model)}"
+
+    def _get(self, key):
+        if key in self.entries:
+            self.entries.move_to_end(key)
+            self.hits[key[0]] += 1
+            return self.entries[key]
+        self.misses[key[0]] += 1
+        return None
+
+    def _put(self, key, value):
+        self.entries[key] = value
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_items:
+            self.entries.popitem(last=False)
+
+    def encode(self, kind, texts, tokenizer, text_encoder, encode_fn):
+        """
+        Returns the stacked encodings of `texts`; `encode_fn(missing_texts)` encodes the texts that are not
+        cached and returns one row per text.
+        """
+        prefix = (kind, self.model_id(tokenizer), self.model_id(text_encoder), str(text_encoder.dtype))
+        keys = [(kind, text) + prefix[1:] for text in texts]
+        rows = {key: self._get(key) for key in dict.fromkeys(keys)}
+
+        missing = [key for key, row in rows.items() if row is None]
+        if missing:
+            encoded = encode_fn([key[1] for key in missing])
+            for key, row in zip(missing, encoded):
+                rows[key] = row.detach()
+                self._put(key, rows[key])
+
+        return torch.stack([rows[key] for key in keys])
+
+    def token_map(self, tokenizer, text, padding, token_map_fn):
+        """Cached `token_map_fn()`, the token strings of `text` (see `guidance.get_token_map`)."""
+        key = ("token_map", text, self.model_id(tokenizer), padding)
+        token_map = self._get(key)
+        if token_map is None:
+            token_map = token_map_fn()
+            self._put(key, token_map)
+        return list(token_map)
+
+    def stats(self):
+        kinds = sorted(set(self.hits) | set(self.misses))
+        return {kind: {"hits": self.hits[kind], "misses": self.misses[kind]} for kind in kinds}
+
+    def clear(self):
+        self.entries.clear()
+        self.hits.clear()
+        self.misses.clear()
+
+
+# Process-wide cache used by the prompt encoding helpers
+text_embedding_cache = TextEmbeddingCache()
@@ -2,23 +2,28 @@ import os
 import logging
 import argparse
 from typing import Optional
-import subprocess
 import time
 
 import cv2
+import matplotlib
 import torch
 import numpy as np
 from tqdm import tqdm
 
 
+# The stages plot from worker threads, which needs a non-interactive backend
+matplotlib.use("Agg")
+
 # Custom utils imports
 from utils_pose.models import Models
 from utils_pose.open_cv_transformations import run_open_cv_transformations
 from utils_pose.sam_refiner import run_sam_refine
-from utils_pose.math_model import run_math_analysis
-from utils_pose.vlm_image_parser import parse_image, save_results_image_parse
-from utils_pose.sld_adapter import generate_sld_config
+from utils_pose.math_model import check_batch_equivalence, parse_detection_file, run_math_analysis_batch
+from utils_pose.vlm_image_parser import parse_images, save_results_image_parse
+from utils_pose.sld_adapter import SLD_DIR, generate_sld_config, get_sld_engine, run_sld
 from utils_pose.grounding_dino_refiner import run_grounding_dino_refine
+from utils_pose.stage_pipeline import Stage, StagePipeline
+from utils_pose.stage_cache import StageCache, file_digest
 
 os.environ["CUDA_DEVICE_ORDER"] = "PCI_BUS_ID"
 
@@ -48,51 +53,6 @@ def setup_logging() -> logging.Logger:
     return logger
 
 
-def run_sld(
-    json_path: str,
-    input_path: str,
-    output_dir: str,
-    logger: logging.Logger,
-    NORMAL_GPU: str,
-    evaluation_folder_before: str,
-    evaluation_folder_refined: str,
-    save_file_name: str,
-    mode: str,
-) -> None:
-    """
-    Run the SLD (Structure-aware Latent Diffusion) pipeline
-    """
-    ext_script = "src/SLD/SLD_demo.py"
-    config_ini = "/dtu/blackhole/14/189044/marscho/VLM_controller_for_SD/src/SLD/demo_config.ini"
-
-    evaluation_before_path = os.path.abspath(evaluation_folder_before)
-    evaluation_refined_path = os.path.abspath(evaluation_folder_refined)
-
-    os.environ["CUDA_VISIBLE_DEVICES"] = NORMAL_GPU.replace("cuda:", "")
-    subprocess.run(
-        [
-            "python",
-            ext_script,
-            "--json-file",
-            json_path,
-            "--input-dir",
-            input_path,
-            "--output-dir",
-            output_dir,
-            "--mode",
-            mode,
-            "--config",
-            config_ini,
-            "--evaluation-path-before",
-            evaluation_before_path,
-            "--evaluation-path-refined",
-            evaluation_refined_path,
-            "--save-file-name",
-            save_file_name,
-        ]
-    )
-
-
 def save_run_details(args, logger, output_path=None, timing_stats=None):
     """Save important details about the run to a text file"""
     if output_path is None:
@@ -145,6 +105,9 @@ def save_run_details(args, logger, output_path=None, timing_stats=None):
                 [f"- Total drawing time: {timing_stats['drawing_time']:.2f}s", f"- Average drawing time per sample: {timing_stats['avg_drawing']:.2f}s"]
             )
 
+        if timing_stats.get("stage_report"):
+            details.extend(["\n=== Stage Utilisation ===", *timing_stats["stage_report"]])
+
         try:
             with open(output_path, "a") as f:
                 f.write("\n".join(details))
@@ -158,8 +121,9 @@ def main():
     logger = setup_logging()
 
     # Set up CUDA devices
-    DEEP_SEEK_GPU = "cuda:1" if torch.cuda.is_available() else "cpu"
     NORMAL_GPU = "cuda:0" if torch.cuda.is_available() else "cpu"
+    # With a single GPU the math LLM shares it with the other models (see --gpu_budget_gb)
+    DEEP_SEEK_GPU = "cuda:1" if torch.cuda.device_count() > 1 else NORMAL_GPU
     logger.info(f"Using device: {DEEP_SEEK_GPU}")
 
     # Parse arguments
@@ -187,6 +151,28 @@ def main():
         help="Math LLM model to use",
     )
     parser.add_argument("--skip_samples", type=int, default=0, help="Number of samples to skip")
+    parser.add_argument("--queue_size", type=int, default=2, help="Maximum number of samples waiting in front of each pipeline stage")
+    parser.add_argument("--vlm_batch_size", type=int, default=4, help="Maximum number of images per VLM generation batch")
+    parser.add_argument("--math_batch_size", type=int, default=4, help="Maximum number of samples per math LLM generation batch")
+    parser.add_argument(
+        "--constrained_decoding", action="store_true", help="Force the math LLM answer into its output template (grammar constrained decoding)"
+    )
+    parser.add_argument("--math_seed", type=int, default=None, help="Torch seed of the math LLM generations")
+    parser.add_argument(
+        "--math_greedy", action="store_true", help="Greedy math LLM decoding, so that a batched sample gets the output of a batch of one"
+    )
+    parser.add_argument(
+        "--check_math_batch", action="store_true", help="Check that every batched math LLM output equals its batch-of-one output (greedy)"
+    )
+    parser.add_argument("--cache_dir", type=str, default=None, help="Stage cache directory (default: <out_dir>/.stage_cache)")
+    parser.add_argument("--no_cache", action="store_true", help="Disable the stage cache and recompute every stage")
+    parser.add_argument(
+        "--gpu_budget_gb", type=float, default=None, help="Memory budget per GPU; idle models are offloaded to stay within it (default: no limit)"
+    )
+    parser.add_argument(
+        "--cpu_budget_gb", type=float, default=None, help="Pinned CPU memory for offloaded models; beyond it they go to --offload_dir"
+    )
+    parser.add_argument("--offload_dir", type=str, default=None, help="Directory for models offloaded to disk (default: <out_dir>/.offload)")
     args = parser.parse_args()
 
     # save config details to txt
@@ -206,7 +192,13 @@ def main():
         os.makedirs(folder, exist_ok=True)
 
     # Load models
-    models = Models(device_reasoning=NORMAL_GPU, DEEP_SEEK_GPU=DEEP_SEEK_GPU)
+    models = Models(
+        device_reasoning=NORMAL_GPU,
+        DEEP_SEEK_GPU=DEEP_SEEK_GPU,
+        gpu_budget_gb=args.gpu_budget_gb,
+        cpu_budget_gb=args.cpu_budget_gb,
+        offload_dir=(args.offload_dir or os.path.join(args.out_dir, ".offload")) if args.cpu_budget_gb else None,
+    )
     if args.vlm_model_name == "qwen_2_5_vl_7b":
         vlm_model, vlm_processor = models.get_qwen_2_5_vl_7b()
     elif args.vlm_model_name == "intern_vl_2_5_8B":
@@ -220,190 +212,330 @@ def main():
 
     grounding_dino_model = models.get_grounding_dino()
 
-    # Initialize time tracking variables
-    start_time = time.time()
-    reasoning_time = 0
-    drawing_time = 0
-    sample_count = 0
+    # Load the SLD models once; they stay resident for every sample
+    sld_engine = get_sld_engine(NORMAL_GPU) if args.draw else None
+    if sld_engine is not None:
+        models.registry.register("sld", sld_engine.modules, NORMAL_GPU)
 
     # count number of folder sin args.in_dir and print it
     num_in_folders = len(os.listdir(args.in_dir))
     logger.info(f"Number of folders in {args.in_dir}: {num_in_folders}")
 
-    isoccured = False
-
-    # Process each image in input directory
-    total_samples = sum(1 for _, _, files in os.walk(args.in_dir) for f in files if f.lower().endswith((".png", ".jpg", ".jpeg")) and f != "input_mask.png")
-    progress_bar = tqdm(total=total_samples, desc="Processing samples")
-
-    for sample_idx, (subdir, _, files) in enumerate(os.walk(args.in_dir)):
-        if sample_idx < args.skip_samples:
-            continue
+    def with_model(name, fn):
+        # Keeps the model on its GPU while `fn` runs; with --gpu_budget_gb idle models are offloaded to make room
+        with models.use(name):
+            return fn()
 
-        for filename in files:
-            if not filename.lower().endswith((".png", ".jpg", ".jpeg")):
-                continue
+    # Cache in front of every stage; a rerun after a walltime kill resumes from the cached results
+    cache = StageCache(args.cache_dir or os.path.join(args.out_dir, ".stage_cache"), enabled=not args.no_cache, logger=logger)
 
-            if filename == "input_mask.png":
+    def iter_samples():
+        """Yield one sample dict per input image, in os.walk order"""
+        for sample_idx, (subdir, _, files) in enumerate(os.walk(args.in_dir)):
+            if sample_idx < args.skip_samples:
                 continue
 
-            if args.is_benchmark_dataset:
-                with open(os.path.join(subdir, "save_file_name.txt"), "r") as file:
-                    save_file_name = file.read().strip()
-                    # if save_file_name == "2007_003194_0_transform_0_prompt_1":  #    DAY 1
-                    #     isoccured = True
-                    # if save_file_name == "2008_004365_1_transform_1_prompt_1":  # DAY 2
-                    #     isoccured = True
-            else:
-                save_file_name = os.path.basename(subdir).strip()
-            sample_count += 1
-            # if not isoccured:
-            #     continue
-
-            # Set up paths
-            input_path = os.path.join(subdir, filename)
-            subfolder_name = os.path.basename(subdir)
-            sample_dir = os.path.join(args.out_dir, subfolder_name)
-            os.makedirs(sample_dir, exist_ok=True)
-
-            analysis_file = os.path.join(sample_dir, "analysis.txt")
-            analysis_enhanced_file = os.path.join(sample_dir, "analysis_enhanced.txt")
-            transformation_matrix_file = os.path.join(sample_dir, "transformation_matrix.npy")
-            json_path = os.path.join(sample_dir, "config_sld.json")
-            edit_instruction_file = os.path.join(subdir, "edit_instruction.txt")
-
-            with open(edit_instruction_file, "r") as file:
-                USER_EDIT = file.read().strip()
-
-            logger.info(f"Processing sample #{sample_idx}: {input_path}")
-            ### REASONING ###
-            reasoning_start = time.time()
-            if args.reasoning:
-                #  STEP 1 VLM ---  parsing
-                logger.info(f"Step 1: VLM Parsing for sample {sample_idx}/{num_in_folders}")
-                try:
-                    results = parse_image(input_path, args.vlm_model_name, vlm_model, vlm_processor, NORMAL_GPU, USER_EDIT)
-                    save_results_image_parse(sample_dir, results)
-                except:
-                    logger.error(f"No VLM parsing found for sample {sample_idx}")
-                    continue
-                VLM_BBOXES = results["objects"]
-                if len(VLM_BBOXES) > args.max_objects:
-                    logger.error(f"Too many objects detected for sample {sample_idx}/{num_in_folders}")
+            for filename in files:
+                if not filename.lower().endswith((".png", ".jpg", ".jpeg")):
                     continue
 
-                # # Step 2: Refine detections with SAM
-                # logger.info(f"Step 2: SAM Refine Detections for sample {sample_idx}")
-                # try:
-                #     SAM_MASKS = run_sam_refine(file_analysis_path=analysis_file, img_path=input_path, sam_model=sam_model)
-                # except:
-                #     logger.error(f"No SAM masks found for sample {sample_idx}")
-                #     continue
-                # step 2B: Refine detections with Grounding DINO
-                logger.info(f"Step 2B: Grounding DINO Refine Detections for sample {sample_idx}")
-                try:
-                    SAM_MASKS = run_grounding_dino_refine(file_analysis_path=analysis_file, img_path=input_path, grounding_dino_model=grounding_dino_model)
-                except:
-                    logger.error(f"No Grounding DINO masks found for sample {sample_idx}")
+                if filename == "input_mask.png":
                     continue
 
-                # Step 3:  LLM: Mathematical analysis
-                logger.info(f"Step 3 - LLM Math Analysis for sample {sample_idx}/{num_in_folders}")
-                try:
-                    _, OBJECT_ID, APPEARANCE_TOKEN = run_math_analysis(
-                        user_edit=USER_EDIT,
-                        file_path=analysis_enhanced_file,
-                        model_name=args.math_llm_name,
-                        model=math_model,
-                        tokenizer=math_tokenizer,
-                        device=DEEP_SEEK_GPU,
-                        logger=logger,
-                    )
-                except:
-                    logger.error(f"No math analysis found for object {OBJECT_ID}")
-                    continue
-
-                # Step 4: Apply transformations
-                logger.info(f"Step 4: OPEN-CV Transformations for sample {sample_idx}/{num_in_folders}")
-                try:
-                    TRANSFORMED_MASK, TRANSFORMED_ORACLE = run_open_cv_transformations(
-                        matrix_transform_file=transformation_matrix_file,
-                        output_dir=sample_dir,
-                        oracle_mask_path=os.path.join(subdir, "input_mask.png"),
-                        ENHANCED_FILE_DESCRIPTION=analysis_enhanced_file,
-                    )
-                except:
-                    logger.error(f"No transformation matrix found for object {OBJECT_ID}")
-                    # Create a black image with the same dimensions as the input image
-                    TRANSFORMED_MASK = np.zeros((512, 512))
-                    continue
-
-                # Get masks and bounding boxes
-                try:
-                    VLM_BBOX = VLM_BBOXES[OBJECT_ID - 1]["bbox"]
-                except:
-                    logger.error(f"No bounding box found for object {OBJECT_ID}")
-                    # Create a black mask with same dimensions as SAM_MASKS
-                    VLM_BBOX = [0, 0, 1, 1]
-                    continue
-
-                try:
-                    SAM_MASK = SAM_MASKS[str(OBJECT_ID)].astype(np.uint8) * 255
-                except:
-                    logger.error(f"No SAM mask found for object {OBJECT_ID}")
-                    # Create a black image with the same dimensions as the input image
-                    SAM_MASK = np.zeros((512, 512))
+                if args.is_benchmark_dataset:
+                    with open(os.path.join(subdir, "save_file_name.txt"), "r") as file:
+                        save_file_name = file.read().strip()
+                else:
+                    save_file_name = os.path.basename(subdir).strip()
+
+                # Set up paths
+                input_path = os.path.join(subdir, filename)
+                subfolder_name = os.path.basename(subdir)
+                sample_dir = os.path.join(args.out_dir, subfolder_name)
+                os.makedirs(sample_dir, exist_ok=True)
+
+                with open(os.path.join(subdir, "edit_instruction.txt"), "r") as file:
+                    USER_EDIT = file.read().strip()
+
+                yield {
+                    "sample_idx": sample_idx,
+                    "subdir": subdir,
+                    "input_path": input_path,
+                    "sample_dir": sample_dir,
+                    "save_file_name": save_file_name,
+                    "user_edit": USER_EDIT,
+                    "analysis_file": os.path.join(sample_dir, "analysis.txt"),
+                    "analysis_enhanced_file": os.path.join(sample_dir, "analysis_enhanced.txt"),
+                    "transformation_matrix_file": os.path.join(sample_dir, "transformation_matrix.npy"),
+                    "json_path": os.path.join(sample_dir, "config_sld.json"),
+                }
+
+    ### REASONING ###
+    def vlm_parse_stage(samples):
+        #  STEP 1 VLM ---  parsing, batched over the samples waiting in front of the stage
+        logger.info(f"Step 1: VLM Parsing for samples {[sample['sample_idx'] for sample in samples]}/{num_in_folders}")
+
+        def parse_and_save(indices):
+            with models.use(args.vlm_model_name):
+                results = parse_images(
+                    [samples[i]["input_path"] for i in indices],
+                    args.vlm_model_name,
+                    vlm_model,
+                    vlm_processor,
+                    NORMAL_GPU,
+                    [samples[i]["user_edit"] for i in indices],
+                    batch_size=args.vlm_batch_size,
+                )
+            for j, (i, result) in enumerate(zip(indices, results)):
+                if isinstance(result, Exception):
                     continue
-
                 try:
-                    # Save evaluation results
-                    cv2.imwrite(os.path.join(evaluation_folders["evaluation_2_after_sam"], f"{save_file_name}.png"), SAM_MASK)
-                    cv2.imwrite(os.path.join(evaluation_folders["evaluation_3_after_llm_transformation"], f"{save_file_name}.png"), TRANSFORMED_MASK)
-                    cv2.imwrite(os.path.join(evaluation_folders["evaluation_6_after_llm_transformatio_oracle"], f"{save_file_name}.png"), TRANSFORMED_ORACLE)
-
-                    # Create and save VLM mask
-                    height, width = SAM_MASK.shape
-                    vlm_mask = np.zeros((height, width), dtype=np.uint8)
-                    xmin, ymin = int(VLM_BBOX[0] * width), int(VLM_BBOX[1] * height)
-                    xmax, ymax = int(VLM_BBOX[2] * width), int(VLM_BBOX[3] * height)
-                    vlm_mask[ymin:ymax, xmin:xmax] = 255
-                    cv2.imwrite(os.path.join(evaluation_folders["evaluation_1_after_vlm"], f"{save_file_name}.png"), vlm_mask)
-
-                    # Step 5: Generate config_sld.json for the SLD
-
-                    logger.info(f"Step 5: SLD Generation for sample {sample_idx}/{num_in_folders}")
-                    generate_sld_config(sample_dir, analysis_enhanced_file, USER_EDIT)
-                except:
-                    logger.error(f"No SLD config found for object {OBJECT_ID}")
-                    continue
+                    save_results_image_parse(samples[i]["sample_dir"], result)
+                except Exception as e:
+                    results[j] = e
+            return results
+
+        outputs = cache.cached_batch_call(
+            "vlm_parse",
+            [{"image": file_digest(sample["input_path"]), "user_edit": sample["user_edit"], "model": args.vlm_model_name} for sample in samples],
+            parse_and_save,
+            output_dirs=[sample["sample_dir"] for sample in samples],
+        )
+        for idx, (sample, results) in enumerate(zip(samples, outputs)):
+            if isinstance(results, Exception):
+                logger.error(f"VLM parsing failed for sample {sample['sample_idx']}/{num_in_folders}: {results}")
+                samples[idx] = None
+                continue
+            sample["vlm_bboxes"] = results["objects"]
+            if len(sample["vlm_bboxes"]) > args.max_objects:
+                logger.error(f"Too many objects detected for sample {sample['sample_idx']}/{num_in_folders}")
+                samples[idx] = None
+        return samples
+
+    def grounding_dino_stage(sample):
+        # # Step 2: Refine detections with SAM
+        # logger.info(f"Step 2: SAM Refine Detections for sample {sample_idx}")
+        # try:
+        #     SAM_MASKS = run_sam_refine(file_analysis_path=analysis_file, img_path=input_path, sam_model=sam_model)
+        # except:
+        #     logger.error(f"No SAM masks found for sample {sample_idx}")
+        #     continue
+        # step 2B: Refine detections with Grounding DINO
+        sample_idx = sample["sample_idx"]
+        logger.info(f"Step 2B: Grounding DINO Refine Detections for sample {sample_idx}")
+        try:
+            sample["sam_masks"] = cache.cached_call(
+                "grounding_dino",
+                {"image": file_digest(sample["input_path"]), "analysis": file_digest(sample["analysis_file"])},
+                lambda: with_model(
+                    "grounding_dino",
+                    lambda: run_grounding_dino_refine(
+                        file_analysis_path=sample["analysis_file"], img_path=sample["input_path"], grounding_dino_model=grounding_dino_model
+                    ),
+                ),
+                output_dir=sample["sample_dir"],
+            )
+        except:
+            logger.error(f"No Grounding DINO masks found for sample {sample_idx}")
+            return None
+        return sample
+
+    def math_llm_stage(samples):
+        # Step 3:  LLM: Mathematical analysis, batched over the samples waiting in front of the stage
+        logger.info(f"Step 3 - LLM Math Analysis for samples {[sample['sample_idx'] for sample in samples]}/{num_in_folders}")
+        if args.check_math_batch and len(samples) > 1:
+            try:
+                requests = []
+                for sample in samples:
+                    objects, scene_desc, spatial_rel = parse_detection_file(sample["analysis_enhanced_file"])
+                    requests.append({"user_edit": sample["user_edit"], "objects": objects, "scene_desc": scene_desc, "spatial_rel": spatial_rel})
+                with models.use(args.math_llm_name):
+                    check_batch_equivalence(args.math_llm_name, math_model, math_tokenizer, requests, DEEP_SEEK_GPU, logger)
+            except Exception as e:
+                logger.error(f"Math LLM batch equivalence check failed: {e}")
+        outputs = cache.cached_batch_call(
+            "math_llm",
+            [
+                {
+                    "analysis_enhanced": file_digest(sample["analysis_enhanced_file"]),
+                    "user_edit": sample["user_edit"],
+                    "model": args.math_llm_name,
+                    "constrained": args.constrained_decoding,
+                    "seed": args.math_seed,
+                    "greedy": args.math_greedy,
+                }
+                for sample in samples
+            ],
+            lambda indices: with_model(
+                args.math_llm_name,
+                lambda: run_math_analysis_batch(
+                    user_edits=[samples[i]["user_edit"] for i in indices],
+                    file_paths=[samples[i]["analysis_enhanced_file"] for i in indices],
+                    model_name=args.math_llm_name,
+                    model=math_model,
+                    tokenizer=math_tokenizer,
+                    device=DEEP_SEEK_GPU,
+                    logger=logger,
+                    constrained=args.constrained_decoding,
+                    seed=args.math_seed,
+                    do_sample=False if args.math_greedy else None,
+                ),
+            ),
+            output_dirs=[sample["sample_dir"] for sample in samples],
+        )
+        for idx, (sample, output) in enumerate(zip(samples, outputs)):
+            if isinstance(output, Exception):
+                logger.error(f"No math analysis found for sample {sample['sample_idx']}")
+                samples[idx] = None
+                continue
+            _, sample["object_id"], sample["appearance_token"] = output
+        return samples
+
+    def transform_stage(sample):
+        # Step 4: Apply transformations
+        sample_idx, OBJECT_ID, save_file_name = sample["sample_idx"], sample["object_id"], sample["save_file_name"]
+        logger.info(f"Step 4: OPEN-CV Transformations for sample {sample_idx}/{num_in_folders}")
+        oracle_mask_path = os.path.join(sample["subdir"], "input_mask.png")
+        try:
+            TRANSFORMED_MASK, TRANSFORMED_ORACLE = cache.cached_call(
+                "open_cv",
+                {
+                    "matrix": file_digest(sample["transformation_matrix_file"]),
+                    "object_id": file_digest(os.path.join(sample["sample_dir"], "object_id.txt")),
+                    "mask": file_digest(os.path.join(sample["sample_dir"], f"mask_{OBJECT_ID}.png")),
+                    "oracle_mask": file_digest(oracle_mask_path),
+                    "analysis_enhanced": file_digest(sample["analysis_enhanced_file"]),
+                },
+                lambda: run_open_cv_transformations(
+                    matrix_transform_file=sample["transformation_matrix_file"],
+                    output_dir=sample["sample_dir"],
+                    oracle_mask_path=oracle_mask_path,
+                    ENHANCED_FILE_DESCRIPTION=sample["analysis_enhanced_file"],
+                ),
+                output_dir=sample["sample_dir"],
+            )
+        except:
+            logger.error(f"No transformation matrix found for object {OBJECT_ID}")
+            return None
 
-                reasoning_time += time.time() - reasoning_start
+        # Get masks and bounding boxes
+        try:
+            VLM_BBOX = sample["vlm_bboxes"][OBJECT_ID - 1]["bbox"]
+        except:
+            logger.error(f"No bounding box found for object {OBJECT_ID}")
+            return None
 
-            ### IMAGE GENERATION ###
-            drawing_start = time.time()
-            if args.draw:
+        try:
+            SAM_MASK = sample["sam_masks"][str(OBJECT_ID)].astype(np.uint8) * 255
+        except:
+            logger.error(f"No SAM mask found for object {OBJECT_ID}")
+            return None
 
-                # Step 6: Run SLD to generate edited image
-                logger.info(f"Step 6: SLD Generation for sample {sample_idx}/{num_in_folders}")
-                run_sld(
-                    json_path=os.path.abspath(json_path),
-                    input_path=os.path.abspath(input_path),
-                    output_dir=os.path.abspath(sample_dir),
+        try:
+            # Save evaluation results
+            cv2.imwrite(os.path.join(evaluation_folders["evaluation_2_after_sam"], f"{save_file_name}.png"), SAM_MASK)
+            cv2.imwrite(os.path.join(evaluation_folders["evaluation_3_after_llm_transformation"], f"{save_file_name}.png"), TRANSFORMED_MASK)
+            cv2.imwrite(os.path.join(evaluation_folders["evaluation_6_after_llm_transformatio_oracle"], f"{save_file_name}.png"), TRANSFORMED_ORACLE)
+
+            # Create and save VLM mask
+            height, width = SAM_MASK.shape
+            vlm_mask = np.zeros((height, width), dtype=np.uint8)
+            xmin, ymin = int(VLM_BBOX[0] * width), int(VLM_BBOX[1] * height)
+            xmax, ymax = int(VLM_BBOX[2] * width), int(VLM_BBOX[3] * height)
+            vlm_mask[ymin:ymax, xmin:xmax] = 255
+            cv2.imwrite(os.path.join(evaluation_folders["evaluation_1_after_vlm"], f"{save_file_name}.png"), vlm_mask)
+
+            # Step 5: Generate config_sld.json for the SLD
+            logger.info(f"Step 5: SLD Config Generation for sample {sample_idx}/{num_in_folders}")
+            cache.cached_call(
+                "sld_config",
+                {
+                    "analysis_enhanced": file_digest(sample["analysis_enhanced_file"]),
+                    "user_edit": sample["user_edit"],
+                    "matrix": file_digest(sample["transformation_matrix_file"]),
+                    "image_size": [height, width],
+                },
+                lambda: generate_sld_config(
+                    sample["sample_dir"],
+                    sample["analysis_enhanced_file"],
+                    sample["user_edit"],
+                    transformation_matrix_file=sample["transformation_matrix_file"],
+                    image_size=(height, width),
+                ),
+                output_dir=sample["sample_dir"],
+            )
+        except:
+            logger.error(f"No SLD config found for object {OBJECT_ID}")
+            return None
+        return sample
+
+    ### IMAGE GENERATION ###
+    def sld_stage(sample):
+        # Step 6: Run SLD to generate edited image
+        logger.info(f"Step 6: SLD Generation for sample {sample['sample_idx']}/{num_in_folders}")
+        save_file_name = sample["save_file_name"]
+        cache.cached_call(
+            "sld",
+            {
+                "config_sld": file_digest(sample["json_path"]),
+                "image": file_digest(sample["input_path"]),
+                "mode": args.mode,
+                "sld_config": file_digest(os.path.join(SLD_DIR, "demo_config.ini")),
+            },
+            lambda: with_model(
+                "sld",
+                lambda: run_sld(
+                    json_path=os.path.abspath(sample["json_path"]),
+                    input_path=os.path.abspath(sample["input_path"]),
+                    output_dir=os.path.abspath(sample["sample_dir"]),
                     logger=logger,
                     NORMAL_GPU=NORMAL_GPU,
                     evaluation_folder_before=evaluation_folders["evaluation_4_after_sld"],
                     evaluation_folder_refined=evaluation_folders["evaluation_5_after_sld_refine"],
                     save_file_name=save_file_name,
                     mode=args.mode,
-                )
-            drawing_time += time.time() - drawing_start
+                    engine=sld_engine,
+                ),
+            ),
+            output_dir=sample["sample_dir"],
+            extra_outputs=[
+                os.path.join(evaluation_folders["evaluation_4_after_sld"], f"{save_file_name}.png"),
+                os.path.join(evaluation_folders["evaluation_5_after_sld_refine"], f"{save_file_name}.png"),
+            ],
+        )
+        return sample
+
+    # Each stage runs in its own worker, so consecutive samples overlap on the two GPUs
+    reasoning_stages = []
+    if args.reasoning:
+        reasoning_stages = [
+            Stage("vlm_parse", vlm_parse_stage, batch_size=args.vlm_batch_size),
+            Stage("grounding_dino", grounding_dino_stage),
+            Stage("math_llm", math_llm_stage, batch_size=args.math_batch_size),
+            Stage("transform", transform_stage),
+        ]
+    drawing_stages = [Stage("sld", sld_stage)] if args.draw else []
+    pipeline = StagePipeline(reasoning_stages + drawing_stages, queue_size=args.queue_size, logger=logger)
 
-            progress_bar.update(1)
+    # Process each image in input directory
+    total_samples = sum(1 for _, _, files in os.walk(args.in_dir) for f in files if f.lower().endswith((".png", ".jpg", ".jpeg")) and f != "input_mask.png")
+    progress_bar = tqdm(total=total_samples, desc="Processing samples")
+
+    sample_count = 0
+
+    def counted_samples():
+        nonlocal sample_count
+        for sample in iter_samples():
+            sample_count += 1
+            yield sample
 
+    pipeline.run(counted_samples(), on_done=lambda seq, sample: progress_bar.update(1))
     progress_bar.close()
 
     # After the main processing loop, before the timing statistics logging:
-    total_time = time.time() - start_time
+    total_time = pipeline.wall_time
+    reasoning_time = sum(stage.busy_time for stage in reasoning_stages)
+    drawing_time = sum(stage.busy_time for stage in drawing_stages)
     timing_stats = {
         "sample_count": sample_count,
         "total_time": total_time,
@@ -412,6 +544,7 @@ def main():
         "avg_total": total_time / sample_count if sample_count > 0 else 0,
         "avg_reasoning": reasoning_time / sample_count if sample_count > 0 and args.reasoning else 0,
         "avg_drawing": drawing_time / sample_count if sample_count > 0 and args.draw else 0,
+        "stage_report": pipeline.report() + cache.report() + models.registry.report(),
     }
     save_run_details(args=args, logger=logger, timing_stats=timing_stats)
 
@@ -422,6 +555,8 @@ def main():
             logger.info(f"Average reasoning time per sample: {timing_stats['avg_reasoning']:.2f}s")
         if args.draw:
             logger.info(f"Average drawing time per sample: {timing_stats['avg_drawing']:.2f}s")
+    for line in timing_stats["stage_report"]:
+        logger.info(line)
 
 
 if __name__ == "__main__":
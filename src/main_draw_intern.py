@@ -2,7 +2,6 @@ import os
 import logging
 import argparse
 from typing import Optional
-import subprocess
 import time
 
 import cv2
@@ -17,7 +16,7 @@ from utils_pose.open_cv_transformations import run_open_cv_transformations
 from utils_pose.sam_refiner import run_sam_refine
 from utils_pose.math_model import run_math_analysis
 from utils_pose.vlm_image_parser import parse_image, save_results_image_parse
-from utils_pose.sld_adapter import generate_sld_config
+from utils_pose.sld_adapter import generate_sld_config, run_sld
 
 os.environ["CUDA_DEVICE_ORDER"] = "PCI_BUS_ID"
 
@@ -47,51 +46,6 @@ def setup_logging() -> logging.Logger:
     return logger
 
 
-def run_sld(
-    json_path: str,
-    input_path: str,
-    output_dir: str,
-    logger: logging.Logger,
-    NORMAL_GPU: str,
-    evaluation_folder_before: str,
-    evaluation_folder_refined: str,
-    save_file_name: str,
-    mode: str,
-) -> None:
-    """
-    Run the SLD (Structure-aware Latent Diffusion) pipeline
-    """
-    ext_script = "src/SLD/SLD_demo.py"
-    config_ini = "/dtu/blackhole/14/189044/marscho/VLM_controller_for_SD/src/SLD/demo_config.ini"
-
-    evaluation_before_path = os.path.abspath(evaluation_folder_before)
-    evaluation_refined_path = os.path.abspath(evaluation_folder_refined)
-
-    os.environ["CUDA_VISIBLE_DEVICES"] = NORMAL_GPU.replace("cuda:", "")
-    subprocess.run(
-        [
-            "python",
-            ext_script,
-            "--json-file",
-            json_path,
-            "--input-dir",
-            input_path,
-            "--output-dir",
-            output_dir,
-            "--mode",
-            mode,
-            "--config",
-            config_ini,
-            "--evaluation-path-before",
-            evaluation_before_path,
-            "--evaluation-path-refined",
-            evaluation_refined_path,
-            "--save-file-name",
-            save_file_name,
-        ]
-    )
-
-
 def save_run_details(args, logger, output_path=None, timing_stats=None):
     """Save important details about the run to a text file"""
     if output_path is None:
@@ -0,0 +1,236 @@
+import re
+import string
+from typing import Dict, List, Optional, Sequence, Set, Tuple
+
+import torch
+from transformers import LogitsProcessor
+
+# (segment index, characters consumed in that segment)
+State = Tuple[int, str]
+
+
+class Literal:
+    """Fixed text."""
+
+    def __init__(self, text: str):
+        self.text = text
+
+    def accept(self, buf: str, ch: str) -> Optional[str]:
+        return buf + ch if self.text.startswith(buf + ch) else None
+
+    def complete(self, buf: str) -> bool:
+        return buf == self.text
+
+    def final(self, buf: str) -> bool:
+        return buf == self.text
+
+    def first_chars(self, buf: str) -> Set[str]:
+        return {self.text[len(buf)]} if len(buf) < len(self.text) else set()
+
+
+class Number:
+    """Float with a fixed number of decimals, e.g. -0.25 or 1.00."""
+
+    def __init__(self, max_int_digits: int = 3, decimals: int = 2):
+        self.prefix_re = re.compile(rf"-?(\d{{1,{max_int_digits}}}(\.\d{{0,{decimals}}})?)?")
+        self.full_re = re.compile(rf"-?\d{{1,{max_int_digits}}}\.\d{{{decimals}}}")
+
+    def accept(self, buf: str, ch: str) -> Optional[str]:
+        return buf + ch if self.prefix_re.fullmatch(buf + ch) else None
+
+    def complete(self, buf: str) -> bool:
+        return self.full_re.fullmatch(buf) is not None
+
+    def final(self, buf: str) -> bool:
+        return self.complete(buf)
+
+    def first_chars(self, buf: str) -> Set[str]:
+        return {ch for ch in "-.0123456789" if self.prefix_re.fullmatch(buf + ch)}
+
+
+class Choice:
+    """One of a fixed set of strings (e.g. the object IDs listed in the prompt)."""
+
+    def __init__(self, options: Sequence[str]):
+        self.options = list(options)
+
+    def accept(self, buf: str, ch: str) -> Optional[str]:
+        return buf + ch if any(option.startswith(buf + ch) for option in self.options) else None
+
+    def complete(self, buf: str) -> bool:
+        return buf in self.options
+
+    def final(self, buf: str) -> bool:
+        return self.complete(buf) and not any(option != buf and option.startswith(buf) for option in self.options)
+
+    def first_chars(self, buf: str) -> Set[str]:
+        return {option[len(buf)] for option in self.options if option.startswith(buf) and len(option) > len(buf)}
+
+
+class Word:
+    """A single word of ASCII letters."""
+
+    def __init__(self, max_length: int = 20):
+        self.max_length = max_length
+
+    def accept(self, buf: str, ch: str) -> Optional[str]:
+        return buf + ch if ch in string.ascii_letters and len(buf) < self.max_length else None
+
+    def complete(self, buf: str) -> bool:
+        return len(buf) > 0
+
+    def final(self, buf: str) -> bool:
+        return len(buf) == self.max_length
+
+    def first_chars(self, buf: str) -> Set[str]:
+        return set(string.ascii_letters) if len(buf) < self.max_length else set()
+
+
+class TemplateFSM:
+    """Character level state machine for an output template made of consecutive segments."""
+
+    def __init__(self, segments: List):
+        self.segments = segments
+
+    def initial(self) -> State:
+        return (0, "")
+
+    def done(self, state: State) -> bool:
+        return state[0] == len(self.segments)
+
+    def step(self, state: State, ch: str) -> Optional[State]:
+        seg_idx, buf = state
+        while seg_idx < len(self.segments):
+            segment = self.segments[seg_idx]
+            new_buf = segment.accept(buf, ch)
+            if new_buf is not None:
+                return (seg_idx + 1, "") if segment.final(new_buf) else (seg_idx, new_buf)
+            # A complete but still extensible segment (e.g. ID "1" when "12" exists) ends at the first character it rejects
+            if not segment.complete(buf):
+                return None
+            seg_idx, buf = seg_idx + 1, ""
+        return None
+
+    def feed(self, state: Optional[State], text: str) -> Optional[State]:
+        for ch in text:
+            if state is None:
+                return None
+            state = self.step(state, ch)
+        return state
+
+    def next_chars(self, state: State) -> Set[str]:
+        chars: Set[str] = set()
+        seg_idx, buf = state
+        while seg_idx < len(self.segments):
+            segment = self.segments[seg_idx]
+            chars |= segment.first_chars(buf)
+            if not segment.complete(buf):
+                break
+            seg_idx, buf = seg_idx + 1, ""
+        return chars
+
+    def can_end(self, state: State) -> bool:
+        seg_idx, buf = state
+        while seg_idx < len(self.segments):
+            if not self.segments[seg_idx].complete(buf):
+                return False
+            seg_idx, buf = seg_idx + 1, ""
+        return True
+
+
+# Decoded text of every token, per tokenizer; decoding the whole vocabulary is done once
+_TOKEN_STRINGS: Dict[int, Tuple[List[str], Dict[str, List[Tuple[int, str]]]]] = {}
+
+
+def _token_index(tokenizer) -> Tuple[List[str], Dict[str, List[Tuple[int, str]]]]:
+    if id(tokenizer) not in _TOKEN_STRINGS:
+        token_strings = tokenizer.batch_decode([[i] for i in range(len(tokenizer))])
+        special_ids = set(tokenizer.all_special_ids)
+        by_first_char: Dict[str, List[Tuple[int, str]]] = {}
+        for token_id, text in enumerate(token_strings):
+            if token_id in special_ids or not text:
+                token_strings[token_id] = ""
+                continue
+            by_first_char.setdefault(text[0], []).append((token_id, text))
+        _TOKEN_STRINGS[id(tokenizer)] = (token_strings, by_first_char)
+    return _TOKEN_STRINGS[id(tokenizer)]
+
+
+class TemplateLogitsProcessor(LogitsProcessor):
+    """Forces the tail of each generated row into an output template.
+
+    Every row decodes freely until `trigger` appears in its output (or right away if `trigger` is None),
+    or until only `reserve_tokens` of the `max_new_tokens` budget are left. With `trigger_line`, the trigger
+    must be a whole line of the output (e.g. "MATRIX" on its own line, not the word inside a sentence). From then on only tokens
+    that keep the row's `TemplateFSM` valid are allowed, and EOS once the template is complete.
+    """
+
+    def __init__(
+        self,
+        tokenizer,
+        fsms: List[TemplateFSM],
+        max_new_tokens: int,
+        trigger: Optional[str] = None,
+        reserve_tokens: int = 160,
+        trigger_line: bool = False,
+    ):
+        self.token_strings, self.by_first_char = _token_index(tokenizer)
+        self.eos_ids = [tokenizer.eos_token_id] if tokenizer.eos_token_id is not None else []
+        self.fsms = fsms
+        self.max_new_tokens = max_new_tokens
+        self.trigger = trigger
+        self.trigger_line = trigger_line
+        self.reserve_tokens = reserve_tokens
+        self.prompt_length = None
+        self.free_texts = [""] * len(fsms)
+        self.states: List[Optional[State]] = [fsm.initial() if trigger is None else None for fsm in fsms]
+
+    def __call__(self, input_ids: torch.LongTensor, scores: torch.FloatTensor) -> torch.FloatTensor:
+        if self.prompt_length is None:
+            self.prompt_length = input_ids.shape[1]
+        num_generated = input_ids.shape[1] - self.prompt_length
+
+        for row, fsm in enumerate(self.fsms):
+            if num_generated > 0:
+                last_token = input_ids[row, -1].item()
+                piece = self.token_strings[last_token] if last_token < len(self.token_strings) else ""
+                if self.states[row] is not None:
+                    self.states[row] = fsm.feed(self.states[row], piece) if not fsm.done(self.states[row]) else self.states[row]
+                else:
+                    self.free_texts[row] += piece
+                    if self._triggered(self.free_texts[row], piece):
+                        self.states[row] = fsm.initial()
+
+            # Leave enough room for the template to be completed within the token budget
+            if self.states[row] is None and num_generated >= self.max_new_tokens - self.reserve_tokens:
+                self.states[row] = fsm.initial()
+
+            state = self.states[row]
+            if state is None:
+                continue
+            allowed = self._allowed_tokens(fsm, state) if not fsm.done(state) else []
+            if not allowed or fsm.can_end(state):
+                allowed = allowed + self.eos_ids
+            mask = torch.full_like(scores[row], float("-inf"))
+            mask[allowed] = 0
+            scores[row] = scores[row] + mask
+
+        return scores
+
+    def _triggered(self, text: str, piece: str) -> bool:
+        if not self.trigger_line:
+            return self.trigger in text[-(len(self.trigger) + len(piece)) :]
+        # Lines completed by this piece
+        completed = piece.count("\n")
+        if completed == 0:
+            return False
+        lines = text.split("\n")[:-1]
+        return any(line.strip() == self.trigger for line in lines[-completed:])
+
+    def _allowed_tokens(self, fsm: TemplateFSM, state: State) -> List[int]:
+        allowed = []
+        for ch in fsm.next_chars(state):
+            for token_id, text in self.by_first_char.get(ch, []):
+                if fsm.feed(state, text) is not None:
+                    allowed.append(token_id)
+        return allowed
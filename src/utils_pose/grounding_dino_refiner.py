@@ -5,6 +5,7 @@ import re
 import logging
 from typing import Dict, List, Any, Tuple
 import matplotlib.pyplot as plt
+from .stage_pipeline import PYPLOT_LOCK
 from ultralytics import SAM
 from autodistill.detection import CaptionOntology
 
@@ -93,6 +94,69 @@ def parse_detection_file(file_path: str, img_path: str) -> Tuple[Dict[str, np.nd
     return points_by_class, labels_by_class, boxes_by_class, objects
 
 
+def box_iou(box: np.ndarray, boxes: np.ndarray) -> np.ndarray:
+    """IoU between one xyxy box and an (N, 4) array of xyxy boxes."""
+    xmin = np.maximum(box[0], boxes[:, 0])
+    ymin = np.maximum(box[1], boxes[:, 1])
+    xmax = np.minimum(box[2], boxes[:, 2])
+    ymax = np.minimum(box[3], boxes[:, 3])
+    intersection = np.clip(xmax - xmin, 0, None) * np.clip(ymax - ymin, 0, None)
+    area = (box[2] - box[0]) * (box[3] - box[1])
+    areas = (boxes[:, 2] - boxes[:, 0]) * (boxes[:, 3] - boxes[:, 1])
+    return intersection / np.maximum(area + areas - intersection, 1e-6)
+
+
+def assign_detections_to_objects(boxes_by_class: Dict[str, np.ndarray], predictions: Any, classes: List[str]) -> Dict[str, int]:
+    """
+    Assign the detections of a multi-class prediction to the VLM objects.
+
+    Every object gets a detection of its own class, matched greedily by IoU with the VLM box; an object
+    whose box overlaps none of the remaining detections of its class gets the most confident one.
+
+    Args:
+        boxes_by_class: Maps class keys ("<class>_<object id>") to the VLM boxes in pixels
+        predictions: supervision Detections with xyxy, confidence, class_id and mask
+        classes: Ontology classes, indexed by `predictions.class_id`
+
+    Returns:
+        Dict mapping class keys to detection indices
+    """
+    if predictions.mask is None or len(predictions) == 0:
+        return {}
+
+    class_names = [classes[class_id] if class_id is not None and 0 <= class_id < len(classes) else None for class_id in predictions.class_id]
+    confidence = predictions.confidence if predictions.confidence is not None else np.zeros(len(predictions))
+
+    # All (IoU, object, detection) pairs of the same class, best overlap first
+    candidates = []
+    for class_key, boxes in boxes_by_class.items():
+        obj_class = class_key.rsplit("_", 1)[0]
+        indices = np.array([i for i, name in enumerate(class_names) if name == obj_class], dtype=int)
+        if len(indices) == 0:
+            continue
+        ious = box_iou(np.asarray(boxes[0], dtype=float), predictions.xyxy[indices].astype(float))
+        for det_idx, iou in zip(indices, ious):
+            candidates.append((float(iou), float(confidence[det_idx]), class_key, int(det_idx)))
+    candidates.sort(key=lambda c: (c[0], c[1]), reverse=True)
+
+    assigned: Dict[str, int] = {}
+    used = set()
+    for iou, _, class_key, det_idx in candidates:
+        if class_key in assigned or det_idx in used or iou <= 0:
+            continue
+        assigned[class_key] = det_idx
+        used.add(det_idx)
+
+    # Objects without an overlapping detection fall back to the most confident unused one of their class
+    for _, _, class_key, det_idx in sorted(candidates, key=lambda c: c[1], reverse=True):
+        if class_key in assigned or det_idx in used:
+            continue
+        assigned[class_key] = det_idx
+        used.add(det_idx)
+
+    return assigned
+
+
 def run_grounding_dino_refine(file_analysis_path: str, img_path: str, grounding_dino_model: any, debug: bool = True) -> Dict[str, np.ndarray]:
     """
     Run Grounding DINO refinement on detected objects.
@@ -123,26 +187,24 @@ def run_grounding_dino_refine(file_analysis_path: str, img_path: str, grounding_
         orig_img = cv2.cvtColor(orig_img, cv2.COLOR_BGR2RGB)
         debug_img = orig_img.copy()
 
+    # One multi-class prediction per image: the detector and the SAM image encoder run once for all objects
+    classes = list(dict.fromkeys(class_key.rsplit("_", 1)[0] for class_key in input_points_by_class))
+    assigned_masks = {}
+    if classes:
+        grounding_dino_model.ontology = CaptionOntology({obj_class: obj_class for obj_class in classes})
+        predictions = grounding_dino_model.predict(PIL.Image.open(img_path))
+        assigned_masks = assign_detections_to_objects(input_boxes_by_class, predictions, classes)
+
     for class_key in input_points_by_class:
         points = input_points_by_class[class_key]
         labels = input_labels_by_class[class_key]
         boxes = input_boxes_by_class[class_key]
 
-        # Run SAM inference
-
-        obj_class = class_key.split("_")[0]
-        grounding_dino_model.ontology = CaptionOntology(
-            {
-                obj_class: obj_class,
-            }
-        )
-
-        predictions = grounding_dino_model.predict(PIL.Image.open(img_path))
-        if predictions.mask.size == 0:
+        if class_key not in assigned_masks:
             logging.warning(f"No mask found for {class_key}")
             continue
 
-        mask_array = predictions.mask[0].astype(np.uint8) * 255
+        mask_array = predictions.mask[assigned_masks[class_key]].astype(np.uint8) * 255
 
         rows = np.any(mask_array, axis=1)
         cols = np.any(mask_array, axis=0)
@@ -186,12 +248,13 @@ def run_grounding_dino_refine(file_analysis_path: str, img_path: str, grounding_
 
     if debug:
         # Save debug visualization
-        plt.figure(figsize=(12, 12))
-        plt.imshow(debug_img)
-        plt.title("SAM Refinement Debug View")
-        plt.axis("off")
-        plt.savefig(os.path.join(output_dir, "sam_debug_visualization.png"), bbox_inches="tight", pad_inches=0)
-        plt.close()
+        with PYPLOT_LOCK:
+            plt.figure(figsize=(12, 12))
+            plt.imshow(debug_img)
+            plt.title("SAM Refinement Debug View")
+            plt.axis("off")
+            plt.savefig(os.path.join(output_dir, "sam_debug_visualization.png"), bbox_inches="tight", pad_inches=0)
+            plt.close()
 
     # Write enhanced analysis file
     enhanced_file = os.path.join(output_dir, "analysis_enhanced.txt")
@@ -1,9 +1,14 @@
 import logging
 import os
 import re
-from typing import Dict, Any, List
+from typing import Dict, Any, List, Optional
 import numpy as np
+import torch
 import torch.nn.functional as F
+from transformers import LogitsProcessorList, StoppingCriteria, StoppingCriteriaList
+
+from .constrained_decoding import Choice, Literal, Number, TemplateFSM, TemplateLogitsProcessor, Word
+from .prefix_cache import PrefixKVCache
 
 
 # Define transformation matrices with clear mathematical formulas
@@ -244,6 +249,13 @@ def parse_object_id_deepseek(reasoning):
         raise ValueError(f"Could not parse object ID from text: {id_text}")
 
 
+# The scene context is placed after the fixed instructions, so everything before this text is the same for every request
+PROMPT_SCENE_MARKERS = {"deepseek_r1_distill_qwen_32B": "SCENE CONTEXT:\n", "qwen2_5_math_7b_instruct": "Scene content: "}
+
+# KV state of the static prompt prefixes, shared by every request and retry
+prefix_kv_cache = PrefixKVCache()
+
+
 def generate_prompt(model_name, user_edit, objects, scene_desc, spatial_rel, device):
     scene_context = f"""Scene Information:
     
@@ -286,11 +298,11 @@ def generate_prompt(model_name, user_edit, objects, scene_desc, spatial_rel, dev
                 "Scale: [[sx  0.00  0.00], [0.00  sy  0.00], [0.00  0.00  1.00]]\n"
                 "Shear: [[1.00  shx  0.00], [shy  1.00  0.00], [0.00  0.00  1.00]]\n"
                 "Flip X: [[-1.00  0.00  0.00], [0.00  1.00  0.00], [0.00  0.00  1.00]]\n\n"
-                "SCENE CONTEXT:\n"
-                f"{scene_context}\n\n"
                 "CRITICAL: Your response must contain exactly one matrix between <<MATRIX_START>> and <<MATRIX_END>> tokens, "
                 "and exactly one object ID between <<OBJECT_ID_START>> and <<OBJECT_ID_END>> tokens.\n"
-                "The object ID must be one of the IDs listed in OBJECT DETAILS."
+                "The object ID must be one of the IDs listed in OBJECT DETAILS.\n\n"
+                "SCENE CONTEXT:\n"
+                f"{scene_context}"
             ),
         },
         {"role": "user", "content": user_edit},
@@ -299,9 +311,8 @@ def generate_prompt(model_name, user_edit, objects, scene_desc, spatial_rel, dev
         {
             "role": "system",
             "content": "Please integrate natural language reasoning with programs to solve the problem. Your task is to output a 3x3 transformation matrix and object ID based on the user's edit request.\n\n"
-            "Scene content: " + scene_context + "\n\n"
             "REQUIRED OUTPUT:\n"
-            "1. The word 'MATRIX' followed by the 3x3 transformation matrix\n"
+            "1. A line with only the word 'MATRIX', followed by the 3x3 transformation matrix\n"
             "2. The word 'OBJECT_ID' followed by the object ID number\n"
             "3. The word 'APPEARANCE' followed by the appearance token\n\n"
             "TRANSFORMATION MATRIX TEMPLATES:\n"
@@ -327,7 +338,8 @@ def generate_prompt(model_name, user_edit, objects, scene_desc, spatial_rel, dev
             "APPEARANCE: <TOKEN>\n"
             "If user does not want to change the appearance of the object, APPEARANCE: null\n"
             "This is important, do not change the appearance of the object if the user does not want to change it. APPEARANCE field can be the name of a color, texture, or any other visual property."
-            "If user does not want to change the appearance of the object appearance field should be null like this APPEARANCE: null\n",
+            "If user does not want to change the appearance of the object appearance field should be null like this APPEARANCE: null\n\n"
+            "Scene content: " + scene_context,
         },
         {"role": "user", "content": user_edit},
     ]
@@ -340,89 +352,410 @@ def generate_prompt(model_name, user_edit, objects, scene_desc, spatial_rel, dev
         raise ValueError(f"Model {model_name} not supported")
 
 
-def run_math_llm(model_name, model, tokenizer, user_edit, objects, scene_desc, spatial_rel, device, logger):
+def parse_math_output(model_name, reasoning):
+    """Parse the transformation matrix, object ID and appearance token from the model output."""
+    if model_name == "deepseek_r1_distill_qwen_32B":
+        matrix = parse_transformation_matrix_deepseek(reasoning)
+        object_id = parse_object_id_deepseek(reasoning)
+        # appearance_token = parse_appearance_token_deepseek(reasoning)
+        # The DeepSeek prompt does not ask for an appearance change
+        appearance_token = "null"
+    elif model_name == "qwen2_5_math_7b_instruct":
+        matrix = parse_transformation_matrix_qwen(reasoning)
+        object_id = parse_object_id_qwen(reasoning)
+        appearance_token = parse_appearance_token_qwen(reasoning)
+    else:
+        raise ValueError(f"Model {model_name} not supported")
+    return matrix, object_id, appearance_token
+
 
-    # 1. generate prompt
-    messages = generate_prompt(model_name, user_edit, objects, scene_desc, spatial_rel, device)
-    # Try parsing up to 5 times
-    for attempt in range(5):
-        text = tokenizer.apply_chat_template(messages, tokenize=False, add_generation_prompt=True)
-        model_inputs = tokenizer([text], return_tensors="pt").to(device)
+# Constrained decoding starts once the model opens its answer with this text
+CONSTRAINED_TRIGGERS = {"deepseek_r1_distill_qwen_32B": "</think>", "qwen2_5_math_7b_instruct": "MATRIX"}
+# Models whose trigger must be a whole output line; the Qwen prompt also mentions "TRANSFORMATION MATRIX" and "MATRIX RULES"
+CONSTRAINED_LINE_TRIGGERS = {"qwen2_5_math_7b_instruct"}
+# First literal of each output template, used to find the constrained answer in the generated text
+CONSTRAINED_TAIL_MARKERS = {"deepseek_r1_distill_qwen_32B": "<<MATRIX_START>>", "qwen2_5_math_7b_instruct": "\noutput:\n"}
 
-        generated_ids = model.generate(**model_inputs, max_new_tokens=1024)
-        generated_ids = [output_ids[len(input_ids) :] for input_ids, output_ids in zip(model_inputs.input_ids, generated_ids)]
 
-        reasoning = tokenizer.batch_decode(generated_ids, skip_special_tokens=True)[0]
+def _matrix_segments(opening: str, number_sep: str, row_sep: str, closing: str) -> list:
+    segments = [Literal(opening)]
+    for row in range(3):
+        for col in range(3):
+            segments.append(Number())
+            if col < 2:
+                segments.append(Literal(number_sep))
+        if row < 2:
+            segments.append(Literal(row_sep))
+    segments.append(Literal(closing))
+    return segments
 
-        logger.info(f"Model Reasoning (Attempt {attempt + 1}):")
 
+def build_output_fsm(model_name: str, object_ids: List[int]) -> TemplateFSM:
+    """Output template of the model, with the object ID restricted to `object_ids`."""
+    ids = [str(object_id) for object_id in object_ids] or ["1"]
+    if model_name == "deepseek_r1_distill_qwen_32B":
+        segments = _matrix_segments("<<MATRIX_START>>\n[[", "  ", "]\n [", "]]\n<<MATRIX_END>>\n<<OBJECT_ID_START>>")
+        segments += [Choice(ids), Literal("<<OBJECT_ID_END>>")]
+    elif model_name == "qwen2_5_math_7b_instruct":
+        # parse_transformation_matrix_qwen looks for a comma separated matrix after the word "output"
+        segments = _matrix_segments("\noutput:\n[[", ", ", "], [", "]]\nOBJECT_ID: ")
+        segments += [Choice(ids), Literal("\nAPPEARANCE: "), Word(), Literal("\n")]
+    else:
+        raise ValueError(f"Model {model_name} not supported")
+    return TemplateFSM(segments)
+
+
+class ParsedOutputStoppingCriteria(StoppingCriteria):
+    """Stops each row of a generation as soon as all required fields can be parsed.
+
+    The generated text of every row is decoded incrementally, one token per step. Whenever a word or a
+    <<..._END>> marker is completed, `parse_math_output` is tried on the text so far; on success the parsed
+    result is kept in `results` and the row is marked as finished.
+    """
+
+    def __init__(self, tokenizer, model_name: str, batch_size: int):
+        self.tokenizer = tokenizer
+        self.model_name = model_name
+        self.texts = [""] * batch_size
+        self.results = [None] * batch_size
+
+    def __call__(self, input_ids, scores, **kwargs):
+        done = []
+        for row in range(input_ids.shape[0]):
+            if self.results[row] is None:
+                piece = self.tokenizer.decode(input_ids[row, -1:], skip_special_tokens=True)
+                self.texts[row] += piece
+                boundaries = [idx for idx, c in enumerate(piece) if c.isspace() or c == ">"]
+                if boundaries:
+                    # Only parse up to the last completed word, so that e.g. "OBJECT_ID: 1" is not taken from "OBJECT_ID: 12"
+                    text = self.texts[row][: len(self.texts[row]) - len(piece) + boundaries[-1] + 1]
+                    try:
+                        self.results[row] = (*parse_math_output(self.model_name, text), text)
+                    except Exception:
+                        pass
+            done.append(self.results[row] is not None)
+        return torch.tensor(done, dtype=torch.bool, device=input_ids.device)
+
+
+def generate_batch(
+    model,
+    tokenizer,
+    texts: List[str],
+    device,
+    max_new_tokens: int = 1024,
+    seed=None,
+    stopping_criteria=None,
+    logits_processor=None,
+    prefix_text: Optional[str] = None,
+    do_sample: Optional[bool] = None,
+) -> List[str]:
+    """Generate completions for several chat prompts in one left-padded batch.
+
+    Left padding keeps the generated tokens of every row aligned at the end of the prompt, and the
+    attention mask excludes the padding. Sampling draws from one RNG stream for the whole batch, so only
+    greedy decoding (`do_sample=False`) can reproduce a batch of one, see `check_batch_equivalence`.
+    `do_sample=None` keeps the model's generation config (DeepSeek-R1-Distill samples by default).
+    If `prefix_text` is given (a text every prompt starts with), its KV state comes from `prefix_kv_cache`
+    and only the rest of the prompts is prefilled.
+    """
+    if tokenizer.pad_token is None:
+        tokenizer.pad_token = tokenizer.eos_token
+    if prefix_text is not None:
+        model_inputs = prefix_kv_cache.build_inputs(model, tokenizer, texts, prefix_text, device)
+    else:
+        padding_side = tokenizer.padding_side
+        tokenizer.padding_side = "left"
         try:
-            if model_name == "deepseek_r1_distill_qwen_32B":
-                matrix = parse_transformation_matrix_deepseek(reasoning)
-                object_id = parse_object_id_deepseek(reasoning)
-                # appearance_token = parse_appearance_token_deepseek(reasoning)
-            elif model_name == "qwen2_5_math_7b_instruct":
-                matrix = parse_transformation_matrix_qwen(reasoning)
-                object_id = parse_object_id_qwen(reasoning)
-                appearance_token = parse_appearance_token_qwen(reasoning)
-            else:
-                raise ValueError(f"Model {model_name} not supported")
-            return matrix, object_id, appearance_token, reasoning
-        except Exception as e:  # Catch specific exception for better error handling
-            if attempt == 4:  # Last attempt
-                logger.warning(f"Failed to parse matrix after 5 attempts: {str(e)}, using identity matrix and object_id=1")
-                identity_matrix = np.array([[1.0, 0.0, 0.0], [0.0, 1.0, 0.0], [0.0, 0.0, 1.0]])
-                return identity_matrix, 1, "null", reasoning
-            logger.error(f"Failed to parse matrix on attempt {attempt + 1}: {str(e)}, retrying...")
-            continue
-
-
-def run_math_analysis(user_edit: str, file_path: str, model_name: str, model: Any, tokenizer: Any, device: str, logger):
-    try:
-        # 0. parse detection file with enhanced information
-        file_dir = os.path.dirname(file_path)
-        objects, scene_desc, spatial_rel = parse_detection_file(file_path)
-
-        # 2. run math llm
-        matrix_array, object_id, appearance_token, reasoning = run_math_llm(
-            model_name, model, tokenizer, user_edit, objects, scene_desc, spatial_rel, device, logger
+            model_inputs = tokenizer(texts, return_tensors="pt", padding=True).to(device)
+        finally:
+            tokenizer.padding_side = padding_side
+
+    if seed is not None:
+        torch.manual_seed(seed)
+    sampling = {}
+    if do_sample is False:
+        # Unset the sampling parameters of the generation config, which only apply when sampling
+        sampling = {"do_sample": False, "temperature": None, "top_p": None, "top_k": None}
+    elif do_sample:
+        sampling = {"do_sample": True}
+    generated_ids = model.generate(
+        **model_inputs,
+        max_new_tokens=max_new_tokens,
+        pad_token_id=tokenizer.pad_token_id,
+        stopping_criteria=stopping_criteria,
+        logits_processor=logits_processor,
+        **sampling,
+    )
+    generated_ids = generated_ids[:, model_inputs["input_ids"].shape[1] :]
+
+    return tokenizer.batch_decode(generated_ids, skip_special_tokens=True)
+
+
+def prompt_prefix(model_name, texts: List[str]) -> Optional[str]:
+    """The fixed instructions before the scene marker of the first prompt, or None if the marker is missing."""
+    if not texts:
+        return None
+    end = texts[0].find(PROMPT_SCENE_MARKERS[model_name])
+    if end <= 0:
+        # Without the marker the prefix would be nearly the whole, per-request prompt
+        logging.warning(f"Scene marker of {model_name} not found in the prompt, not reusing the prompt prefix")
+        return None
+    return texts[0][:end]
+
+
+def build_prompt_texts(model_name, tokenizer, requests: List[Dict[str, Any]], device) -> List[str]:
+    """Chat template text of the math LLM prompt of every request."""
+    texts = []
+    for request in requests:
+        messages = generate_prompt(
+            model_name, request["user_edit"], request["objects"], request["scene_desc"], request["spatial_rel"], device
+        )
+        texts.append(tokenizer.apply_chat_template(messages, tokenize=False, add_generation_prompt=True))
+    return texts
+
+
+def check_batch_equivalence(
+    model_name, model, tokenizer, requests: List[Dict[str, Any]], device, logger, max_new_tokens: int = 1024, reuse_prefix: bool = True
+) -> List[bool]:
+    """Check that greedy batched generation gives every request the same output as a batch of one.
+
+    Args:
+        requests: Dicts with the keys user_edit, objects, scene_desc and spatial_rel, see `run_math_llm_batch`
+
+    Returns:
+        List telling for every request whether its batched output equals its batch-of-one output
+    """
+    texts = build_prompt_texts(model_name, tokenizer, requests, device)
+    prefix_text = prompt_prefix(model_name, texts) if reuse_prefix else None
+    batched = generate_batch(model, tokenizer, texts, device, max_new_tokens=max_new_tokens, prefix_text=prefix_text, do_sample=False)
+    matches = []
+    for i, (text, batched_output) in enumerate(zip(texts, batched)):
+        single_output = generate_batch(
+            model, tokenizer, [text], device, max_new_tokens=max_new_tokens, prefix_text=prefix_text, do_sample=False
+        )[0]
+        matches.append(single_output == batched_output)
+        if not matches[-1]:
+            logger.warning(f"Request {i + 1}: batched output differs from the batch-of-one output")
+    logger.info(f"Batch equivalence: {sum(matches)}/{len(matches)} requests match")
+    return matches
+
+
+def run_math_llm_batch(
+    model_name,
+    model,
+    tokenizer,
+    requests: List[Dict[str, Any]],
+    device,
+    logger,
+    max_attempts: int = 5,
+    seed=None,
+    early_stop: bool = True,
+    constrained: bool = False,
+    max_new_tokens: int = 1024,
+    reuse_prefix: bool = True,
+    do_sample: Optional[bool] = None,
+):
+    """Run the math LLM on several requests at once.
+
+    Args:
+        requests: Dicts with the keys user_edit, objects, scene_desc and spatial_rel
+        max_attempts: Rows whose output cannot be parsed are re-submitted together, up to this many times
+        seed: If set, the torch seed before each generation round is seed + attempt
+        early_stop: Stop decoding a row once its matrix, object ID (and appearance) parse, see `ParsedOutputStoppingCriteria`
+        constrained: Force the answer into the output template of the model, with the object ID restricted to the
+            IDs of the request, see `build_output_fsm`. Reasoning before the answer is unconstrained; the answer is
+            forced once the model starts it or the token budget runs low, so it always parses on the first attempt.
+        max_new_tokens: Token budget of each generation
+        reuse_prefix: Reuse the KV state of the fixed instructions at the start of the system prompt, see `PrefixKVCache`
+        do_sample: False for greedy decoding, which makes every row independent of the rest of the batch;
+            None keeps the model's generation config
+
+    Returns:
+        List of (matrix, object_id, appearance_token, reasoning) tuples in request order
+    """
+    texts = build_prompt_texts(model_name, tokenizer, requests, device)
+    prefix_text = prompt_prefix(model_name, texts) if reuse_prefix else None
+
+    results = [None] * len(requests)
+    reasonings = [""] * len(requests)
+    pending = list(range(len(requests)))
+    for attempt in range(max_attempts):
+        if not pending:
+            break
+        # A constrained row ends with EOS as soon as its template is complete, so it needs no stopping criteria
+        criteria = ParsedOutputStoppingCriteria(tokenizer, model_name, len(pending)) if early_stop and not constrained else None
+        processor = None
+        if constrained:
+            fsms = [build_output_fsm(model_name, [obj["id"] for obj in requests[i]["objects"]]) for i in pending]
+            processor = TemplateLogitsProcessor(
+                tokenizer,
+                fsms,
+                max_new_tokens,
+                trigger=CONSTRAINED_TRIGGERS[model_name],
+                trigger_line=model_name in CONSTRAINED_LINE_TRIGGERS,
+            )
+        outputs = generate_batch(
+            model,
+            tokenizer,
+            [texts[i] for i in pending],
+            device,
+            max_new_tokens=max_new_tokens,
+            seed=None if seed is None else seed + attempt,
+            stopping_criteria=StoppingCriteriaList([criteria]) if criteria is not None else None,
+            logits_processor=LogitsProcessorList([processor]) if processor is not None else None,
+            prefix_text=prefix_text,
+            do_sample=do_sample,
         )
 
-        logger.info("Parsed Matrix: \n" + str(matrix_array))
-        logger.info("Object ID:" + str(object_id))
-        logger.info("Appearance Token:" + str(appearance_token))
-        # 3. save files
-        TRANSFORMATION_MATRIX_FILE = f"{file_dir}/transformation_matrix.npy"
-        np.save(TRANSFORMATION_MATRIX_FILE, matrix_array)
-
-        REASONING_FILE = f"{file_dir}/math_reasoning.txt"
-        with open(REASONING_FILE, "w") as f:
-            f.write(reasoning)
-
-        OBJECT_ID_FILE = f"{file_dir}/object_id.txt"
-        with open(OBJECT_ID_FILE, "w") as f:
-            f.write(str(object_id))
-
-        # 4. save appearance token
-        ENHANCED_FILE_DESCRIPTION = f"{file_dir}/analysis_enhanced.txt"
-        with open(ENHANCED_FILE_DESCRIPTION, "r") as token_file:
-            analysis_lines = token_file.readlines()
-
-        for i, line in enumerate(analysis_lines):
-            if f"Object {object_id}:" in line:
-                appearance_token_line = f"  Appearance Token: {appearance_token}\n"
-                analysis_lines.insert(i + 2, appearance_token_line)
-                break
-
-        with open(ENHANCED_FILE_DESCRIPTION, "w") as token_file:
-            token_file.writelines(analysis_lines)
-
-        APPEARANCE_TOKEN_FILE = f"{file_dir}/appearance_token.txt"
-        with open(APPEARANCE_TOKEN_FILE, "w") as f:
-            f.write(str(appearance_token))
-
-        return matrix_array, object_id, appearance_token
+        failed = []
+        for row, (i, reasoning) in enumerate(zip(pending, outputs)):
+            logger.info(f"Model Reasoning (Request {i + 1}, Attempt {attempt + 1}):")
+            reasonings[i] = reasoning
+            # Rows stopped early were already parsed while streaming
+            if criteria is not None and criteria.results[row] is not None:
+                results[i] = criteria.results[row]
+                continue
+            answer = reasoning
+            if constrained:
+                # Only the forced answer is parsed, not matrices written while reasoning
+                answer = reasoning[max(reasoning.rfind(CONSTRAINED_TAIL_MARKERS[model_name]), 0) :]
+            try:
+                results[i] = (*parse_math_output(model_name, answer), reasoning)
+            except Exception as e:  # Catch specific exception for better error handling
+                if attempt < max_attempts - 1:
+                    logger.error(f"Failed to parse matrix on attempt {attempt + 1}: {str(e)}, retrying...")
+                else:
+                    logger.warning(f"Failed to parse matrix after {max_attempts} attempts: {str(e)}, using identity matrix and object_id=1")
+                failed.append(i)
+        pending = failed
+
+    for i in pending:
+        identity_matrix = np.array([[1.0, 0.0, 0.0], [0.0, 1.0, 0.0], [0.0, 0.0, 1.0]])
+        results[i] = (identity_matrix, 1, "null", reasonings[i])
+
+    return results
+
+
+def run_math_llm(
+    model_name, model, tokenizer, user_edit, objects, scene_desc, spatial_rel, device, logger, constrained: bool = False, seed=None, do_sample=None
+):
+    request = {"user_edit": user_edit, "objects": objects, "scene_desc": scene_desc, "spatial_rel": spatial_rel}
+    return run_math_llm_batch(
+        model_name, model, tokenizer, [request], device, logger, constrained=constrained, seed=seed, do_sample=do_sample
+    )[0]
+
+
+def save_math_results(file_path: str, matrix_array, object_id, appearance_token, reasoning) -> None:
+    """Write the math LLM results next to the analysis file and add the appearance token to analysis_enhanced.txt"""
+    file_dir = os.path.dirname(file_path)
+
+    # 3. save files
+    TRANSFORMATION_MATRIX_FILE = f"{file_dir}/transformation_matrix.npy"
+    np.save(TRANSFORMATION_MATRIX_FILE, matrix_array)
+
+    REASONING_FILE = f"{file_dir}/math_reasoning.txt"
+    with open(REASONING_FILE, "w") as f:
+        f.write(reasoning)
+
+    OBJECT_ID_FILE = f"{file_dir}/object_id.txt"
+    with open(OBJECT_ID_FILE, "w") as f:
+        f.write(str(object_id))
+
+    # 4. save appearance token
+    ENHANCED_FILE_DESCRIPTION = f"{file_dir}/analysis_enhanced.txt"
+    with open(ENHANCED_FILE_DESCRIPTION, "r") as token_file:
+        analysis_lines = token_file.readlines()
+
+    for i, line in enumerate(analysis_lines):
+        if f"Object {object_id}:" in line:
+            appearance_token_line = f"  Appearance Token: {appearance_token}\n"
+            analysis_lines.insert(i + 2, appearance_token_line)
+            break
 
+    with open(ENHANCED_FILE_DESCRIPTION, "w") as token_file:
+        token_file.writelines(analysis_lines)
+
+    APPEARANCE_TOKEN_FILE = f"{file_dir}/appearance_token.txt"
+    with open(APPEARANCE_TOKEN_FILE, "w") as f:
+        f.write(str(appearance_token))
+
+
+def run_math_analysis_batch(
+    user_edits: List[str],
+    file_paths: List[str],
+    model_name: str,
+    model: Any,
+    tokenizer: Any,
+    device: str,
+    logger,
+    constrained: bool = False,
+    seed: Optional[int] = None,
+    do_sample: Optional[bool] = None,
+) -> List[Any]:
+    """Batched `run_math_analysis`: one math LLM generation for all samples.
+
+    Args:
+        constrained: Use grammar constrained decoding for the answer, see `run_math_llm_batch`
+        seed: Torch seed of the generation, see `run_math_llm_batch`
+        do_sample: False for greedy decoding, so that every sample gets the output of a batch of one
+
+    Returns:
+        List with a (matrix_array, object_id, appearance_token) tuple per sample, or the exception raised for that sample
+    """
+    outputs: List[Any] = [None] * len(file_paths)
+    requests, request_indices = [], []
+    for i, (user_edit, file_path) in enumerate(zip(user_edits, file_paths)):
+        try:
+            # 0. parse detection file with enhanced information
+            objects, scene_desc, spatial_rel = parse_detection_file(file_path)
+            requests.append({"user_edit": user_edit, "objects": objects, "scene_desc": scene_desc, "spatial_rel": spatial_rel})
+            request_indices.append(i)
+        except Exception as e:
+            logging.error(f"Error in mathematical analysis for {file_path}: {str(e)}")
+            outputs[i] = e
+
+    # 2. run math llm
+    try:
+        results = (
+            run_math_llm_batch(model_name, model, tokenizer, requests, device, logger, constrained=constrained, seed=seed, do_sample=do_sample)
+            if requests
+            else []
+        )
     except Exception as e:
-        logging.error(f"Error in mathematical analysis for {file_path}: {str(e)}")
-        raise
+        logging.error(f"Error in mathematical analysis for {file_paths}: {str(e)}")
+        for i in request_indices:
+            outputs[i] = e
+        return outputs
+
+    for i, (matrix_array, object_id, appearance_token, reasoning) in zip(request_indices, results):
+        try:
+            logger.info("Parsed Matrix: \n" + str(matrix_array))
+            logger.info("Object ID:" + str(object_id))
+            logger.info("Appearance Token:" + str(appearance_token))
+            save_math_results(file_paths[i], matrix_array, object_id, appearance_token, reasoning)
+            outputs[i] = (matrix_array, object_id, appearance_token)
+        except Exception as e:
+            logging.error(f"Error in mathematical analysis for {file_paths[i]}: {str(e)}")
+            outputs[i] = e
+
+    return outputs
+
+
+def run_math_analysis(
+    user_edit: str,
+    file_path: str,
+    model_name: str,
+    model: Any,
+    tokenizer: Any,
+    device: str,
+    logger,
+    constrained: bool = False,
+    seed: Optional[int] = None,
+    do_sample: Optional[bool] = None,
+):
+    output = run_math_analysis_batch(
+        [user_edit], [file_path], model_name, model, tokenizer, device, logger, constrained=constrained, seed=seed, do_sample=do_sample
+    )[0]
+    if isinstance(output, Exception):
+        raise output
+    return output
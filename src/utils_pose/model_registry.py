@@ -0,0 +1,297 @@
+import glob
+import hashlib
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, Iterator, List, Optional, Union
+
+import torch
+
+# Tiers a registered model can live in
+DEVICE, CPU, DISK = "device", "cpu", "disk"
+
+ModuleSource = Union[torch.nn.Module, List[torch.nn.Module], Callable[[], List[torch.nn.Module]]]
+
+
+def module_bytes(modules: List[torch.nn.Module]) -> int:
+    """Size of the parameters and buffers of `modules`; tensors shared between modules are counted once."""
+    seen, total = set(), 0
+    for module in modules:
+        for tensor in list(module.parameters()) + list(module.buffers()):
+            if tensor.device.type == "meta" or tensor.data_ptr() in seen:
+                continue
+            seen.add(tensor.data_ptr())
+            total += tensor.numel() * tensor.element_size()
+    return total
+
+
+def unique_tensors(modules: List[torch.nn.Module]) -> List[torch.Tensor]:
+    """Parameters and buffers of `modules`, each (possibly tied) tensor object once, in a stable order."""
+    seen, tensors = set(), []
+    for module in modules:
+        for tensor in list(module.parameters()) + list(module.buffers()):
+            if id(tensor) not in seen:
+                seen.add(id(tensor))
+                tensors.append(tensor)
+    return tensors
+
+
+def named_unique_tensors(modules: List[torch.nn.Module]) -> Dict[str, torch.Tensor]:
+    """`unique_tensors` keyed by "<module index>.<qualified parameter or buffer name>"."""
+    seen, tensors = set(), {}
+    for i, module in enumerate(modules):
+        for name, tensor in list(module.named_parameters()) + list(module.named_buffers()):
+            if id(tensor) not in seen:
+                seen.add(id(tensor))
+                tensors[f"{i}.{name}"] = tensor
+    return tensors
+
+
+def tensors_signature(tensors: Dict[str, torch.Tensor]) -> str:
+    """Digest of the names, shapes and dtypes of `tensors`; tells whether an offload file still matches a model."""
+    layout = [(name, tuple(tensor.shape), str(tensor.dtype)) for name, tensor in tensors.items()]
+    return hashlib.sha256(repr(layout).encode()).hexdigest()
+
+
+def find_modules(obj: Any, depth: int = 2) -> List[torch.nn.Module]:
+    """The torch modules of a wrapper object (e.g. an ultralytics or autodistill model), searched `depth` attributes deep."""
+    if isinstance(obj, torch.nn.Module):
+        return [obj]
+    if depth == 0 or obj is None or isinstance(obj, (str, bytes, int, float, bool)):
+        return []
+    modules = []
+    for value in list(vars(obj).values()) if hasattr(obj, "__dict__") else []:
+        for module in find_modules(value, depth - 1):
+            if all(module is not m for m in modules):
+                modules.append(module)
+    return modules
+
+
+class _Entry:
+    def __init__(self, name: str, modules: ModuleSource, device: str, offloadable: bool, footprint: Optional[int]):
+        self.name = name
+        self.source = modules
+        self.device = device
+        self.offloadable = offloadable
+        self.tier = DEVICE
+        self.in_use = 0
+        self.footprint = footprint if footprint is not None else module_bytes(self.modules())
+
+    def modules(self) -> List[torch.nn.Module]:
+        if callable(self.source) and not isinstance(self.source, torch.nn.Module):
+            return self.source()
+        return self.source if isinstance(self.source, list) else [self.source]
+
+
+class ModelRegistry:
+    """Keeps the models of the pipeline within a memory budget per device.
+
+    Every model is registered with the device it runs on and its footprint. Before a model is used
+    (`use`), the least recently used idle models of the same device are moved out until it fits the
+    device budget: to pinned CPU memory, or, once the CPU budget is used up, to safetensors files
+    in `offload_dir` that are memory-mapped when the model comes back. Moves are done in place, so
+    references held by the callers stay valid. Load, evict and restore times are recorded for `report`.
+    """
+
+    def __init__(
+        self,
+        budgets: Optional[Dict[str, float]] = None,
+        cpu_budget: Optional[float] = None,
+        offload_dir: Optional[str] = None,
+        logger: Optional[logging.Logger] = None,
+    ):
+        """
+        Args:
+            budgets: Memory budget in bytes per device (e.g. {"cuda:0": 40e9}); devices without a budget are unconstrained
+            cpu_budget: Bytes of pinned CPU memory for offloaded models; beyond it models go to disk (None: unlimited)
+            offload_dir: Directory for the safetensors files of models offloaded to disk (None: no disk tier)
+            logger: Logger for loads and moves
+        """
+        self.budgets = dict(budgets or {})
+        self.cpu_budget = cpu_budget
+        self.offload_dir = offload_dir
+        self.logger = logger or logging.getLogger(__name__)
+        self.entries: "OrderedDict[str, _Entry]" = OrderedDict()
+        self.timings: Dict[str, Dict[str, List[float]]] = {}
+        self.condition = threading.Condition(threading.RLock())
+        if offload_dir:
+            os.makedirs(offload_dir, exist_ok=True)
+            # Files of an earlier run may belong to other weights
+            for path in glob.glob(os.path.join(offload_dir, "*.safetensors")):
+                os.remove(path)
+
+    def _record(self, name: str, event: str, seconds: float) -> None:
+        self.timings.setdefault(name, {}).setdefault(event, []).append(seconds)
+
+    def _used(self, device: str, tier: str = DEVICE) -> int:
+        return sum(entry.footprint for entry in self.entries.values() if entry.tier == tier and (tier != DEVICE or entry.device == device))
+
+    def load(
+        self,
+        name: str,
+        loader: Callable[[], Any],
+        device: str,
+        footprint: Optional[float] = None,
+        modules: Optional[Callable[[Any], ModuleSource]] = None,
+    ) -> Any:
+        """Make room for a model, load it with `loader()` and register it.
+
+        Args:
+            name: Registry name
+            loader: Loads the model onto `device` and returns it
+            device: Device the model runs on
+            footprint: Expected size in bytes, used to make room before loading (None: measured after loading)
+            modules: Maps the loaded object to its torch modules (default: `find_modules`)
+
+        Returns:
+            Any: The loaded object
+        """
+        with self.condition:
+            if footprint is not None:
+                self._make_room(device, int(footprint), exclude=name)
+            start = time.time()
+            obj = loader()
+            self._record(name, "load", time.time() - start)
+            found = modules(obj) if modules is not None else find_modules(obj)
+            # Without torch modules (e.g. an external inference engine) the expected footprint is all we know
+            self.register(name, found, device, footprint=None if found else footprint)
+            return obj
+
+    def register(self, name: str, modules: ModuleSource, device: str, offloadable: bool = True, footprint: Optional[float] = None) -> None:
+        """Register modules that are already on `device`.
+
+        Args:
+            name: Registry name
+            modules: A module, a list of modules, or a callable returning the current list (for lazily loaded parts)
+            device: Device the modules run on
+            offloadable: False for models that cannot be moved (e.g. external inference engines); they only count against the budget
+            footprint: Size in bytes if it cannot be measured from the modules
+        """
+        with self.condition:
+            entry = _Entry(name, modules, device, offloadable, footprint)
+            entry.offloadable = offloadable and len(entry.modules()) > 0
+            self.entries[name] = entry
+            self.entries.move_to_end(name)
+            self.logger.info(f"Registered {name} on {device} ({entry.footprint / 1e9:.2f} GB)")
+            self._make_room(device, 0, exclude=name)
+
+    def _make_room(self, device: str, required: int, exclude: str) -> None:
+        budget = self.budgets.get(device)
+        if budget is None or device == "cpu":
+            return
+        while self._used(device) + required > budget:
+            idle = [e for e in self.entries.values() if e.tier == DEVICE and e.device == device and e.name != exclude and e.offloadable and e.in_use == 0]
+            if idle:
+                # `entries` is kept in least recently used order
+                self._evict(idle[0])
+            elif any(e.in_use and e.device == device and e.name != exclude for e in self.entries.values()):
+                # Wait until another stage releases its model
+                self.condition.wait()
+            else:
+                self.logger.warning(f"{device}: {exclude} does not fit the budget of {budget / 1e9:.1f} GB, continuing over budget")
+                return
+
+    def _evict(self, entry: _Entry) -> None:
+        start = time.time()
+        to_disk = self.offload_dir is not None and self.cpu_budget is not None and self._used("cpu", CPU) + entry.footprint > self.cpu_budget
+        if to_disk:
+            self._to_disk(entry)
+        else:
+            # Moves swap `.data`, so tied weights and the parameters held by optimizers or hooks stay the same objects
+            for tensor in unique_tensors(entry.modules()):
+                tensor.data = tensor.data.to("cpu")
+                if torch.cuda.is_available():
+                    tensor.data = tensor.data.pin_memory()
+            entry.tier = CPU
+        seconds = time.time() - start
+        self._record(entry.name, f"evict_{entry.tier}", seconds)
+        self.logger.info(f"Evicted {entry.name} from {entry.device} to {entry.tier} in {seconds:.2f}s")
+        if entry.tier == CPU:
+            self._trim_cpu(exclude=entry.name)
+
+    def _trim_cpu(self, exclude: str) -> None:
+        if self.offload_dir is None or self.cpu_budget is None:
+            return
+        for entry in list(self.entries.values()):
+            if self._used("cpu", CPU) <= self.cpu_budget:
+                return
+            if entry.tier == CPU and entry.name != exclude:
+                start = time.time()
+                self._to_disk(entry)
+                self._record(entry.name, "evict_disk", time.time() - start)
+
+    def _disk_path(self, entry: _Entry) -> str:
+        return os.path.join(self.offload_dir, f"{entry.name}.safetensors")
+
+    def _to_disk(self, entry: _Entry) -> None:
+        from safetensors import safe_open
+        from safetensors.torch import save_file
+
+        tensors = named_unique_tensors(entry.modules())
+        signature = tensors_signature(tensors)
+        path = self._disk_path(entry)
+        # The weights are frozen, so a file written by an earlier eviction is reused as long as the model has
+        # the same tensors (a model group gains tensors when a lazily loaded part comes in)
+        reuse = False
+        if os.path.isfile(path):
+            with safe_open(path, framework="pt", device="cpu") as f:
+                reuse = (f.metadata() or {}).get("signature") == signature
+        if not reuse:
+            # Written next to the old file and swapped in, as tensors may still map the old file
+            tmp_path = f"{path}.tmp"
+            save_file(
+                {name: tensor.data.detach().to("cpu", copy=True).contiguous() for name, tensor in tensors.items()},
+                tmp_path,
+                metadata={"signature": signature},
+            )
+            os.replace(tmp_path, path)
+        # The tensors now point into the memory-mapped file, whose pages the OS can drop
+        with safe_open(path, framework="pt", device="cpu") as f:
+            for name, tensor in tensors.items():
+                tensor.data = f.get_tensor(name)
+        entry.tier = DISK
+
+    def _restore(self, entry: _Entry) -> None:
+        start = time.time()
+        source = entry.tier
+        for tensor in unique_tensors(entry.modules()):
+            tensor.data = tensor.data.to(entry.device, non_blocking=source == CPU)
+        if str(entry.device).startswith("cuda"):
+            torch.cuda.synchronize(entry.device)
+        entry.tier = DEVICE
+        seconds = time.time() - start
+        self._record(entry.name, f"restore_{source}", seconds)
+        self.logger.info(f"Restored {entry.name} from {source} to {entry.device} in {seconds:.2f}s")
+
+    @contextmanager
+    def use(self, name: str) -> Iterator[None]:
+        """Keep model `name` on its device for the duration of the block; idle models are evicted to make room."""
+        with self.condition:
+            entry = self.entries[name]
+            if entry.tier != DEVICE:
+                self._make_room(entry.device, entry.footprint, exclude=name)
+                self._restore(entry)
+            entry.in_use += 1
+            self.entries.move_to_end(name)
+        try:
+            yield
+        finally:
+            with self.condition:
+                entry.in_use -= 1
+                if callable(entry.source) and not isinstance(entry.source, torch.nn.Module):
+                    # Lazily loaded parts of a model group count once they exist
+                    entry.footprint = module_bytes(entry.modules())
+                self.condition.notify_all()
+
+    def report(self) -> List[str]:
+        """One line per model with its tier and its load, evict and restore timings."""
+        lines = []
+        for name, entry in self.entries.items():
+            events = ", ".join(
+                f"{event} {len(times)}x {sum(times):.1f}s" for event, times in sorted(self.timings.get(name, {}).items())
+            )
+            lines.append(f"- Model {name} ({entry.footprint / 1e9:.1f} GB, {entry.device}, now {entry.tier}): {events or 'resident'}")
+        return lines
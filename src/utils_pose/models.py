@@ -1,5 +1,5 @@
 import logging
-from typing import Dict, Any, Tuple, Optional
+from typing import Dict, Any, Callable, Tuple, Optional
 from lmdeploy import pipeline
 import torch
 from transformers import (
@@ -14,25 +14,71 @@ from lmdeploy import pipeline, PytorchEngineConfig, TurbomindEngineConfig
 from autodistill.detection import CaptionOntology
 from autodistill_grounded_sam_2 import GroundedSAM2
 
+from .model_registry import ModelRegistry
+
+# Expected weights in memory (GB, as loaded below), used to make room before a model is loaded
+MODEL_FOOTPRINTS_GB = {
+    "grounding_dino": 1.5,
+    "intern_vl_2_5_8B": 18.0,
+    "qwen_2_5_vl_7b": 16.6,
+    "ovis1_6_gemma2_27B": 55.0,
+    "qwen2_5_math_7b_instruct": 15.2,
+    "deepseek_r1_distill_qwen_32B": 65.5,
+    "sam": 0.3,
+}
+
 
 class Models:
-    def __init__(self, device_reasoning: str = "cuda", DEEP_SEEK_GPU: str = "cuda"):
-        """Initialize model container"""
+    def __init__(
+        self,
+        device_reasoning: str = "cuda",
+        DEEP_SEEK_GPU: str = "cuda",
+        gpu_budget_gb: Optional[float] = None,
+        cpu_budget_gb: Optional[float] = None,
+        offload_dir: Optional[str] = None,
+    ):
+        """Initialize model container
+
+        Args:
+            device_reasoning: Device of the VLM and the detection models
+            DEEP_SEEK_GPU: Device of the math LLM (may be the same as `device_reasoning`)
+            gpu_budget_gb: Memory budget per device; idle models are offloaded to stay within it (None: keep every model resident)
+            cpu_budget_gb: Pinned CPU memory for offloaded models; beyond it they go to `offload_dir` (None: unlimited)
+            offload_dir: Directory for models offloaded to disk
+        """
         self.device_reasoning = device_reasoning
         self.DEEP_SEEK_GPU = DEEP_SEEK_GPU
         self.models: Dict[str, Any] = {}
         self.processors: Dict[str, Any] = {}
         self.tokenizers: Dict[str, Any] = {}
+        budgets = {device: gpu_budget_gb * 1e9 for device in {device_reasoning, DEEP_SEEK_GPU}} if gpu_budget_gb else None
+        self.registry = ModelRegistry(
+            budgets=budgets,
+            cpu_budget=cpu_budget_gb * 1e9 if cpu_budget_gb else None,
+            offload_dir=offload_dir,
+        )
+
+    def _load(self, name: str, loader: Callable[[], Any], device: str, modules: Optional[Callable[[Any], Any]] = None) -> Any:
+        """Load a model through the registry, which makes room for it on `device` and records the load time"""
+        return self.registry.load(name, loader, device, footprint=MODEL_FOOTPRINTS_GB[name] * 1e9, modules=modules)
+
+    def use(self, name: str):
+        """Context manager keeping model `name` on its device (see `ModelRegistry.use`)"""
+        return self.registry.use(name)
 
     def load_grounding_dino(self) -> None:
         """Load Grounding DINO model"""
-        base_model = GroundedSAM2(
-            ontology=CaptionOntology(
-                {
-                    "object": "object",
-                }
+        base_model = self._load(
+            "grounding_dino",
+            lambda: GroundedSAM2(
+                ontology=CaptionOntology(
+                    {
+                        "object": "object",
+                    }
+                ),
+                model="Grounding DINO",
             ),
-            model="Grounding DINO",
+            self.device_reasoning,
         )
 
         self.models["grounding_dino"] = base_model
@@ -59,7 +105,13 @@ class Models:
             #     AutoModel.from_pretrained(path, torch_dtype=torch.bfloat16, low_cpu_mem_usage=True, use_flash_attn=True, trust_remote_code=True).eval().cuda()
             # )
             model = "OpenGVLab/InternVL2_5-8B-MPO"
-            pipe = pipeline(model, backend_config=TurbomindEngineConfig(session_len=8192))
+            # The TurboMind engine manages its own memory; the registry only counts it against the budget
+            pipe = self._load(
+                "intern_vl_2_5_8B",
+                lambda: pipeline(model, backend_config=TurbomindEngineConfig(session_len=8192)),
+                self.device_reasoning,
+                modules=lambda _: [],
+            )
             self.models["intern_vl_2_5_8B"] = pipe
             logging.info("Loaded intern_vl_2_5_8B model successfully")
         except Exception as e:
@@ -71,8 +123,12 @@ class Models:
         """Load Qwen VL model and processor"""
         try:
             # Automatically map model to available devices
-            self.models["qwen_2_5_vl_7b"] = Qwen2VLForConditionalGeneration.from_pretrained(
-                "Qwen/Qwen2-VL-7B-Instruct", torch_dtype=torch.bfloat16, device_map={"": self.device_reasoning}
+            self.models["qwen_2_5_vl_7b"] = self._load(
+                "qwen_2_5_vl_7b",
+                lambda: Qwen2VLForConditionalGeneration.from_pretrained(
+                    "Qwen/Qwen2-VL-7B-Instruct", torch_dtype=torch.bfloat16, device_map={"": self.device_reasoning}
+                ),
+                self.device_reasoning,
             )
             self.processors["qwen_2_5_vl_7b"] = AutoProcessor.from_pretrained("Qwen/Qwen2-VL-7B-Instruct")
             logging.info("Loaded Qwen VL model successfully")
@@ -84,9 +140,13 @@ class Models:
     def load_ovis1_6_gemma2_27B(self) -> None:
         """Load Ovis1.6-Gemma2-27B model"""
         try:
-            model = AutoModelForCausalLM.from_pretrained(
-                "AIDC-AI/Ovis1.6-Gemma2-27B", torch_dtype=torch.bfloat16, multimodal_max_length=8192, trust_remote_code=True
-            ).to(self.device_reasoning)
+            model = self._load(
+                "ovis1_6_gemma2_27B",
+                lambda: AutoModelForCausalLM.from_pretrained(
+                    "AIDC-AI/Ovis1.6-Gemma2-27B", torch_dtype=torch.bfloat16, multimodal_max_length=8192, trust_remote_code=True
+                ).to(self.device_reasoning),
+                self.device_reasoning,
+            )
             text_tokenizer = model.get_text_tokenizer()
 
             self.models["ovis1_6_gemma2_27B"] = (model, text_tokenizer)
@@ -101,10 +161,14 @@ class Models:
         try:
             model_name = "Qwen/Qwen2.5-Math-7B-Instruct"
 
-            model = AutoModelForCausalLM.from_pretrained(
-                model_name,
-                torch_dtype=torch.bfloat16,
-                device_map={"": self.DEEP_SEEK_GPU},
+            model = self._load(
+                "qwen2_5_math_7b_instruct",
+                lambda: AutoModelForCausalLM.from_pretrained(
+                    model_name,
+                    torch_dtype=torch.bfloat16,
+                    device_map={"": self.DEEP_SEEK_GPU},
+                ),
+                self.DEEP_SEEK_GPU,
             )
             tokenizer = AutoTokenizer.from_pretrained(model_name)
 
@@ -120,10 +184,14 @@ class Models:
         try:
             model_name = "deepseek-ai/DeepSeek-R1-Distill-Qwen-32B"
 
-            model = AutoModelForCausalLM.from_pretrained(
-                model_name,
-                torch_dtype=torch.bfloat16,
-                device_map={"": self.DEEP_SEEK_GPU},
+            model = self._load(
+                "deepseek_r1_distill_qwen_32B",
+                lambda: AutoModelForCausalLM.from_pretrained(
+                    model_name,
+                    torch_dtype=torch.bfloat16,
+                    device_map={"": self.DEEP_SEEK_GPU},
+                ),
+                self.DEEP_SEEK_GPU,
             )
             print(model.device)
             tokenizer = AutoTokenizer.from_pretrained(model_name)
@@ -137,7 +205,13 @@ class Models:
     def load_sam(self) -> None:
         """Load SAM model"""
         try:
-            self.models["sam"] = SAM("/dtu/blackhole/14/189044/marscho/VLM_controller_for_SD/sam2.1_b.pt")
+            # Ultralytics places the model on its device at the first prediction, so it is not offloaded
+            self.models["sam"] = self._load(
+                "sam",
+                lambda: SAM("/dtu/blackhole/14/189044/marscho/VLM_controller_for_SD/sam2.1_b.pt"),
+                self.device_reasoning,
+                modules=lambda _: [],
+            )
             logging.info("Loaded SAM model successfully")
         except Exception as e:
             logging.error(f"Failed to load SAM model: {e}")
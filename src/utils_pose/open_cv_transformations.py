@@ -2,6 +2,7 @@ import numpy as np
 import cv2
 import os
 import matplotlib.pyplot as plt
+from .stage_pipeline import PYPLOT_LOCK
 
 
 def _process_object(mask: np.array, transformation_matrix: np.array) -> np.array:
@@ -123,120 +124,123 @@ def run_open_cv_transformations(matrix_transform_file, output_dir, oracle_mask_p
     print(f"Transformed mask saved to: {target_mask_path}")
     print(f"Original oracle saved to: {source_oracle_path}")
     print(f"Transformed oracle saved to: {target_oracle_path}")
-    # Visualization - Mask Transformation
-    plt.figure(figsize=(15, 5))
-
-    # Create subplots for better comparison
-    plt.subplot(131)
-    # Original mask visualization
-    plt.imshow(np.zeros((height, width, 3), dtype=np.uint8) + 255)  # White background
-    mask_overlay = np.zeros((height, width, 4))
-    mask_overlay[binary_mask > 0] = [0, 0.47, 1, 0.8]  # Professional blue with alpha
-    plt.imshow(mask_overlay)
-    plt.title("Original Mask", fontsize=22, pad=10)  # Increased from 14
-    plt.plot([0, width - 1, width - 1, 0, 0], [0, 0, height - 1, height - 1, 0], "k-", linewidth=1)  # Add corners
-    plt.axis("off")
-
-    plt.subplot(132)
-    # Transformed mask visualization
-    plt.imshow(np.zeros((height, width, 3), dtype=np.uint8) + 255)  # White background
-    mask_overlay = np.zeros((height, width, 4))
-    mask_overlay[transformed_mask > 0] = [1, 0.2, 0.2, 0.8]  # Professional red with alpha
-    plt.imshow(mask_overlay)
-    plt.title("Transformed Mask", fontsize=22, pad=10)  # Increased from 14
-    plt.plot([0, width - 1, width - 1, 0, 0], [0, 0, height - 1, height - 1, 0], "k-", linewidth=1)  # Add corners
-    plt.axis("off")
-
-    plt.subplot(133)
-    # Overlay comparison
-    plt.imshow(np.zeros((height, width, 3), dtype=np.uint8) + 255)  # White background
-    # Original mask in blue
-    mask_overlay = np.zeros((height, width, 4))
-    mask_overlay[binary_mask > 0] = [0, 0.47, 1, 0.5]  # Semi-transparent blue
-    plt.imshow(mask_overlay)
-    # Transformed mask in red
-    mask_overlay = np.zeros((height, width, 4))
-    mask_overlay[transformed_mask > 0] = [1, 0.2, 0.2, 0.5]  # Semi-transparent red
-    plt.imshow(mask_overlay)
-    plt.title("Overlay", fontsize=22, pad=10)  # Increased from 14
-    plt.plot([0, width - 1, width - 1, 0, 0], [0, 0, height - 1, height - 1, 0], "k-", linewidth=1)  # Add corners
-    plt.axis("off")
-
-    # Save individual subplot figures
-    for idx, name in enumerate(["original", "transformed", "overlay"], 1):
-        fig = plt.figure(figsize=(5, 5))
-        plt.subplot(111)
-        if idx == 1:
-            # Original mask visualization
-            plt.imshow(np.zeros((height, width, 3), dtype=np.uint8) + 255)
-            mask_overlay = np.zeros((height, width, 4))
-            mask_overlay[binary_mask > 0] = [0, 0.47, 1, 0.8]
-            plt.imshow(mask_overlay)
-        elif idx == 2:
-            # Transformed mask visualization
-            plt.imshow(np.zeros((height, width, 3), dtype=np.uint8) + 255)
-            mask_overlay = np.zeros((height, width, 4))
-            mask_overlay[transformed_mask > 0] = [1, 0.2, 0.2, 0.8]
-            plt.imshow(mask_overlay)
-        else:
-            # Overlay comparison
-            plt.imshow(np.zeros((height, width, 3), dtype=np.uint8) + 255)
-            mask_overlay = np.zeros((height, width, 4))
-            mask_overlay[binary_mask > 0] = [0, 0.47, 1, 0.5]
-            plt.imshow(mask_overlay)
-            mask_overlay = np.zeros((height, width, 4))
-            mask_overlay[transformed_mask > 0] = [1, 0.2, 0.2, 0.5]
-            plt.imshow(mask_overlay)
-        plt.plot([0, width - 1, width - 1, 0, 0], [0, 0, height - 1, height - 1, 0], "k-", linewidth=1)
+    with PYPLOT_LOCK:
+        # Visualization - Mask Transformation
+        plt.figure(figsize=(15, 5))
+
+        # Create subplots for better comparison
+        plt.subplot(131)
+        # Original mask visualization
+        plt.imshow(np.zeros((height, width, 3), dtype=np.uint8) + 255)  # White background
+        mask_overlay = np.zeros((height, width, 4))
+        mask_overlay[binary_mask > 0] = [0, 0.47, 1, 0.8]  # Professional blue with alpha
+        plt.imshow(mask_overlay)
+        plt.title("Original Mask", fontsize=22, pad=10)  # Increased from 14
+        plt.plot([0, width - 1, width - 1, 0, 0], [0, 0, height - 1, height - 1, 0], "k-", linewidth=1)  # Add corners
         plt.axis("off")
-        plt.tight_layout()
-        plt.savefig(os.path.join(output_dir, f"transformation_vis_{name}.png"), transparent=False, dpi=300, bbox_inches="tight", pad_inches=0)
-        plt.close(fig)
-
-    # Add overall title and adjust layout
-    # plt.suptitle('Mask Transformation Analysis', fontsize=18, y=1.05)  # Increased from 16
-    plt.tight_layout()
-
-    plt.tight_layout()
-    plt.savefig(os.path.join(output_dir, "transformation_vis.png"), transparent=False, dpi=300, bbox_inches="tight", pad_inches=0)
-    plt.show()
-
-    # Visualization - Bounding Boxes
-    plt.figure(figsize=(15, 10))
-    plt.gca().set_aspect("equal")
-
-    # Plot original bbox with enhanced style
-    original_bbox = plt.Rectangle(
-        (older_bbox[0], older_bbox[1]),
-        older_bbox[2],
-        older_bbox[3],
-        fill=False,
-        color="#0066CC",  # Refined blue
-        linewidth=3,
-        linestyle="--",
-        label="Initial Position",
-    )
 
-    # Plot transformed bbox with enhanced style
-    transformed_bbox = plt.Rectangle(
-        (new_bbox[0], new_bbox[1]),
-        new_bbox[2],
-        new_bbox[3],
-        fill=False,
-        color="#CC3300",  # Refined red
-        linewidth=3,
-        linestyle="-",
-        label="Transformed Position",
-    )
+        plt.subplot(132)
+        # Transformed mask visualization
+        plt.imshow(np.zeros((height, width, 3), dtype=np.uint8) + 255)  # White background
+        mask_overlay = np.zeros((height, width, 4))
+        mask_overlay[transformed_mask > 0] = [1, 0.2, 0.2, 0.8]  # Professional red with alpha
+        plt.imshow(mask_overlay)
+        plt.title("Transformed Mask", fontsize=22, pad=10)  # Increased from 14
+        plt.plot([0, width - 1, width - 1, 0, 0], [0, 0, height - 1, height - 1, 0], "k-", linewidth=1)  # Add corners
+        plt.axis("off")
 
-    plt.gca().add_patch(original_bbox)
-    plt.gca().add_patch(transformed_bbox)
+        plt.subplot(133)
+        # Overlay comparison
+        plt.imshow(np.zeros((height, width, 3), dtype=np.uint8) + 255)  # White background
+        # Original mask in blue
+        mask_overlay = np.zeros((height, width, 4))
+        mask_overlay[binary_mask > 0] = [0, 0.47, 1, 0.5]  # Semi-transparent blue
+        plt.imshow(mask_overlay)
+        # Transformed mask in red
+        mask_overlay = np.zeros((height, width, 4))
+        mask_overlay[transformed_mask > 0] = [1, 0.2, 0.2, 0.5]  # Semi-transparent red
+        plt.imshow(mask_overlay)
+        plt.title("Overlay", fontsize=22, pad=10)  # Increased from 14
+        plt.plot([0, width - 1, width - 1, 0, 0], [0, 0, height - 1, height - 1, 0], "k-", linewidth=1)  # Add corners
+        plt.axis("off")
+
+        # Save individual subplot figures
+        for idx, name in enumerate(["original", "transformed", "overlay"], 1):
+            fig = plt.figure(figsize=(5, 5))
+            plt.subplot(111)
+            if idx == 1:
+                # Original mask visualization
+                plt.imshow(np.zeros((height, width, 3), dtype=np.uint8) + 255)
+                mask_overlay = np.zeros((height, width, 4))
+                mask_overlay[binary_mask > 0] = [0, 0.47, 1, 0.8]
+                plt.imshow(mask_overlay)
+            elif idx == 2:
+                # Transformed mask visualization
+                plt.imshow(np.zeros((height, width, 3), dtype=np.uint8) + 255)
+                mask_overlay = np.zeros((height, width, 4))
+                mask_overlay[transformed_mask > 0] = [1, 0.2, 0.2, 0.8]
+                plt.imshow(mask_overlay)
+            else:
+                # Overlay comparison
+                plt.imshow(np.zeros((height, width, 3), dtype=np.uint8) + 255)
+                mask_overlay = np.zeros((height, width, 4))
+                mask_overlay[binary_mask > 0] = [0, 0.47, 1, 0.5]
+                plt.imshow(mask_overlay)
+                mask_overlay = np.zeros((height, width, 4))
+                mask_overlay[transformed_mask > 0] = [1, 0.2, 0.2, 0.5]
+                plt.imshow(mask_overlay)
+            plt.plot([0, width - 1, width - 1, 0, 0], [0, 0, height - 1, height - 1, 0], "k-", linewidth=1)
+            plt.axis("off")
+            plt.tight_layout()
+            plt.savefig(os.path.join(output_dir, f"transformation_vis_{name}.png"), transparent=False, dpi=300, bbox_inches="tight", pad_inches=0)
+            plt.close(fig)
+
+        # Add overall title and adjust layout
+        # plt.suptitle('Mask Transformation Analysis', fontsize=18, y=1.05)  # Increased from 16
+        plt.tight_layout()
 
-    plt.xlim(0, width)
-    plt.ylim(height, 0)  # Flip y-axis to match image coordinates
-    plt.grid(False)  # Remove grid for cleaner look
-    plt.legend(loc="upper right", frameon=True, framealpha=0.9, edgecolor="none", fontsize=22)  # Default size is ~10, so 5x larger is 50
-    plt.savefig(os.path.join(output_dir, "bbox_transformation_vis.png"), dpi=300, bbox_inches="tight", pad_inches=0.1)
-    plt.show()
+        plt.tight_layout()
+        plt.savefig(os.path.join(output_dir, "transformation_vis.png"), transparent=False, dpi=300, bbox_inches="tight", pad_inches=0)
+        plt.show()
+        plt.close()
+
+        # Visualization - Bounding Boxes
+        plt.figure(figsize=(15, 10))
+        plt.gca().set_aspect("equal")
+
+        # Plot original bbox with enhanced style
+        original_bbox = plt.Rectangle(
+            (older_bbox[0], older_bbox[1]),
+            older_bbox[2],
+            older_bbox[3],
+            fill=False,
+            color="#0066CC",  # Refined blue
+            linewidth=3,
+            linestyle="--",
+            label="Initial Position",
+        )
+
+        # Plot transformed bbox with enhanced style
+        transformed_bbox = plt.Rectangle(
+            (new_bbox[0], new_bbox[1]),
+            new_bbox[2],
+            new_bbox[3],
+            fill=False,
+            color="#CC3300",  # Refined red
+            linewidth=3,
+            linestyle="-",
+            label="Transformed Position",
+        )
+
+        plt.gca().add_patch(original_bbox)
+        plt.gca().add_patch(transformed_bbox)
+
+        plt.xlim(0, width)
+        plt.ylim(height, 0)  # Flip y-axis to match image coordinates
+        plt.grid(False)  # Remove grid for cleaner look
+        plt.legend(loc="upper right", frameon=True, framealpha=0.9, edgecolor="none", fontsize=22)  # Default size is ~10, so 5x larger is 50
+        plt.savefig(os.path.join(output_dir, "bbox_transformation_vis.png"), dpi=300, bbox_inches="tight", pad_inches=0.1)
+        plt.show()
+        plt.close()
 
     return transformed_mask, transformed_oracle
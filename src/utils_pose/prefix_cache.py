@@ -0,0 +1,67 @@
+import copy
+from typing import Dict, List, Tuple
+
+import torch
+from transformers import DynamicCache
+
+
+class PrefixKVCache:
+    """KV state of static prompt prefixes, computed once per (model, prefix) and reused by every generation.
+
+    Prompts that start with the same text (chat template header plus the fixed system instructions) only
+    need a prefill of their per-sample suffix. The prefix tokens are taken as the longest token prefix
+    shared with every prompt of the batch, so tokenization across the text boundary is never changed.
+    Only the latest prefix of each model is kept, so a changing prefix never pins more than one KV state.
+    """
+
+    def __init__(self):
+        self._entries: Dict[int, Tuple[str, List[int], DynamicCache]] = {}
+
+    def _prefix_state(self, model, tokenizer, prefix_text: str, device) -> Tuple[List[int], DynamicCache]:
+        entry = self._entries.get(id(model))
+        if entry is None or entry[0] != prefix_text:
+            prefix_ids = tokenizer(prefix_text).input_ids
+            with torch.no_grad():
+                outputs = model(input_ids=torch.tensor([prefix_ids], device=device), past_key_values=DynamicCache(), use_cache=True)
+            entry = (prefix_text, prefix_ids, outputs.past_key_values)
+            self._entries[id(model)] = entry
+        return entry[1], entry[2]
+
+    def build_inputs(self, model, tokenizer, texts: List[str], prefix_text: str, device) -> Dict[str, object]:
+        """Tokenize the prompts and attach a copy of the cached prefix state.
+
+        The rows are laid out as [prefix][padding][suffix]: the shared prefix stays aligned with the cached
+        keys and values, and the attention mask excludes the padding between prefix and suffix.
+
+        Returns:
+            Dict with input_ids, attention_mask and past_key_values, to be passed to `model.generate`
+        """
+        prefix_ids, prefix_cache = self._prefix_state(model, tokenizer, prefix_text, device)
+        rows = [tokenizer(text).input_ids for text in texts]
+
+        # Every row keeps at least one uncached token, generate needs it to produce the first logits
+        shared = len(prefix_ids)
+        for ids in rows:
+            common = 0
+            while common < min(shared, len(ids) - 1) and ids[common] == prefix_ids[common]:
+                common += 1
+            shared = common
+
+        past_key_values = copy.deepcopy(prefix_cache)
+        if shared < len(prefix_ids):
+            past_key_values.crop(shared)
+        if len(rows) > 1:
+            past_key_values.batch_repeat_interleave(len(rows))
+
+        suffix_length = max(len(ids) - shared for ids in rows)
+        input_ids, attention_mask = [], []
+        for ids in rows:
+            padding = suffix_length - (len(ids) - shared)
+            input_ids.append(ids[:shared] + [tokenizer.pad_token_id] * padding + ids[shared:])
+            attention_mask.append([1] * shared + [0] * padding + [1] * (len(ids) - shared))
+
+        return {
+            "input_ids": torch.tensor(input_ids, device=device),
+            "attention_mask": torch.tensor(attention_mask, device=device),
+            "past_key_values": past_key_values,
+        }
@@ -5,6 +5,7 @@ import re
 import logging
 from typing import Dict, List, Any, Tuple
 import matplotlib.pyplot as plt
+from .stage_pipeline import PYPLOT_LOCK
 from ultralytics import SAM
 
 
@@ -176,12 +177,13 @@ def run_sam_refine(file_analysis_path: str, img_path: str, sam_model: SAM, debug
 
     if debug:
         # Save debug visualization
-        plt.figure(figsize=(12, 12))
-        plt.imshow(debug_img)
-        plt.title("SAM Refinement Debug View")
-        plt.axis("off")
-        plt.savefig(os.path.join(output_dir, "sam_debug_visualization.png"), bbox_inches="tight", pad_inches=0)
-        plt.close()
+        with PYPLOT_LOCK:
+            plt.figure(figsize=(12, 12))
+            plt.imshow(debug_img)
+            plt.title("SAM Refinement Debug View")
+            plt.axis("off")
+            plt.savefig(os.path.join(output_dir, "sam_debug_visualization.png"), bbox_inches="tight", pad_inches=0)
+            plt.close()
 
     # Write enhanced analysis file
     enhanced_file = os.path.join(output_dir, "analysis_enhanced.txt")
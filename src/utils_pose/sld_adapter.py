@@ -1,14 +1,88 @@
 from .config_sld_format import format_example
 import json
 import logging
-from typing import Tuple, Dict, Any
+from typing import Tuple, Dict, Any, Optional
 import numpy as np
 import os
+import re
+import sys
 
+SLD_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "SLD")
 
-def generate_sld_config(sample_dir: str, analysis_enhanced_file: str, user_edit_instruction: str) -> str:
+# One resident SLD engine per device, shared by every `run_sld` call of the process
+_SLD_ENGINES: Dict[str, Any] = {}
+
+
+def get_sld_engine(device: str = "cuda:0", config_path: Optional[str] = None) -> Any:
+    """Return the process-wide SLD engine for `device`, loading its models on first use.
+
+    Args:
+        device: CUDA device the SLD models are placed on
+        config_path: SLD config (.ini); defaults to `src/SLD/demo_config.ini`
+
+    Returns:
+        SLDEngine: engine with GLIGEN, SAM, OWLv2 and the SDXL refiner resident in memory
+    """
+    if device not in _SLD_ENGINES:
+        # The SLD code base imports its packages (`models`, `utils`, `sld`) as top-level modules
+        if SLD_DIR not in sys.path:
+            sys.path.insert(0, SLD_DIR)
+        from SLD_demo import SLDEngine, DEFAULT_CONFIG_PATH
+
+        logging.info(f"Loading SLD engine on {device}")
+        _SLD_ENGINES[device] = SLDEngine(config_path=config_path or DEFAULT_CONFIG_PATH, device=device)
+    return _SLD_ENGINES[device]
+
+
+def run_sld(
+    json_path: str,
+    input_path: str,
+    output_dir: str,
+    logger: logging.Logger,
+    NORMAL_GPU: str,
+    evaluation_folder_before: str,
+    evaluation_folder_refined: str,
+    save_file_name: str,
+    mode: str = "image_editing",
+    engine: Optional[Any] = None,
+) -> None:
+    """
+    Run the SLD (Structure-aware Latent Diffusion) pipeline in-process on the resident engine
+    """
+    if engine is None:
+        engine = get_sld_engine(NORMAL_GPU)
+
+    evaluation_before_path = os.path.abspath(evaluation_folder_before)
+    evaluation_refined_path = os.path.abspath(evaluation_folder_refined)
+
+    engine.run_json(
+        json_path,
+        input_path,
+        output_dir,
+        mode,
+        evaluation_before_path,
+        evaluation_refined_path,
+        save_file_name,
+    )
+
+
+def generate_sld_config(
+    sample_dir: str,
+    analysis_enhanced_file: str,
+    user_edit_instruction: str,
+    transformation_matrix_file: Optional[str] = None,
+    image_size: Optional[Tuple[int, int]] = None,
+) -> str:
     """Generate Stable Layout Diffusion configuration from enhanced analysis.
 
+    Args:
+        sample_dir: Directory the config is written to
+        analysis_enhanced_file: Enhanced analysis with the (transformed) bounding boxes
+        user_edit_instruction: Edit instruction used as the SLD prompt
+        transformation_matrix_file: Optional math model matrix (pixels, about the object center). When given with
+            `image_size`, it is stored per transformed object so that SLD warps the object's latents with it.
+        image_size: (height, width) of the image the matrix was estimated on
+
     Returns:
         str: Generated SLD configuration as a validated JSON string
 
@@ -31,6 +105,9 @@ def generate_sld_config(sample_dir: str, analysis_enhanced_file: str, user_edit_
                 if current_object:
                     objects.append(current_object)
                 current_object = {}
+                object_id = re.search(r"Object (\d+):", line)
+                if object_id:
+                    current_object["id"] = int(object_id.group(1))
             elif "Class:" in line and current_object is not None:
                 current_object["class"] = line.split("Class:")[1].strip().lower()
             elif "Appearance Token:" in line and current_object is not None:
@@ -98,6 +175,7 @@ def generate_sld_config(sample_dir: str, analysis_enhanced_file: str, user_edit_
 
         # Add layout suggestions with class-specific numbering
         layout_suggestions = []
+        detections = []
         class_counts = {}
 
         for obj in objects:
@@ -111,9 +189,29 @@ def generate_sld_config(sample_dir: str, analysis_enhanced_file: str, user_edit_
             class_counts[obj_class] = class_counts.get(obj_class, 0) + 1
             bbox = obj.get("transformed_bbox", obj["sld_bbox"])
             layout_suggestions.append([f"{display_class} #{class_counts[obj_class]}", bbox])
+            # Current name, as the SLD detector would report it: without the new appearance, so attribute edits are detected
+            detections.append([f"{obj_class} #{class_counts[obj_class]}", obj["sld_bbox"]])
 
         config_data[0]["llm_layout_suggestions"] = layout_suggestions
 
+        # The objects are already localised (VLM + Grounding DINO), so SLD does not need to run its detector.
+        # "Object {id}" of the enhanced analysis has its mask in `mask_{id}.png`, next to the config.
+        config_data[0]["det_results"] = detections
+        config_data[0]["det_masks"] = {
+            name: f"mask_{obj['id']}.png"
+            for obj, (name, _) in zip(objects, detections)
+            if "id" in obj and os.path.exists(os.path.join(sample_dir, f"mask_{obj['id']}.png"))
+        }
+
+        # The transformed objects carry the matrix in normalized image coordinates (still about the object center)
+        if transformation_matrix_file is not None and image_size is not None and os.path.exists(transformation_matrix_file):
+            height, width = image_size
+            to_normalized = np.diag([1.0 / width, 1.0 / height, 1.0])
+            matrix = to_normalized @ np.load(transformation_matrix_file) @ np.linalg.inv(to_normalized)
+            config_data[0]["transformation_matrices"] = {
+                name: matrix.tolist() for obj, (name, _) in zip(objects, layout_suggestions) if "transformed_bbox" in obj
+            }
+
         # Write validated config
         config_path = f"{sample_dir}/config_sld.json"
         with open(config_path, "w", encoding="utf-8") as f:
@@ -0,0 +1,196 @@
+import hashlib
+import json
+import logging
+import os
+import pickle
+import shutil
+import tempfile
+from typing import Any, Callable, Dict, Iterable, List, Optional, Sequence, Tuple
+
+# Bump to invalidate every cached entry after a change to the stage outputs
+CACHE_VERSION = 4
+
+
+def file_digest(*paths: str) -> Optional[str]:
+    """Hash the content of one or more files.
+
+    Args:
+        paths: Files to hash, in order
+
+    Returns:
+        Optional[str]: sha256 hex digest, or None if any file is missing
+    """
+    h = hashlib.sha256()
+    for path in paths:
+        if not os.path.isfile(path):
+            return None
+        h.update(os.path.basename(path).encode())
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(1 << 20), b""):
+                h.update(chunk)
+    return h.hexdigest()
+
+
+def _snapshot(directory: str) -> Dict[str, Tuple[int, int]]:
+    """Map every file below `directory` to its (mtime_ns, size)."""
+    snapshot = {}
+    for root, _, files in os.walk(directory):
+        for name in files:
+            path = os.path.join(root, name)
+            stat = os.stat(path)
+            snapshot[os.path.relpath(path, directory)] = (stat.st_mtime_ns, stat.st_size)
+    return snapshot
+
+
+class StageCache:
+    """Content-addressed cache in front of the pipeline stages.
+
+    Every stage call is keyed by a hash of its inputs (image bytes, edit instruction, model name,
+    upstream artifacts, relevant config). A hit restores the files the stage wrote into the sample
+    directory and returns the stored result, so a rerun only recomputes stages whose inputs changed.
+    """
+
+    def __init__(self, cache_dir: str, enabled: bool = True, logger: Optional[logging.Logger] = None):
+        """
+        Args:
+            cache_dir: Directory where the cache entries are stored
+            enabled: If False, every call runs the stage and nothing is stored
+            logger: Logger for hits and misses
+        """
+        self.cache_dir = cache_dir
+        self.enabled = enabled
+        self.logger = logger or logging.getLogger(__name__)
+        self.hits: Dict[str, int] = {}
+        self.misses: Dict[str, int] = {}
+        if enabled:
+            os.makedirs(cache_dir, exist_ok=True)
+
+    def key(self, stage: str, inputs: Dict[str, Any]) -> str:
+        """Hash the stage name and its (json serializable) inputs."""
+        payload = json.dumps({"version": CACHE_VERSION, "stage": stage, "inputs": inputs}, sort_keys=True, default=str)
+        return hashlib.sha256(payload.encode()).hexdigest()
+
+    def _entry_dir(self, stage: str, key: str) -> str:
+        return os.path.join(self.cache_dir, stage, key[:2], key)
+
+    def cached_call(self, stage: str, inputs: Dict[str, Any], fn: Callable[[], Any], output_dir: str, extra_outputs: Iterable[str] = ()) -> Any:
+        """Run `fn` unless a result for the same stage inputs is cached.
+
+        Args:
+            stage: Stage name
+            inputs: Everything the stage output depends on; pass file contents through `file_digest`
+            fn: Runs the stage and returns its result (must be picklable)
+            output_dir: Sample directory; every file the stage creates or modifies here is cached
+            extra_outputs: Files the stage writes outside `output_dir` (e.g. shared evaluation folders)
+
+        Returns:
+            Any: Result of `fn`, either freshly computed or restored from the cache
+        """
+        if not self.enabled:
+            return fn()
+
+        extra_outputs = list(extra_outputs)
+        key = self.key(stage, inputs)
+        entry_dir = self._entry_dir(stage, key)
+
+        if os.path.isfile(os.path.join(entry_dir, "manifest.json")):
+            result = self._restore(entry_dir, output_dir, extra_outputs)
+            self.hits[stage] = self.hits.get(stage, 0) + 1
+            self.logger.info(f"Stage cache hit for {stage} ({key[:12]})")
+            return result
+
+        self.misses[stage] = self.misses.get(stage, 0) + 1
+        before = _snapshot(output_dir) if os.path.isdir(output_dir) else {}
+        result = fn()
+        after = _snapshot(output_dir) if os.path.isdir(output_dir) else {}
+        changed = [path for path, stat in after.items() if before.get(path) != stat]
+        self._store(entry_dir, result, output_dir, changed, extra_outputs)
+        return result
+
+    def cached_batch_call(
+        self, stage: str, inputs_list: Sequence[Dict[str, Any]], fn: Callable[[List[int]], List[Any]], output_dirs: Sequence[str]
+    ) -> List[Any]:
+        """Batched `cached_call`: cached samples are restored, the others are computed by a single call of `fn`.
+
+        Args:
+            stage: Stage name
+            inputs_list: Stage inputs of every sample
+            fn: Receives the indices of the samples to compute and returns their results in the same order;
+                a result that is an Exception is returned as is and not cached
+            output_dirs: Sample directory of every sample (must be distinct)
+
+        Returns:
+            List[Any]: One result per sample
+        """
+        if not self.enabled:
+            return fn(list(range(len(inputs_list))))
+
+        results: List[Any] = [None] * len(inputs_list)
+        entry_dirs = [self._entry_dir(stage, self.key(stage, inputs)) for inputs in inputs_list]
+        missing = []
+        for i, entry_dir in enumerate(entry_dirs):
+            if os.path.isfile(os.path.join(entry_dir, "manifest.json")):
+                results[i] = self._restore(entry_dir, output_dirs[i], [])
+                self.hits[stage] = self.hits.get(stage, 0) + 1
+                self.logger.info(f"Stage cache hit for {stage} ({os.path.basename(entry_dir)[:12]})")
+            else:
+                self.misses[stage] = self.misses.get(stage, 0) + 1
+                missing.append(i)
+        if not missing:
+            return results
+
+        before = {i: _snapshot(output_dirs[i]) if os.path.isdir(output_dirs[i]) else {} for i in missing}
+        for i, result in zip(missing, fn(missing)):
+            results[i] = result
+            if isinstance(result, Exception):
+                continue
+            after = _snapshot(output_dirs[i]) if os.path.isdir(output_dirs[i]) else {}
+            changed = [path for path, stat in after.items() if before[i].get(path) != stat]
+            self._store(entry_dirs[i], result, output_dirs[i], changed, [])
+        return results
+
+    def _store(self, entry_dir: str, result: Any, output_dir: str, changed: Iterable[str], extra_outputs: Iterable[str]) -> None:
+        # Write to a temporary directory first so that a killed job never leaves a partial entry behind
+        os.makedirs(os.path.dirname(entry_dir), exist_ok=True)
+        tmp_dir = tempfile.mkdtemp(dir=os.path.dirname(entry_dir))
+        try:
+            manifest = {"files": [], "extra": []}
+            for rel_path in changed:
+                dst = os.path.join(tmp_dir, "files", rel_path)
+                os.makedirs(os.path.dirname(dst), exist_ok=True)
+                shutil.copy2(os.path.join(output_dir, rel_path), dst)
+                manifest["files"].append(rel_path)
+            for idx, path in enumerate(extra_outputs):
+                if os.path.isfile(path):
+                    os.makedirs(os.path.join(tmp_dir, "extra"), exist_ok=True)
+                    shutil.copy2(path, os.path.join(tmp_dir, "extra", str(idx)))
+                    manifest["extra"].append(idx)
+            with open(os.path.join(tmp_dir, "result.pkl"), "wb") as f:
+                pickle.dump(result, f)
+            with open(os.path.join(tmp_dir, "manifest.json"), "w") as f:
+                json.dump(manifest, f)
+            if os.path.isdir(entry_dir):
+                shutil.rmtree(entry_dir)
+            os.replace(tmp_dir, entry_dir)
+        except Exception as e:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+            self.logger.error(f"Failed to store stage cache entry {entry_dir}: {e}")
+
+    def _restore(self, entry_dir: str, output_dir: str, extra_outputs: list) -> Any:
+        with open(os.path.join(entry_dir, "manifest.json"), "r") as f:
+            manifest = json.load(f)
+        for rel_path in manifest["files"]:
+            dst = os.path.join(output_dir, rel_path)
+            os.makedirs(os.path.dirname(dst), exist_ok=True)
+            shutil.copy2(os.path.join(entry_dir, "files", rel_path), dst)
+        for idx in manifest["extra"]:
+            if idx < len(extra_outputs):
+                os.makedirs(os.path.dirname(extra_outputs[idx]), exist_ok=True)
+                shutil.copy2(os.path.join(entry_dir, "extra", str(idx)), extra_outputs[idx])
+        with open(os.path.join(entry_dir, "result.pkl"), "rb") as f:
+            return pickle.load(f)
+
+    def report(self) -> list:
+        """One line per stage with the hit and miss counts."""
+        stages = sorted(set(self.hits) | set(self.misses))
+        return [f"- Cache {stage}: {self.hits.get(stage, 0)} hits, {self.misses.get(stage, 0)} misses" for stage in stages]
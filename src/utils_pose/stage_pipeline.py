@@ -0,0 +1,181 @@
+import logging
+import queue
+import threading
+import time
+from typing import Any, Callable, Dict, Iterable, List, Optional
+
+# Marks the end of the sample stream on a queue
+_END = object()
+
+# pyplot draws on a process-wide current figure, so stages running concurrently hold this lock while plotting
+PYPLOT_LOCK = threading.RLock()
+
+
+class Stage:
+    """A single step of the pipeline, run by its own worker thread."""
+
+    def __init__(self, name: str, fn: Callable[[Any], Any], batch_size: int = 1):
+        """
+        Args:
+            name: Stage name used in logs and the utilisation report
+            fn: Processes one sample dict in place and returns it, or returns None to drop the sample.
+                If batch_size > 1, receives a list of samples and returns a list of the same length.
+            batch_size: Maximum number of already queued samples processed by one call of `fn`
+        """
+        self.name = name
+        self.fn = fn
+        self.batch_size = batch_size
+        self.busy_time = 0.0
+        self.wait_time = 0.0
+        self.processed = 0
+        self.dropped = 0
+
+
+class StagePipeline:
+    """Queue-connected stage pipeline.
+
+    Every stage runs in its own thread and hands samples to the next stage through a bounded queue,
+    so sample N+1 can be parsed while sample N is in the math LLM and sample N-1 is rendering. Each
+    stage processes samples strictly in arrival order, which keeps the output order deterministic.
+    """
+
+    def __init__(self, stages: List[Stage], queue_size: int = 2, logger: Optional[logging.Logger] = None):
+        """
+        Args:
+            stages: Stages in execution order
+            queue_size: Maximum number of samples waiting in front of each stage
+            logger: Logger for stage failures
+        """
+        self.stages = stages
+        self.queue_size = queue_size
+        self.logger = logger or logging.getLogger(__name__)
+        self.wall_time = 0.0
+
+    def _worker(self, stage: Stage, in_queue: queue.Queue, out_queue: queue.Queue) -> None:
+        done = False
+        while not done:
+            wait_start = time.time()
+            items = [in_queue.get()]
+            stage.wait_time += time.time() - wait_start
+            # Batched stages take whatever is already waiting, without blocking for more
+            while stage.batch_size > 1 and len(items) < stage.batch_size and items[-1] is not _END:
+                try:
+                    items.append(in_queue.get_nowait())
+                except queue.Empty:
+                    break
+            if items[-1] is _END:
+                items.pop()
+                done = True
+
+            live = [(seq, sample) for seq, sample in items if sample is not None]
+            if live:
+                busy_start = time.time()
+                outputs = self._call(stage, live)
+                stage.busy_time += time.time() - busy_start
+                stage.processed += len(live)
+                stage.dropped += sum(output is None for output in outputs)
+                outputs = dict(zip([seq for seq, _ in live], outputs))
+            else:
+                outputs = {}
+
+            # Dropped samples still travel downstream so that every stage sees the same sequence
+            for seq, _ in items:
+                out_queue.put((seq, outputs.get(seq)))
+        out_queue.put(_END)
+
+    def _call(self, stage: Stage, live: List[tuple]) -> List[Optional[Dict[str, Any]]]:
+        if stage.batch_size == 1:
+            seq, sample = live[0]
+            try:
+                return [stage.fn(sample)]
+            except Exception as e:
+                self.logger.error(f"Stage '{stage.name}' failed for sample {seq}: {e}")
+                return [None]
+        try:
+            return stage.fn([sample for _, sample in live])
+        except Exception as e:
+            self.logger.error(f"Stage '{stage.name}' failed for samples {[seq for seq, _ in live]}: {e}")
+            return [None] * len(live)
+
+    def run(self, samples: Iterable[Dict[str, Any]], on_done: Optional[Callable[[int, Optional[Dict[str, Any]]], None]] = None) -> List[Dict[str, Any]]:
+        """Push all samples through the stages.
+
+        Args:
+            samples: Sample dicts in processing order
+            on_done: Called as `on_done(seq, sample)` when a sample leaves the pipeline (sample is None if dropped)
+
+        Returns:
+            List[Dict[str, Any]]: Samples that completed every stage, in input order
+
+        Raises:
+            Exception: An error of the `samples` iterator, re-raised once the samples fed before it have drained
+        """
+        # A batched stage needs room for a full batch in front of it
+        queues = [queue.Queue(maxsize=max(self.queue_size, stage.batch_size)) for stage in self.stages]
+        queues.append(queue.Queue(maxsize=self.queue_size))
+        workers = [
+            threading.Thread(target=self._worker, args=(stage, queues[i], queues[i + 1]), name=f"stage-{stage.name}", daemon=True)
+            for i, stage in enumerate(self.stages)
+        ]
+
+        feed_error = []
+
+        def feed():
+            # The end marker is always sent, so the workers drain even if the sample iterator fails
+            try:
+                for seq, sample in enumerate(samples):
+                    queues[0].put((seq, sample))
+            except BaseException as e:
+                feed_error.append(e)
+            finally:
+                queues[0].put(_END)
+
+        start_time = time.time()
+        feeder = threading.Thread(target=feed, name="stage-feeder", daemon=True)
+        feeder.start()
+        for worker in workers:
+            worker.start()
+
+        completed = {}
+        while True:
+            item = queues[-1].get()
+            if item is _END:
+                break
+            seq, sample = item
+            if sample is not None:
+                completed[seq] = sample
+            if on_done is not None:
+                on_done(seq, sample)
+
+        feeder.join()
+        for worker in workers:
+            worker.join()
+        self.wall_time = time.time() - start_time
+        if feed_error:
+            raise feed_error[0]
+
+        return [completed[seq] for seq in sorted(completed)]
+
+    def stats(self) -> Dict[str, Dict[str, float]]:
+        """Per-stage busy time, utilisation (busy / wall time) and sample counts of the last run."""
+        return {
+            stage.name: {
+                "busy_time": stage.busy_time,
+                "wait_time": stage.wait_time,
+                "utilisation": stage.busy_time / self.wall_time if self.wall_time > 0 else 0.0,
+                "processed": stage.processed,
+                "dropped": stage.dropped,
+                "avg_time": stage.busy_time / stage.processed if stage.processed > 0 else 0.0,
+            }
+            for stage in self.stages
+        }
+
+    def report(self) -> List[str]:
+        """Human readable utilisation report, one line per stage."""
+        lines = [f"- Pipeline wall time: {self.wall_time:.2f}s"]
+        for name, s in self.stats().items():
+            lines.append(
+                f"- Stage {name}: busy {s['busy_time']:.2f}s ({100 * s['utilisation']:.1f}% utilisation), "
+                f"{s['processed']} processed, {s['dropped']} dropped, {s['avg_time']:.2f}s per sample"
+            )
+        return lines
@@ -5,12 +5,49 @@ from typing import Dict, List, Tuple, Any, Optional
 import logging
 import cv2
 import matplotlib.pyplot as plt
+from .stage_pipeline import PYPLOT_LOCK
 import os
 
 from lmdeploy import pipeline
 from PIL import Image
 
 
+# The system prompts are the same for every image
+QWEN_VL_SYSTEM_PROMPT = """You are a leading computer vision expert specializing in object detection, scene understanding, and spatial relationships.
+    For each detected object in the image, output exactly one line in the following format:
+    DETECT: <object_id_number>|<object_class>|<xmin>|<ymin>|<xmax>|<ymax>
+    POINT: <object_id_number>|<x_center>|<y_center>
+    SCENE: <scene_description>
+    SPATIAL: <spatial_relationships>
+    BACKGROUND: <background_description>
+    GENERATION: <generation_prompt>
+    Note: provide:
+    - Only detect and describe the 2-3 most prominent or important objects in the scene
+    - Bounding boxes use normalized coordinates: [0, 0] at top-left and [1, 1] at bottom-right.
+    - For each detected object, you MUST provide a POINT line with x_center and y_center coordinates
+    - The point coordinates MUST be inside the object's bounding box
+    - For most objects, place the point at the center of the bounding box (x_center=(xmin+xmax)/2, y_center=(ymin+ymax)/2) or at the main center of mass
+    - For some objects like people, the point may be offset from center to mark key features
+    - Use consistent numerical object IDs for detections and points
+    - The generation prompt should be a concise prompt for image editing that captures the key visual elements and style
+            """
+
+INTERN_VL_SYSTEM_PROMPT = """You are a leading computer vision expert specializing in object detection, scene understanding, and spatial relationships.
+    For each detected object in the image, output exactly one line in the following format:
+    DETECT: <object_id_number>|<object_class>|<xmin>|<ymin>|<xmax>|<ymax>
+    POINT: <object_id_number>|<x_center>|<y_center>
+    SCENE: <scene_description>
+    SPATIAL: <spatial_relationships>
+    BACKGROUND: <background_description>
+    GENERATION: <generation_prompt>
+    Note: provide:
+    - Bounding boxes use normalized coordinates: [0, 0] at top-left and [1, 1] at bottom-right.
+    - Points share the same coordinate system; provide x_center and y_center.
+    - Use consistent numerical object IDs for detections and points.
+    - The generation prompt should be a concise prompt for image editing that captures the key visual elements and style
+            """
+
+
 def parse_line(line: str, objects: list) -> None:
     """
     Parse a single line of model output with error handling
@@ -108,50 +145,13 @@ def mock_parse_detection_file(file_path: str, img_path: str) -> List[Dict]:
     return objects
 
 
-def parse_image(
-    image_path: str,
-    model_name: str,
-    model: Optional[Any] = None,
-    processor: Optional[Any] = None,
-    device: str = "cuda",
-    user_edit: Optional[str] = None,
-) -> Dict[str, Any]:
-    """
-    Parse an image using Qwen2VL model to detect objects, points, and scene understanding.
-
-    Args:
-        image_path: Path to input image
-        model: Pre-loaded Qwen model instance
-        processor: Pre-loaded processor instance
-        device: Computing device ('cuda' or 'cpu')
-
-    Returns:
-        Dict containing detected objects, scene description, and spatial relationships
-    """
-
+def _build_messages(model_name: str, image_path: str) -> List[Dict[str, Any]]:
+    """Chat messages asking the VLM to parse one image."""
     if model_name == "qwen_2_5_vl_7b":
-        # Prepare prompt
-        messages = [
+        return [
             {
                 "role": "system",
-                "content": """You are a leading computer vision expert specializing in object detection, scene understanding, and spatial relationships.
-    For each detected object in the image, output exactly one line in the following format:
-    DETECT: <object_id_number>|<object_class>|<xmin>|<ymin>|<xmax>|<ymax>
-    POINT: <object_id_number>|<x_center>|<y_center>
-    SCENE: <scene_description>
-    SPATIAL: <spatial_relationships>
-    BACKGROUND: <background_description>
-    GENERATION: <generation_prompt>
-    Note: provide:
-    - Only detect and describe the 2-3 most prominent or important objects in the scene
-    - Bounding boxes use normalized coordinates: [0, 0] at top-left and [1, 1] at bottom-right.
-    - For each detected object, you MUST provide a POINT line with x_center and y_center coordinates
-    - The point coordinates MUST be inside the object's bounding box
-    - For most objects, place the point at the center of the bounding box (x_center=(xmin+xmax)/2, y_center=(ymin+ymax)/2) or at the main center of mass
-    - For some objects like people, the point may be offset from center to mark key features
-    - Use consistent numerical object IDs for detections and points
-    - The generation prompt should be a concise prompt for image editing that captures the key visual elements and style
-            """,
+                "content": QWEN_VL_SYSTEM_PROMPT,
             },
             {
                 "role": "user",
@@ -161,40 +161,12 @@ def parse_image(
                 ],
             },
         ]
-        text = processor.apply_chat_template(messages, tokenize=False, add_generation_prompt=True)
-        image_inputs, video_inputs = process_vision_info(messages)
-
-        # Generate output
-        with torch.cuda.device(device):
-            inputs = processor(text=[text], images=image_inputs, videos=video_inputs, padding=True, return_tensors="pt").to(device)
-
-            generated_ids = model.generate(**inputs, max_new_tokens=1024)
-            output_text = processor.batch_decode(
-                [out_ids[len(in_ids) :] for in_ids, out_ids in zip(inputs.input_ids, generated_ids)],
-                skip_special_tokens=True,
-                clean_up_tokenization_spaces=False,
-            )[0]
-
     elif model_name == "intern_vl_2_5_8B":
         image_sample = Image.open(image_path)
-        # Prepare prompt
-        messages = [
+        return [
             {
                 "role": "system",
-                "content": """You are a leading computer vision expert specializing in object detection, scene understanding, and spatial relationships.
-    For each detected object in the image, output exactly one line in the following format:
-    DETECT: <object_id_number>|<object_class>|<xmin>|<ymin>|<xmax>|<ymax>
-    POINT: <object_id_number>|<x_center>|<y_center>
-    SCENE: <scene_description>
-    SPATIAL: <spatial_relationships>
-    BACKGROUND: <background_description>
-    GENERATION: <generation_prompt>
-    Note: provide:
-    - Bounding boxes use normalized coordinates: [0, 0] at top-left and [1, 1] at bottom-right.
-    - Points share the same coordinate system; provide x_center and y_center.
-    - Use consistent numerical object IDs for detections and points.
-    - The generation prompt should be a concise prompt for image editing that captures the key visual elements and style
-            """,
+                "content": INTERN_VL_SYSTEM_PROMPT,
             },
             {
                 "role": "user",
@@ -204,13 +176,130 @@ def parse_image(
                 ],
             },
         ]
+    else:
+        raise ValueError(f"Model {model_name} not supported")
 
-        response = model(messages)
-        output_text = response.text
+
+def _generate_outputs(model_name: str, messages_list: List[List[Dict[str, Any]]], model: Any, processor: Any, device: str) -> List[str]:
+    """Run the VLM once on a batch of conversations and return the generated text of each."""
+    if model_name == "qwen_2_5_vl_7b":
+        texts = [processor.apply_chat_template(messages, tokenize=False, add_generation_prompt=True) for messages in messages_list]
+        image_inputs, video_inputs = process_vision_info(messages_list)
+
+        # Left padding keeps the generated tokens of every row right after its prompt
+        padding_side = processor.tokenizer.padding_side
+        processor.tokenizer.padding_side = "left"
+        try:
+            with torch.cuda.device(device):
+                inputs = processor(text=texts, images=image_inputs, videos=video_inputs, padding=True, return_tensors="pt").to(device)
+
+                generated_ids = model.generate(**inputs, max_new_tokens=1024)
+                return processor.batch_decode(
+                    [out_ids[len(in_ids) :] for in_ids, out_ids in zip(inputs.input_ids, generated_ids)],
+                    skip_special_tokens=True,
+                    clean_up_tokenization_spaces=False,
+                )
+        finally:
+            processor.tokenizer.padding_side = padding_side
+
+    elif model_name == "intern_vl_2_5_8B":
+        # The lmdeploy pipeline batches a list of conversations internally
+        responses = model(messages_list)
+        return [response.text for response in responses]
 
     else:
         raise ValueError(f"Model {model_name} not supported")
 
+
+def parse_images(
+    image_paths: List[str],
+    model_name: str,
+    model: Optional[Any] = None,
+    processor: Optional[Any] = None,
+    device: str = "cuda",
+    user_edits: Optional[List[Optional[str]]] = None,
+    batch_size: int = 4,
+) -> List[Dict[str, Any]]:
+    """
+    Parse several images with the VLM, `batch_size` images per generation call.
+
+    Args:
+        image_paths: Paths to the input images
+        model: Pre-loaded VLM instance
+        processor: Pre-loaded processor instance (Qwen2VL only)
+        device: Computing device ('cuda' or 'cpu')
+        user_edits: Edit instruction of every image, used as fallback generation prompt
+        batch_size: Maximum number of images per generation call
+
+    Returns:
+        List with the `parse_image` result of every image, in input order, or the exception raised for that image
+    """
+    if user_edits is None:
+        user_edits = [None] * len(image_paths)
+
+    results: List[Any] = [None] * len(image_paths)
+    for start in range(0, len(image_paths), batch_size):
+        indices, messages_list = [], []
+        for i in range(start, min(start + batch_size, len(image_paths))):
+            try:
+                messages_list.append(_build_messages(model_name, image_paths[i]))
+                indices.append(i)
+            except Exception as e:
+                logging.error(f"Error in parse_image for {image_paths[i]}: {str(e)}")
+                results[i] = e
+        if not indices:
+            continue
+
+        try:
+            output_texts = _generate_outputs(model_name, messages_list, model, processor, device)
+        except Exception as e:
+            if len(indices) == 1:
+                logging.error(f"Error in parse_image for {image_paths[indices[0]]}: {str(e)}")
+                results[indices[0]] = e
+                continue
+            # Generate image by image, so that only the image that breaks the batch fails
+            logging.error(f"Error in batched parse_image, retrying image by image: {str(e)}")
+            output_texts = []
+            for i, messages in zip(indices, messages_list):
+                try:
+                    output_texts.extend(_generate_outputs(model_name, [messages], model, processor, device))
+                except Exception as e:
+                    logging.error(f"Error in parse_image for {image_paths[i]}: {str(e)}")
+                    output_texts.append(e)
+
+        for i, output_text in zip(indices, output_texts):
+            results[i] = output_text if isinstance(output_text, Exception) else _parse_output(output_text, image_paths[i], user_edits[i])
+    return results
+
+
+def parse_image(
+    image_path: str,
+    model_name: str,
+    model: Optional[Any] = None,
+    processor: Optional[Any] = None,
+    device: str = "cuda",
+    user_edit: Optional[str] = None,
+) -> Dict[str, Any]:
+    """
+    Parse an image using Qwen2VL model to detect objects, points, and scene understanding.
+
+    Args:
+        image_path: Path to input image
+        model: Pre-loaded Qwen model instance
+        processor: Pre-loaded processor instance
+        device: Computing device ('cuda' or 'cpu')
+
+    Returns:
+        Dict containing detected objects, scene description, and spatial relationships
+    """
+    result = parse_images([image_path], model_name, model, processor, device, [user_edit], batch_size=1)[0]
+    if isinstance(result, Exception):
+        raise result
+    return result
+
+
+def _parse_output(output_text: str, image_path: str, user_edit: Optional[str]) -> Dict[str, Any]:
+    """Turn the raw VLM output for one image into the `parse_image` result dict."""
     try:
         # Parse output
         objects = []
@@ -274,9 +363,12 @@ def parse_image(
                     logging.error(f"Error drawing object: {str(e)}")
                     continue
 
-            plt.imshow(cv2.cvtColor(debug_image, cv2.COLOR_BGR2RGB))
-            plt.title("Debug: Detected Objects")
-            plt.axis("off")
+            with PYPLOT_LOCK:
+                plt.figure()
+                plt.imshow(cv2.cvtColor(debug_image, cv2.COLOR_BGR2RGB))
+                plt.title("Debug: Detected Objects")
+                plt.axis("off")
+                plt.close()
 
         except Exception as e:
             logging.error(f"Error in visualization: {str(e)}")